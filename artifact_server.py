@@ -0,0 +1,191 @@
+"""
+
+Artifacts served by the bot's own app.
+
+Every plot used to take a cross-app call to the upload function and a
+Cloudinary upload before the user could see it. ArtifactStore instead writes
+the bytes to a content-addressed directory, and mount_artifacts serves it from
+the bot's ASGI app: the URL is known as soon as the execution is done, and
+since a name is the digest of the content, responses are cached for a year as
+immutable.
+
+The directory is bounded by `max_bytes`, the least recently written or served
+artifacts are evicted first. On Modal it is a NetworkFileSystem, so that any
+container of the app serves the artifacts of the others; eviction is then
+approximate, each container only accounts for what it has seen.
+
+The feature is enabled by setting ARTIFACT_BASE_URL to the public URL of the
+app when deploying it:
+
+    artifact_store = artifact_store_from_environment()
+    if artifact_store is not None:
+        mount_artifacts(app, artifact_store)
+        urls = await artifact_store.publish([(data, "image.png")])
+
+Bots that may run without it call publish_artifacts, which falls back to the
+upload function of function_upload.py.
+
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from upload_cache import FileData, LocalDirectoryStorage, read_file_data
+
+ARTIFACT_PATH = "/artifacts"
+ARTIFACT_DIR = "/artifacts"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_NAME = re.compile(r"[0-9a-f]{64}(\.[a-z0-9]+)?")
+
+
+@dataclass
+class ArtifactStoreStats:
+    published: int = 0
+    # artifacts that were already in the store
+    reused: int = 0
+    served: int = 0
+    not_found: int = 0
+    evicted: int = 0
+    evicted_bytes: int = 0
+
+
+class ArtifactStore(LocalDirectoryStorage):
+    """Content-addressed artifacts in `root`, at most `max_bytes` of them."""
+
+    def __init__(
+        self, root: str, base_url: str, max_bytes: int = 2 * 1024**3
+    ) -> None:
+        super().__init__(root, base_url)
+        self.max_bytes = max_bytes
+        self.stats = ArtifactStoreStats()
+        self._lock = threading.Lock()
+        # name -> size, least recently used first
+        self._sizes: OrderedDict[str, int] = OrderedDict()
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and _NAME.fullmatch(entry.name):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._sizes[name] = size
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def upload(self, data: bytes, file_name: str, digest: str) -> str:
+        name = digest + os.path.splitext(file_name)[1]
+        if os.path.isfile(os.path.join(self.root, name)):
+            self.stats.reused += 1
+            self._touch(name, len(data))
+            return self.url(name)
+        url = super().upload(data, file_name, digest)
+        self.stats.published += 1
+        self._touch(name, len(data))
+        self._evict()
+        return url
+
+    def _touch(self, name: str, size: int) -> None:
+        with self._lock:
+            self._sizes[name] = size
+            self._sizes.move_to_end(name)
+
+    def _evict(self) -> None:
+        with self._lock:
+            total = sum(self._sizes.values())
+            # the newest artifact is last, and always kept
+            while total > self.max_bytes and len(self._sizes) > 1:
+                name, size = self._sizes.popitem(last=False)
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.stats.evicted += 1
+                self.stats.evicted_bytes += size
+
+    def put(self, data: FileData, file_name: str) -> str:
+        """Store `data` and return its URL."""
+        data = read_file_data(data)
+        return self.upload(data, file_name, hashlib.sha256(data).hexdigest())
+
+    async def publish(self, files: list[tuple[FileData, str]]) -> list[str]:
+        """Store (data, file_name) pairs off the event loop, the URLs are in order."""
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(
+            *(loop.run_in_executor(None, self.put, *file) for file in files)
+        )
+
+    def path(self, name: str) -> str | None:
+        """The file of the artifact `name`, or None."""
+        path = os.path.join(self.root, name)
+        if not _NAME.fullmatch(name) or not os.path.isfile(path):
+            self.stats.not_found += 1
+            return None
+        self.stats.served += 1
+        with self._lock:
+            if name in self._sizes:
+                self._sizes.move_to_end(name)
+        return path
+
+
+def mount_artifacts(app: Any, store: ArtifactStore, path: str = ARTIFACT_PATH) -> None:
+    """Serve the artifacts of `store` under `path` of the FastAPI `app`."""
+    from fastapi import HTTPException
+    from fastapi.responses import FileResponse
+
+    @app.get(path + "/{name}")
+    async def artifact(name: str) -> Any:
+        file_path = store.path(name)
+        if file_path is None:
+            raise HTTPException(status_code=404)
+        return FileResponse(
+            file_path,
+            media_type=mimetypes.guess_type(name)[0] or "application/octet-stream",
+            headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL},
+        )
+
+
+async def publish_artifacts(
+    store: ArtifactStore | None, files: list[tuple[FileData, str]]
+) -> list[str]:
+    """The URLs of (data, file_name) pairs, from `store` or else the upload app."""
+    if store is not None:
+        # served by this app, available right away
+        return await store.publish(files)
+    import modal
+
+    loop = asyncio.get_running_loop()
+    f = modal.Function.lookup("image-upload-shared", "upload_files")
+    # one call for every file, uploaded concurrently
+    return await loop.run_in_executor(None, f.remote, files)
+
+
+def artifact_environment() -> dict[str, str]:
+    """The ARTIFACT_* variables set at deploy time, to pass on to the app."""
+    return {
+        name: value
+        for name, value in os.environ.items()
+        if name.startswith("ARTIFACT_")
+    }
+
+
+def artifact_store_from_environment() -> ArtifactStore | None:
+    """The store if ARTIFACT_BASE_URL is set, ARTIFACT_DIR and _MAX_BYTES are optional."""
+    base_url = os.environ.get("ARTIFACT_BASE_URL")
+    if not base_url:
+        return None
+    return ArtifactStore(
+        os.environ.get("ARTIFACT_DIR", ARTIFACT_DIR),
+        base_url.rstrip("/") + ARTIFACT_PATH,
+        int(os.environ.get("ARTIFACT_MAX_BYTES", 2 * 1024**3)),
+    )
@@ -0,0 +1,117 @@
+"""
+
+Download user attachments straight to their volume.
+
+All attachments of a message are downloaded concurrently with bounded
+parallelism. Each download is hashed while it streams into a spooled temporary
+file (in memory up to SPOOL_MAX_SIZE, on disk beyond that), the volume needs a
+seekable file as it hashes and measures it before the upload. The digest of
+every uploaded attachment is kept next to it under DIGEST_DIR, and the volume
+copy is skipped when that digest matches, without reading the stored file back.
+A failed attachment does not stop the others, its result carries the error.
+
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+from dataclasses import dataclass
+from typing import Any
+
+import httpx
+
+from http_client import get_async_client
+
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+DIGEST_DIR = ".attachment-digests"
+
+
+@dataclass
+class IngestResult:
+    name: str
+    digest: str
+    size: int
+    # False when the volume already had this content
+    uploaded: bool
+    error: str | None = None
+
+
+def _digest_path(name: str) -> str:
+    return f"{DIGEST_DIR}/{name}.sha256"
+
+
+def _stored_digest(volume: Any, name: str) -> str | None:
+    try:
+        # the digest is only good while the file it describes is still there
+        if not volume.listdir(name):
+            return None
+        return b"".join(volume.read_file(_digest_path(name))).decode().strip()
+    except Exception:
+        return None
+
+
+def _upload(volume: Any, name: str, spool: Any, digest: str) -> None:
+    volume.write_file(name, spool)
+    volume.write_file(_digest_path(name), io.BytesIO(digest.encode()))
+
+
+async def _ingest(
+    client: httpx.AsyncClient,
+    semaphore: asyncio.Semaphore,
+    volume: Any,
+    attachment: Any,
+) -> IngestResult:
+    loop = asyncio.get_running_loop()
+    # the name comes from the user, never let it escape the volume root
+    name = os.path.basename(attachment.name)
+    async with semaphore:
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+            sha256 = hashlib.sha256()
+            async with client.stream("GET", attachment.url, timeout=60) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    sha256.update(chunk)
+                    spool.write(chunk)
+            digest, size = sha256.hexdigest(), spool.tell()
+
+            stored = await loop.run_in_executor(None, _stored_digest, volume, name)
+            if stored == digest:
+                return IngestResult(name, digest, size, uploaded=False)
+
+            spool.seek(0)
+            await loop.run_in_executor(None, _upload, volume, name, spool, digest)
+            return IngestResult(name, digest, size, uploaded=True)
+
+
+async def ingest_attachments(
+    attachments: list[Any],
+    volume: Any,
+    max_concurrency: int = 4,
+    client: httpx.AsyncClient | None = None,
+) -> list[IngestResult]:
+    """Download `attachments` (with .name and .url) into the root of `volume`.
+
+    The results are in the order of `attachments`, those that failed have an error.
+
+    """
+    if not attachments:
+        return []
+    semaphore = asyncio.Semaphore(max_concurrency)
+    client = client or get_async_client()
+    results = await asyncio.gather(
+        *(_ingest(client, semaphore, volume, attachment) for attachment in attachments),
+        return_exceptions=True,
+    )
+    for index, (attachment, result) in enumerate(zip(attachments, results)):
+        if isinstance(result, IngestResult):
+            continue
+        if not isinstance(result, Exception):
+            # cancellation
+            raise result
+        name = os.path.basename(attachment.name)
+        results[index] = IngestResult(name, "", 0, uploaded=False, error=repr(result))
+    return results
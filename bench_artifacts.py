@@ -0,0 +1,108 @@
+"""
+
+Time until a plot can be shown: served by the bot's app or uploaded.
+
+The self-hosted path stores the rendered figures with ArtifactStore.publish and
+fetches them back through the app with mount_artifacts, in process. The upload
+path calls the deployed upload_files function with --remote; without it, the
+call is simulated with a fixed latency per remote hop and per upload, since
+this benchmark cannot assume Cloudinary credentials.
+
+python bench_artifacts.py [--remote]
+
+"""
+
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from artifact_server import ArtifactStore, mount_artifacts
+from figure_capture import FigureCapture, use_agg
+
+# simulated upload path: function lookup and call, then the upload itself
+REMOTE_CALL_SECONDS = 0.25
+UPLOAD_SECONDS = 0.6
+FIGURES = [1, 3, 6]
+RUNS = 5
+
+
+def render(count, seed):
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    with FigureCapture("png", 100) as capture:
+        for _ in range(count):
+            plt.figure()
+            plt.plot(rng.random(200).cumsum())
+    return [(image.data, "image.png") for image in capture.images]
+
+
+async def upload_simulated(files):
+    await asyncio.sleep(REMOTE_CALL_SECONDS)
+    # uploaded concurrently by upload_files
+    await asyncio.sleep(UPLOAD_SECONDS)
+    return [f"https://example.com/{i}.png" for i in range(len(files))]
+
+
+async def upload_remote(files):
+    import modal
+
+    loop = asyncio.get_running_loop()
+    f = modal.Function.lookup("image-upload-shared", "upload_files")
+    return await loop.run_in_executor(None, f.remote, files)
+
+
+async def self_hosted(store, client, files):
+    urls = await store.publish(files)
+    # the client fetches what the user would see
+    for url in urls:
+        response = await client.get(url)
+        response.raise_for_status()
+    return urls
+
+
+async def measure(run, count):
+    seconds = []
+    for seed in range(RUNS):
+        # new figures each run, so that nothing is deduplicated
+        files = render(count, seed + 1000 * count)
+        start = time.perf_counter()
+        await run(files)
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds) * 1000
+
+
+async def main():
+    use_agg()
+    upload = upload_remote if "--remote" in sys.argv else upload_simulated
+    with tempfile.TemporaryDirectory() as root:
+        store = ArtifactStore(root, "http://bot/artifacts", max_bytes=64 * 1024**2)
+        app = FastAPI()
+        mount_artifacts(app, store)
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://bot"
+        ) as client:
+            response = await client.get((await store.publish(render(1, 0)))[0])
+            print("cache-control:", response.headers["cache-control"])
+            print(
+                f"\nmedian of {RUNS} runs (ms),"
+                f" upload path {'remote' if upload is upload_remote else 'simulated'}"
+            )
+            print(f"{'figures':>8} {'upload':>10} {'self-hosted':>12}")
+            for count in FIGURES:
+                uploaded = await measure(upload, count)
+                hosted = await measure(
+                    lambda files: self_hosted(store, client, files), count
+                )
+                print(f"{count:>8} {uploaded:>10.1f} {hosted:>12.1f}")
+        print("\n", store.stats)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
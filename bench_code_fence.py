@@ -0,0 +1,65 @@
+"""
+
+Micro-benchmark of code block detection in a streamed reply.
+
+Compares re.findall over the accumulated reply after every chunk, which is what
+the agent loop used to do, against feeding the chunks to CodeFenceParser.
+
+python bench_code_fence.py
+
+"""
+
+import re
+import time
+
+from code_fence import CodeFenceParser
+
+REPLY_LENGTHS = [10_000, 25_000, 50_000, 100_000]
+# roughly one token per streamed chunk
+CHUNK_SIZE = 4
+
+
+def make_reply(length):
+    prose = "Let me explain the approach step by step before writing the code.\n"
+    code = "```python\nimport numpy as np\nprint(np.arange(10).sum())\n```\n"
+    return (prose * (length // len(prose) + 1))[: length - len(code)] + code
+
+
+def chunks(reply):
+    return re.findall(r"[\s\S]{1,%d}" % CHUNK_SIZE, reply)
+
+
+def detect_with_regex(deltas):
+    reply = ""
+    for delta in deltas:
+        reply += delta
+        if re.findall(r"```python([\s\S]*?)```", reply):
+            return reply
+
+
+def detect_with_parser(deltas):
+    parser = CodeFenceParser()
+    for delta in deltas:
+        if parser.feed(delta):
+            return parser.code
+
+
+def measure(function, deltas, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(deltas)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    print(f"{'length':>8} {'regex (ms)':>12} {'parser (ms)':>12} {'speedup':>8}")
+    for length in REPLY_LENGTHS:
+        deltas = chunks(make_reply(length))
+        regex_seconds = measure(detect_with_regex, deltas)
+        parser_seconds = measure(detect_with_parser, deltas)
+        print(
+            f"{length:>8} {regex_seconds * 1000:>12.1f} {parser_seconds * 1000:>12.1f}"
+            f" {regex_seconds / parser_seconds:>7.0f}x"
+        )
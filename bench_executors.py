@@ -0,0 +1,90 @@
+"""
+
+Latency of typical cells on the three ways to run them.
+
+- cold subprocess: a new interpreter per cell, which imports everything itself
+- warm shell: a pooled IPython shell with the preload modules imported
+- fork server: a child forked per cell from a server with the manifest imported
+
+python bench_executors.py
+
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+from io import StringIO
+
+from fork_server import PRELOAD_MANIFEST, ForkServerExecutor
+from shell_pool import ShellPool
+
+CELLS = {
+    "print": "print(sum(range(1000)))",
+    "numpy": "import numpy as np\nprint(np.random.rand(1000, 100).mean(axis=0).max())",
+    "matplotlib": (
+        "import io\n"
+        "import matplotlib.pyplot as plt\n"
+        "plt.plot(range(100))\n"
+        "plt.savefig(io.BytesIO())\n"
+    ),
+    "exception": "import numpy as np\nnp.zeros(3)[5]",
+}
+RUNS = 10
+
+
+def run_cold(code):
+    subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=False
+    )
+
+
+def make_run_warm(pool):
+    def run_warm(code):
+        with pool.shell() as ipython:
+            old_stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                ipython.run_cell(
+                    code, silent=True, store_history=False, shell_futures=False
+                )
+            finally:
+                sys.stdout = old_stdout
+
+    return run_warm
+
+
+def measure(run, code):
+    seconds = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        run(code)
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds) * 1000
+
+
+def main():
+    start = time.perf_counter()
+    pool = ShellPool(preload=PRELOAD_MANIFEST)
+    print(f"warm shell pool ready in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    executor = ForkServerExecutor(preload=PRELOAD_MANIFEST)
+    executor.warm()
+    print(f"fork server ready in {time.perf_counter() - start:.2f}s")
+
+    runners = {
+        "cold subprocess": run_cold,
+        "warm shell": make_run_warm(pool),
+        "fork server": executor.execute,
+    }
+    print(f"\nmedian of {RUNS} runs (ms)")
+    print(f"{'cell':>12}" + "".join(f"{name:>17}" for name in runners))
+    for cell, code in CELLS.items():
+        print(
+            f"{cell:>12}"
+            + "".join(f"{measure(run, code):>17.1f}" for run in runners.values())
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+
+Benchmark of the execution helpers of function_exec.py, run in process.
+
+For each snippet of the corpus it reports:
+- cold: the first call in a new interpreter, imports and shell pool included
+- warm: p50, p95 and p99 over repeated calls
+- throughput: calls per second with N concurrent callers
+- peak memory: the peak RSS of the cold interpreter and its executions
+
+The results are written as JSON, and --compare prints the change of each
+number against an earlier result file.
+
+python bench_function_exec.py [--runs 20] [--concurrency 4] [--output results.json]
+    [--compare baseline.json]
+
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CORPUS = {
+    "print": ("execute_code", "print('hello world')\nprint(sum(range(10**5)))"),
+    "pandas_groupby": (
+        "execute_code",
+        "import numpy as np\n"
+        "import pandas as pd\n"
+        "df = pd.DataFrame({'key': np.random.randint(0, 100, 10**5),"
+        " 'value': np.random.rand(10**5)})\n"
+        "print(df.groupby('key')['value'].agg(['mean', 'sum']).head())",
+    ),
+    "basemap_plot": (
+        "execute_code_matplotlib",
+        "import matplotlib.pyplot as plt\n"
+        "from mpl_toolkits.basemap import Basemap\n"
+        "m = Basemap(projection='merc', llcrnrlat=20, urcrnrlat=50,"
+        " llcrnrlon=-130, urcrnrlon=-60, resolution='c')\n"
+        "m.drawcoastlines()\n"
+        "m.drawcountries()\n"
+        "plt.show()",
+    ),
+    "exception": ("execute_code", "def f(x):\n    return 1 / x\n\nf(0)"),
+    "large_output": ("execute_code", "for i in range(10**5):\n    print(i, 'x' * 50)"),
+}
+
+# runs in a new interpreter, prints the seconds of the first call and the peak RSS
+COLD_SCRIPT = """\
+import json, resource, sys, time
+start = time.perf_counter()
+import function_exec
+result = function_exec.LOCAL_FUNCTIONS[sys.argv[1]](sys.argv[2])
+seconds = time.perf_counter() - start
+peak = max(
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+)
+print(json.dumps({"seconds": seconds, "peak_rss": peak * 1024}))
+"""
+
+
+def percentile(values, p):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def measure_cold(name, code):
+    completed = subprocess.run(
+        [sys.executable, "-c", COLD_SCRIPT, name, code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    # the helpers log to stdout, the result is the last line
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def measure_warm(function, code, runs):
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function(code)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def measure_throughput(function, code, concurrency, calls):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(lambda _: function(code), range(calls)))
+    return calls / (time.perf_counter() - start)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    import function_exec
+
+    results = {}
+    for snippet, (name, code) in CORPUS.items():
+        function = function_exec.LOCAL_FUNCTIONS[name]
+        cold = measure_cold(name, code)
+        # the first call warms the shell pool of this process
+        function(code)
+        warm = measure_warm(function, code, args.runs)
+        results[snippet] = {
+            "function": name,
+            "cold_ms": cold["seconds"] * 1000,
+            "warm_p50_ms": percentile(warm, 50) * 1000,
+            "warm_p95_ms": percentile(warm, 95) * 1000,
+            "warm_p99_ms": percentile(warm, 99) * 1000,
+            "throughput_per_s": measure_throughput(
+                function, code, args.concurrency, args.runs
+            ),
+            "peak_rss_bytes": cold["peak_rss"],
+        }
+    return {
+        "revision": git_revision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "runs": args.runs,
+        "concurrency": args.concurrency,
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "snippets": results,
+    }
+
+
+def print_report(report, baseline=None):
+    columns = [
+        "cold_ms",
+        "warm_p50_ms",
+        "warm_p95_ms",
+        "warm_p99_ms",
+        "throughput_per_s",
+        "peak_rss_bytes",
+    ]
+    print(f"{'snippet':>15}" + "".join(f"{column:>18}" for column in columns))
+    for snippet, result in report["snippets"].items():
+        cells = []
+        for column in columns:
+            value = result[column]
+            if column == "peak_rss_bytes":
+                cell = f"{value / 1024**2:.0f} MiB"
+            else:
+                cell = f"{value:.1f}"
+            old = (baseline or {}).get("snippets", {}).get(snippet, {}).get(column)
+            if old:
+                cell += f" ({(value - old) / old:+.0%})"
+            cells.append(f"{cell:>18}")
+        print(f"{snippet:>15}" + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--output", default="bench_function_exec.json")
+    parser.add_argument("--compare", help="an earlier result file")
+    args = parser.parse_args()
+
+    # the helpers log every call to stdout
+    with contextlib.redirect_stdout(io.StringIO()):
+        report = run(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"\nwritten to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
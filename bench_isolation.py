@@ -0,0 +1,107 @@
+"""
+
+Concurrent executions in one process, checked for cross-talk.
+
+Every execution writes a file and a module with the same names as the others,
+imports the module, sleeps, and reads both back; every plot saves image.png.
+With a shared working directory they would read each other's files. The check
+fails if any execution sees another's token, two executions share a working
+directory, a plot comes back with the wrong image, or a scratch directory is
+left behind. It also reports the time against running the executions serially.
+
+python bench_isolation.py [--executions 16]
+
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import function_exec
+
+CODE = """\
+import os, time
+token = {token!r}
+with open("data.txt", "w") as f:
+    f.write(token)
+with open("helper.py", "w") as f:
+    f.write(f"VALUE = {{token!r}}")
+import helper
+time.sleep(0.2)
+with open("data.txt") as f:
+    print(helper.VALUE, f.read(), os.getcwd())
+"""
+
+PLOT_CODE = """\
+import matplotlib.pyplot as plt
+plt.title({token!r})
+plt.plot(range(10))
+plt.savefig("image.png")
+plt.close()
+"""
+
+
+def execute(token):
+    output = function_exec.run_code(CODE.format(token=token))
+    _, images, _ = function_exec.run_code_matplotlib(PLOT_CODE.format(token=token))
+    return token, output, images
+
+
+def check(results):
+    problems, directories, images = [], set(), set()
+    for token, output, plots in results:
+        fields = output.split()
+        if len(fields) != 3 or fields[0] != token or fields[1] != token:
+            problems.append(f"{token}: unexpected output {output!r}")
+            continue
+        if fields[2] in directories:
+            problems.append(f"{token}: shared working directory {fields[2]}")
+        directories.add(fields[2])
+        if len(plots) != 1:
+            problems.append(f"{token}: {len(plots)} images instead of 1")
+        elif plots[0]["data"] in images:
+            problems.append(f"{token}: got the image of another execution")
+        else:
+            images.add(plots[0]["data"])
+    left = os.listdir(function_exec.SCRATCH_ROOT)
+    if left:
+        problems.append(f"scratch directories left behind: {left}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--executions", type=int, default=16)
+    args = parser.parse_args()
+    tokens = [uuid.uuid4().hex for _ in range(args.executions)]
+
+    # the helpers log every call to stdout
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        function_exec.run_code("pass")
+        start = time.perf_counter()
+        serial = [execute(token) for token in tokens]
+        serial_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.executions) as pool:
+            concurrent = list(pool.map(execute, tokens))
+        concurrent_seconds = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+
+    problems = check(serial) + check(concurrent)
+    print(f"{args.executions} executions and plots")
+    print(f"serial:     {serial_seconds:.2f}s")
+    print(f"concurrent: {concurrent_seconds:.2f}s")
+    for problem in problems:
+        print("cross-talk:", problem)
+    if problems:
+        sys.exit(1)
+    print("no cross-talk")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+
+Wall time saved by preparing the kernel while the model reply streams.
+
+Runs one agent iteration against local stand-ins: a volume backend with a fixed
+lookup latency, a subprocess kernel, and a model reply streamed at a fixed rate.
+The serial loop prepares everything after the code block closes, like the agent
+used to; the overlapped loop starts RequestPrep when the request arrives.
+
+python bench_overlap.py
+
+"""
+
+import asyncio
+import tempfile
+import time
+
+from kernel_pool import KernelPool, LocalSubprocessBackend
+from request_prep import RequestPrep
+from tracing import Tracer
+from volume_registry import LocalDirectoryBackend, VolumeRegistry
+
+VOLUME_LOOKUP_SECONDS = 0.3
+STREAM_SECONDS = [0.25, 0.5, 1.0, 2.0]
+STREAM_CHUNKS = 50
+WARMUP_CODE = "import json, decimal, email.mime.text\n"
+CODE = "print(sum(range(1000)))\n"
+
+
+class SlowDirectoryBackend(LocalDirectoryBackend):
+    def lookup(self, name):
+        time.sleep(VOLUME_LOOKUP_SECONDS)
+        return super().lookup(name)
+
+
+async def stream_reply(seconds):
+    for _ in range(STREAM_CHUNKS):
+        await asyncio.sleep(seconds / STREAM_CHUNKS)
+
+
+async def run_iteration(root, stream_seconds, overlapped):
+    kernel_pool = KernelPool(LocalSubprocessBackend(workdir=root))
+    prep = RequestPrep(
+        VolumeRegistry(SlowDirectoryBackend(root)),
+        kernel_pool,
+        Tracer().trace(),
+        volume_name="vol-bench",
+        conversation_id="bench",
+        attachments=[],
+        warmup_code=WARMUP_CODE,
+    )
+    start = time.perf_counter()
+    if overlapped:
+        prep.start()
+    await stream_reply(stream_seconds)
+    if not overlapped:
+        prep.start()
+    kernel = await prep.kernel(0)
+    await kernel.execute(CODE)
+    total = time.perf_counter() - start
+    await kernel_pool.close()
+    return total, prep.records[0]
+
+
+async def main():
+    print(
+        f"{'stream (s)':>10} {'serial (s)':>11} {'overlapped (s)':>15}"
+        f" {'saved (s)':>10} {'waited (s)':>11}"
+    )
+    with tempfile.TemporaryDirectory() as root:
+        for stream_seconds in STREAM_SECONDS:
+            serial, _ = await run_iteration(root, stream_seconds, overlapped=False)
+            overlapped, record = await run_iteration(
+                root, stream_seconds, overlapped=True
+            )
+            print(
+                f"{stream_seconds:>10.2f} {serial:>11.3f} {overlapped:>15.3f}"
+                f" {serial - overlapped:>10.3f} {record.wait_seconds:>11.3f}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -13,24 +13,54 @@ from __future__ import annotations
 import os
 from typing import AsyncIterable
 
-import modal
 from fastapi_poe import PoeBot, make_app
 from fastapi_poe.types import PartialResponse, QueryRequest
 from modal import Image, Stub, asgi_app
 
+from output_stream import FencedOutput, coalesce_output, stream_sandbox_output
+from volume_registry import ModalVolumeBackend, VolumeRegistry
+
 
 class EchoBot(PoeBot):
+    # show output while the command runs, at most one event per interval
+    stream_output = True
+    output_coalesce_interval = 0.5
+    output_max_bytes = 20000
+
     async def get_response(
         self, request: QueryRequest
     ) -> AsyncIterable[PartialResponse]:
         last_message = request.query[-1].content
-        stub.nfs = modal.NetworkFileSystem.persisted(f"vol-{request.user_id}")
+        vol = await volume_registry.get(f"vol-{request.user_id}")
         sb = stub.spawn_sandbox(
             "bash",
             "-c",
             f"cd /cache && {last_message}",
-            network_file_systems={"/cache": stub.nfs},
+            network_file_systems={"/cache": vol},
         )
+
+        if self.stream_output:
+            nothing_returned = True
+            fenced_output = FencedOutput()
+            async for kind, payload in coalesce_output(
+                stream_sandbox_output(sb),
+                interval=self.output_coalesce_interval,
+                max_bytes=self.output_max_bytes,
+            ):
+                if kind == "truncated":
+                    yield PartialResponse(text=fenced_output.close())
+                    yield PartialResponse(
+                        text="There is too much output, this is the partial output."
+                    )
+                    continue
+                yield PartialResponse(text=fenced_output.write(kind, payload))
+                nothing_returned = False
+            yield PartialResponse(text=fenced_output.close())
+
+            if nothing_returned:
+                yield PartialResponse(text="""No output or error returned.""")
+            return
+
         sb.wait()
 
         output = sb.stdout.read()
@@ -60,6 +90,8 @@ image = (
 
 stub = Stub("poe-bot-quickstart")
 
+volume_registry = VolumeRegistry(ModalVolumeBackend())
+
 bot = EchoBot()
 
 
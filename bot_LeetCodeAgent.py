@@ -28,18 +28,17 @@ import collections
 import itertools
 import numpy as np
 
-import dill, os, pickle
-if os.path.exists("{conversation_id}.dill"):
-    try:
-        with open("{conversation_id}.dill", 'rb') as f:
-            dill.load_session(f)
-    except:
-        pass
+import sys, types
+if "session_snapshot" not in sys.modules:
+    __session_snapshot__ = types.ModuleType("session_snapshot")
+    exec({snapshot_source}, __session_snapshot__.__dict__)
+    sys.modules["session_snapshot"] = __session_snapshot__
+__snapshot__ = sys.modules["session_snapshot"].open_store(".snapshots/{conversation_id}")
+__snapshot__.restore(globals())
 
 {code}
 
-with open('{conversation_id}.dill', 'wb') as f:
-    dill.dump_session(f)
+__snapshot__.commit(globals(), {code_source})
 """
 
 bot_PythonAgent.SIMULATED_USER_REPLY_NO_OUTPUT_OR_ERROR = """\
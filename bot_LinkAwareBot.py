@@ -8,6 +8,7 @@ What is the difference between https://arxiv.org/pdf/2201.11903.pdf and https://
 """
 from __future__ import annotations
 
+import asyncio
 import re
 from io import BytesIO
 from typing import AsyncIterable
@@ -15,7 +16,6 @@ from urllib.parse import urlparse, urlunparse
 
 import fastapi_poe.client
 import pdftotext
-import requests
 from bs4 import BeautifulSoup
 from fastapi_poe import PoeBot, make_app
 from fastapi_poe.client import MetaMessage, stream_request
@@ -23,6 +23,9 @@ from fastapi_poe.types import QueryRequest, SettingsRequest, SettingsResponse
 from modal import Image, Stub, asgi_app
 from sse_starlette.sse import ServerSentEvent
 
+from http_client import log_stats
+from url_fetch import FetchResult, UrlFetcher, log_results
+
 fastapi_poe.client.MAX_EVENT_COUNT = 10000
 
 url_regex = re.compile(
@@ -64,51 +67,45 @@ def insert_newlines(element):
             tag.insert_after("\n")
 
 
-def extract_readable_text(url):
-    # Note: many websites seem to block this, needs fixing
-    try:
-        response = requests.get(url)
-    except requests.exceptions.InvalidURL:
-        print(f"URL is invalid: {url}")
-        return None
-    except Exception:
-        print(f"Unable to load URL: {url}")
-        return None
+def extract_readable_text(html):
+    # Note: many websites seem to block fetching, needs fixing
+    soup = BeautifulSoup(html, "html.parser")
 
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.text, "html.parser")
+    for element in soup(["script", "style", "nav", "header", "footer"]):
+        element.decompose()
 
-        for element in soup(["script", "style", "nav", "header", "footer"]):
-            element.decompose()
+    insert_newlines(soup)
 
-        insert_newlines(soup)
+    readable_text = soup.get_text()
 
-        readable_text = soup.get_text()
+    # Clean up extra whitespaces without collapsing newlines
+    readable_text = "\n".join(
+        " ".join(line.split()) for line in readable_text.split("\n")
+    )
 
-        # Clean up extra whitespaces without collapsing newlines
-        readable_text = "\n".join(
-            " ".join(line.split()) for line in readable_text.split("\n")
-        )
+    return readable_text
 
-        return readable_text
 
-    else:
-        print(f"Request failed with status code {response.status_code}")
-        return None
+def parse_pdf_document(data: bytes) -> str:
+    with BytesIO(data) as f:
+        pdf = pdftotext.PDF(f)
+    text = "\n\n".join(pdf)
+    return text[:2000]
 
 
-def parse_pdf_document_from_url(pdf_url: str) -> tuple[bool, str]:
+def page_content(result: FetchResult) -> str | None:
+    # parsing is CPU bound, this runs in a thread
+    if not result.ok:
+        print(f"Unable to load URL: {result.url} ({result.error})")
+        return None
     try:
-        response = requests.get(pdf_url)
-        with BytesIO(response.content) as f:
-            pdf = pdftotext.PDF(f)
-        text = "\n\n".join(pdf)
-        text = text[:2000]
-        return True, text
-    except requests.exceptions.MissingSchema:
-        return False, ""
-    except BaseException:
-        return False, ""
+        if result.url.endswith(".pdf") or "pdf" in result.content_type:
+            return parse_pdf_document(result.content)
+        html = result.content.decode(errors="replace")
+        return extract_readable_text(html)[:3000]  # to fix
+    except Exception:
+        print(f"Unable to parse URL: {result.url}")
+        return None
 
 
 class EchoBot(PoeBot):
@@ -116,14 +113,25 @@ class EchoBot(PoeBot):
         user_statement = query.query[-1].content.strip()
         print(user_statement)
 
-        urls = extract_urls(user_statement)
+        # every link at once, slow ones are left out at the deadline
+        urls = list(
+            dict.fromkeys(
+                resolve_url_scheme(url) for url in extract_urls(user_statement)
+            )
+        )
+        results = await url_fetcher.fetch_all(urls)
+        log_results(results)
+        log_stats()
+        loop = asyncio.get_running_loop()
+        contents = await asyncio.gather(
+            *(loop.run_in_executor(None, page_content, result) for result in results)
+        )
 
-        for url in urls:
-            if url.endswith(".pdf"):
-                _, content = parse_pdf_document_from_url(url)
-            else:
-                content = extract_readable_text(url)[:3000]  # to fix
-            user_statement += "\n{url} contains the following content:"
+        for url, content in zip(urls, contents):
+            if content is None:
+                user_statement += f"\n{url} could not be loaded."
+                continue
+            user_statement += f"\n{url} contains the following content:"
             user_statement += "\n\n---\n\n"
             user_statement += content
             user_statement += "\n\n---\n\n"
@@ -150,6 +158,8 @@ class EchoBot(PoeBot):
         )
 
 
+url_fetcher = UrlFetcher(connect_timeout=3, read_timeout=10, per_host=2, deadline=15)
+
 bot = EchoBot()
 
 image = (
@@ -158,7 +168,8 @@ image = (
     .pip_install(
         "fastapi-poe==0.0.23",
         "pdftotext==2.2.2",
-        "requests==2.28.2",
+        "httpx[http2]==0.28.1",
+        "httpcore==1.0.9",
         "beautifulsoup4==4.12.2",
     )
 )
@@ -12,7 +12,7 @@ from typing import AsyncIterable
 from urllib.parse import urlparse, urlunparse
 
 import fastapi_poe.client
-import requests
+import httpx
 from bs4 import BeautifulSoup
 from fastapi_poe import PoeBot, make_app
 from fastapi_poe.client import MetaMessage, stream_request
@@ -20,6 +20,8 @@ from fastapi_poe.types import QueryRequest, SettingsRequest, SettingsResponse
 from modal import Image, Stub, asgi_app
 from sse_starlette.sse import ServerSentEvent
 
+from http_client import get_async_client, log_stats
+
 fastapi_poe.client.MAX_EVENT_COUNT = 10000
 
 PROMPT_TEMPLATE = """
@@ -78,10 +80,10 @@ def insert_newlines(element):
             tag.insert_after("\n")
 
 
-def extract_readable_text(url):
+async def extract_readable_text(url):
     try:
-        response = requests.get(url)
-    except requests.exceptions.InvalidURL:
+        response = await get_async_client().get(url, timeout=10)
+    except (httpx.InvalidURL, httpx.UnsupportedProtocol):
         print(f"URL is invalid: {url}")
         return None
     except Exception:
@@ -118,7 +120,8 @@ class EchoBot(PoeBot):
             url = query.query[-1].content.strip()
             url = resolve_url_scheme(url)
             yield self.replace_response_event(f"Attempting to load [{url}]({url}) ...")
-            content = extract_readable_text(url)
+            content = await extract_readable_text(url)
+            log_stats()
             if content is None:
                 yield self.replace_response_event(
                     "Please submit an URL that you want to create a promoted answer for."
@@ -156,7 +159,10 @@ class EchoBot(PoeBot):
 bot = EchoBot()
 
 image = Image.debian_slim().pip_install(
-    "fastapi-poe==0.0.23", "requests==2.31.0", "beautifulsoup4==4.10.0"
+    "fastapi-poe==0.0.23",
+    "httpx[http2]==0.28.1",
+    "httpcore==1.0.9",
+    "beautifulsoup4==4.10.0",
 )
 
 stub = Stub("poe-bot-quickstart")
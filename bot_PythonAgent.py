@@ -10,13 +10,12 @@ list directory
 
 from __future__ import annotations
 
+import inspect
 import os
-import re
 import textwrap
+import time
 from typing import AsyncIterable
 
-import modal
-import requests
 from fastapi_poe import PoeBot, make_app
 from fastapi_poe.client import MetaMessage, stream_request
 from fastapi_poe.types import (
@@ -26,13 +25,26 @@ from fastapi_poe.types import (
     SettingsRequest,
     SettingsResponse,
 )
-from modal import Image, Stub, asgi_app
-
+from modal import Image, NetworkFileSystem, Stub, asgi_app
+
+import session_snapshot
+from artifact_server import (
+    ARTIFACT_DIR,
+    artifact_environment,
+    artifact_store_from_environment,
+    mount_artifacts,
+    publish_artifacts,
+)
+from code_fence import CodeFenceParser
+from history_compaction import HistoryCompactor, ToolTurn
+from kernel_pool import KernelDied, KernelPool, ModalSandboxBackend
+from output_stream import FencedOutput, coalesce_output
+from request_prep import RequestPrep
+from tracing import tracer_from_environment
+from volume_registry import ModalVolumeBackend, VolumeRegistry
 
-def extract_code(reply):
-    pattern = r"```python([\s\S]*?)```"
-    matches = re.findall(pattern, reply)
-    return "\n\n".join(matches)
+# shipped to the kernel as source, the sandbox image does not have this repository
+SESSION_SNAPSHOT_SOURCE = inspect.getsource(session_snapshot)
 
 
 PYTHON_AGENT_SYSTEM_PROMPT = """
@@ -70,31 +82,24 @@ yfinance
 CODE_WITH_WRAPPERS = """\
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.pyplot import savefig
-
-def save_image(filename):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            savefig(filename)
-        return wrapper
-    return decorator
-
-plt.show = save_image('image.png')(plt.show)
-plt.savefig = save_image('image.png')(plt.savefig)
-
-import dill, os, pickle
-if os.path.exists("{conversation_id}.dill"):
-    try:
-        with open("{conversation_id}.dill", 'rb') as f:
-            dill.load_session(f)
-    except:
-        pass
+
+import sys, types
+if "session_snapshot" not in sys.modules:
+    __session_snapshot__ = types.ModuleType("session_snapshot")
+    exec({snapshot_source}, __session_snapshot__.__dict__)
+    sys.modules["session_snapshot"] = __session_snapshot__
+__snapshot__ = sys.modules["session_snapshot"].open_store(".snapshots/{conversation_id}")
+__snapshot__.restore(globals())
 
 {code}
 
-with open('{conversation_id}.dill', 'wb') as f:
-    dill.dump_session(f)
+__snapshot__.commit(globals(), {code_source})
+"""
+
+# run on a new kernel while the model is still writing the code
+KERNEL_WARMUP_CODE = """\
+import numpy
+import matplotlib.pyplot
 """
 
 SIMULATED_USER_REPLY_OUTPUT_ONLY = """\
@@ -144,17 +149,36 @@ Otherwise, provide a brief and concise comment.
 
 def wrap_session(code, conversation_id):
     # the wrapper code
-    # - load session with dill (for the same conversation)
+    # - restore the globals that changed since the kernel last saw the snapshot
     # - execute the code
-    # - save to image.png on plt.plot() and plt.show()
-    # - save session with dill (if execution is successful)
+    # (the kernel renders the figures on plt.show() and those left open)
+    # - save the globals the code touched (if execution is successful)
 
-    return CODE_WITH_WRAPPERS.format(code=code, conversation_id=conversation_id)
+    return CODE_WITH_WRAPPERS.format(
+        code=code,
+        conversation_id=conversation_id,
+        snapshot_source=repr(SESSION_SNAPSHOT_SOURCE),
+        code_source=repr(code),
+    )
+
+
+async def upload_artifacts(artifacts):
+    return await publish_artifacts(
+        artifact_store, [(artifact.data, artifact.name) for artifact in artifacts]
+    )
 
 
 class PythonAgentBot(PoeBot):
     prompt_bot = "ChatGPT"
     code_iteration_limit = 7
+    code_execution_timeout = 5 * 60
+    # show output while the code runs, at most one event per interval
+    stream_output = True
+    output_coalesce_interval = 0.5
+    output_max_bytes = 20000
+    # upstream prompt budget, older iterations are compacted to fit
+    history_token_budget = 6000
+    output_token_limit = 1000
 
     async def get_response(
         self, request: QueryRequest
@@ -171,152 +195,235 @@ class PythonAgentBot(PoeBot):
         request.logit_bias = {"21362": -10}  # censor "![", but does this work?
         request.temperature = 0.1  # does this work?
 
-        # procedure to create volume if it does not exist
-        # tried other ways to write a code but has hydration issues
+        trace = tracer.trace(
+            conversation_id=request.conversation_id, user_id=request.user_id
+        )
+
+        # files in latest user message, ingested in the background
+        attachments = request.query[-1].attachments
+
+        # volume lookup, attachment ingestion and kernel warm-up run while the
+        # model is streaming its reply
+        prep = RequestPrep(
+            volume_registry,
+            kernel_pool,
+            trace,
+            volume_name=f"vol-{request.user_id}",
+            conversation_id=request.conversation_id,
+            attachments=attachments,
+            warmup_code=KERNEL_WARMUP_CODE,
+        )
+        prep.start()
         try:
-            vol = modal.NetworkFileSystem.lookup(f"vol-{request.user_id}")
-        except Exception:
-            stub.nfs = modal.NetworkFileSystem.persisted(f"vol-{request.user_id}")
-            sb = stub.spawn_sandbox(
-                "bash", "-c", "cd /cache", network_file_systems={"/cache": stub.nfs}
+            for query in request.query:
+                for attachment in query.attachments:
+                    query.content += f"\n\nThe user has provided {attachment.name} in the current directory."
+                query.attachments = []
+
+            history_compactor = HistoryCompactor(
+                budget_tokens=self.history_token_budget,
+                max_output_tokens=self.output_token_limit,
             )
-            sb.wait()
-            vol = modal.NetworkFileSystem.lookup(f"vol-{request.user_id}")
-
-        for query in request.query:
-            for attachment in query.attachments:
-                query.content += f"\n\nThe user has provided {attachment.name} in the current directory."
-            query.attachments = []
-
-        # upload files in latest user message
-        for attachment in request.query[-1].attachments:
-            r = requests.get(attachment.url)
-            with open(attachment.name, "wb") as f:
-                f.write(r.content)
-            vol.add_local_file(attachment.name)
-
-        for code_iteration_count in range(self.code_iteration_limit):
-            print("code_iteration_count", code_iteration_count)
-
-            current_bot_reply = ""
-            async for msg in stream_request(request, self.prompt_bot, request.api_key):
-                if isinstance(msg, MetaMessage):
-                    continue
-                elif msg.is_suggested_reply:
-                    yield self.suggested_reply_event(msg.text)
-                elif msg.is_replace_response:
-                    yield self.replace_response_event(msg.text)
-                else:
-                    current_bot_reply += msg.text
-                    yield self.text_event(msg.text)
-                    if extract_code(current_bot_reply):
-                        # break when a Python code block is detected
-                        break
-
-            message = ProtocolMessage(role="bot", content=current_bot_reply)
-            request.query.append(message)
-
-            # if the bot output does not have code, terminate
-            code = extract_code(current_bot_reply)
-            if not code:
-                return
-
-            # prepare code for execution
-            print("code")
-            print(code)
-            wrapped_code = wrap_session(code, conversation_id=request.conversation_id)
-
-            # upload python script
-            with open(f"{request.user_id}.py", "w") as f:
-                f.write(wrapped_code)
-            vol.add_local_file(f"{request.user_id}.py", f"{request.user_id}.py")
-
-            # execute code
-            stub.nfs = modal.NetworkFileSystem.persisted(f"vol-{request.user_id}")
-            sb = stub.spawn_sandbox(
-                "bash",
-                "-c",
-                f"cd /cache && python {request.user_id}.py",
-                image=image_exec,
-                network_file_systems={"/cache": stub.nfs},
-            )
-            sb.wait()
-
-            output = sb.stdout.read()
-            error = sb.stderr.read()
+            tool_turns = []
+
+            for code_iteration_count in range(self.code_iteration_limit):
+                print("code_iteration_count", code_iteration_count)
+
+                if tool_turns:
+                    record = history_compactor.compact(request.query, tool_turns)
+                    print("history_tokens", record.tokens_before, record.tokens_after)
+
+                prep.warm()
+                current_bot_reply = ""
+                code_fence_parser = CodeFenceParser()
+                upstream_start = time.perf_counter()
+                first_token = True
+                with trace.span("upstream_total", iteration=code_iteration_count):
+                    async for msg in stream_request(
+                        request, self.prompt_bot, request.api_key
+                    ):
+                        if isinstance(msg, MetaMessage):
+                            continue
+                        elif msg.is_suggested_reply:
+                            yield self.suggested_reply_event(msg.text)
+                        elif msg.is_replace_response:
+                            yield self.replace_response_event(msg.text)
+                        else:
+                            if first_token:
+                                first_token = False
+                                trace.add(
+                                    "upstream_ttft",
+                                    time.perf_counter() - upstream_start,
+                                    iteration=code_iteration_count,
+                                )
+                            current_bot_reply += msg.text
+                            yield self.text_event(msg.text)
+                            if code_fence_parser.feed(msg.text):
+                                # break when a Python code block is detected
+                                break
+
+                bot_message = ProtocolMessage(role="bot", content=current_bot_reply)
+                request.query.append(bot_message)
+
+                # if the bot output does not have code, terminate
+                code = code_fence_parser.code
+                if not code:
+                    return
+
+                # prepare code for execution
+                print("code")
+                print(code)
+                wrapped_code = wrap_session(
+                    code, conversation_id=request.conversation_id
+                )
 
-            print("len(output)", len(output))
-            print("len(error)", len(error))
-            if error:  # for monitoring
-                print("error")
-                print(error)
+                # execute code in the long-lived kernel of this conversation
+                try:
+                    kernel = await prep.kernel(code_iteration_count)
+                except Exception as e:
+                    print("kernel unavailable", repr(e))
+                    yield self.text_event(
+                        "\n\nThe Python environment could not be started."
+                    )
+                    return
+                print("saved_seconds", prep.records[-1].saved_seconds)
+                for failed in prep.take_failed_attachments():
+                    yield self.text_event(
+                        f"\n\nThe attachment {failed.name} could not be loaded."
+                    )
+                output, error, dropped, result = "", "", 0, None
+                fenced_output = FencedOutput()
+                with trace.span("execution", iteration=code_iteration_count):
+                    try:
+                        events = kernel.stream(
+                            wrapped_code,
+                            timeout=self.code_execution_timeout,
+                            max_output_bytes=self.output_max_bytes,
+                        )
+                        async for kind, payload in coalesce_output(
+                            events,
+                            interval=self.output_coalesce_interval,
+                            max_bytes=self.output_max_bytes,
+                        ):
+                            if kind == "stdout":
+                                output += payload
+                            elif kind == "stderr":
+                                error += payload
+                            elif kind == "truncated":
+                                dropped += payload
+                            elif kind == "result":
+                                result = payload
+                                dropped += payload.dropped
+                            if self.stream_output and kind in ("stdout", "stderr"):
+                                yield PartialResponse(
+                                    text=fenced_output.write(kind, payload)
+                                )
+                    except KernelDied:
+                        # the next cell of the conversation starts a new kernel
+                        await kernel_pool.evict(request.conversation_id)
+                        yield self.text_event(
+                            "\n\nThe Python process exited unexpectedly."
+                        )
+                        return
+                    finally:
+                        await kernel_pool.release(kernel)
+                if self.stream_output:
+                    yield PartialResponse(text=fenced_output.close())
+                if dropped:
+                    yield self.text_event(
+                        "\n\nThere is too much output, this is the partial output.\n\n"
+                    )
 
-            current_user_simulated_reply = ""
-            if output and error:
-                yield PartialResponse(
-                    text=textwrap.dedent(f"\n\n```output\n{output}```\n\n")
-                )
-                yield PartialResponse(
-                    text=textwrap.dedent(f"\n\n```error\n{error}```\n\n")
-                )
-                current_user_simulated_reply = (
-                    SIMULATED_USER_REPLY_OUTPUT_AND_ERROR.format(
-                        output=output, error=error
+                print("len(output)", len(output))
+                print("len(error)", len(error))
+                if error:  # for monitoring
+                    print("error")
+                    print(error)
+
+                # the user sees everything, the model gets the head and the tail
+                model_output = history_compactor.truncate(output)
+                model_error = history_compactor.truncate(error)
+
+                current_user_simulated_reply = ""
+                if output and error:
+                    if not self.stream_output:
+                        yield PartialResponse(
+                            text=textwrap.dedent(f"\n\n```output\n{output}```\n\n")
+                        )
+                        yield PartialResponse(
+                            text=textwrap.dedent(f"\n\n```error\n{error}```\n\n")
+                        )
+                    current_user_simulated_reply = (
+                        SIMULATED_USER_REPLY_OUTPUT_AND_ERROR.format(
+                            output=model_output, error=model_error
+                        )
                     )
-                )
-            elif output:
-                yield PartialResponse(
-                    text=textwrap.dedent(f"\n\n```output\n{output}```\n\n")
-                )
-                current_user_simulated_reply = SIMULATED_USER_REPLY_OUTPUT_ONLY.format(
-                    output=output
-                )
-            elif error:
-                yield PartialResponse(
-                    text=textwrap.dedent(f"\n\n```error\n{error}```\n\n")
-                )
-                current_user_simulated_reply = SIMULATED_USER_REPLY_ERROR_ONLY.format(
-                    error=error
-                )
-            else:
-                current_user_simulated_reply = SIMULATED_USER_REPLY_NO_OUTPUT_OR_ERROR
-
-            # upload image and get image url
-            image_url = None
-            if any("image.png" in str(entry) for entry in vol.listdir("*")):
-                # some roundabout way to check if image file is in directory
-                with open("image.png", "wb") as f:
-                    for chunk in vol.read_file("image.png"):
-                        f.write(chunk)
-
-                image_data = None
-                with open("image.png", "rb") as f:
-                    image_data = f.read()
-
-                print("len(image_data)", len(image_data))
-                if image_data:
-                    f = modal.Function.lookup("image-upload-shared", "upload_file")
-                    image_url = f.remote(image_data, "image.png")
-                    yield PartialResponse(
-                        text=textwrap.dedent(f"\n\n![plot]({image_url})")
+                elif output:
+                    if not self.stream_output:
+                        yield PartialResponse(
+                            text=textwrap.dedent(f"\n\n```output\n{output}```\n\n")
+                        )
+                    current_user_simulated_reply = (
+                        SIMULATED_USER_REPLY_OUTPUT_ONLY.format(output=model_output)
                     )
-                    vol.remove_file("image.png")
-
-            if image_url:
-                # wishlist - call an API that describes what is going on in the image
-                current_user_simulated_reply += SIMULATED_USER_SUFFIX_IMAGE_FOUND
-                if not output and not error:
-                    current_user_simulated_reply = SIMULATED_USER_SUFFIX_IMAGE_FOUND
-            else:
-                if "matplotlib" in code:
-                    current_user_simulated_reply += (
-                        SIMULATED_USER_SUFFIX_IMAGE_NOT_FOUND
+                elif error:
+                    if not self.stream_output:
+                        yield PartialResponse(
+                            text=textwrap.dedent(f"\n\n```error\n{error}```\n\n")
+                        )
+                    current_user_simulated_reply = (
+                        SIMULATED_USER_REPLY_ERROR_ONLY.format(error=model_error)
+                    )
+                else:
+                    current_user_simulated_reply = (
+                        SIMULATED_USER_REPLY_NO_OUTPUT_OR_ERROR
+                    )
+
+                # upload the figures of the cell and get their urls
+                image_urls = []
+                if result is not None and result.artifacts:
+                    print("len(artifacts)", len(result.artifacts))
+                    trace.add(
+                        "image_fetch",
+                        result.artifact_seconds,
+                        iteration=code_iteration_count,
+                        images=len(result.artifacts),
                     )
+                    with trace.span(
+                        "image_upload",
+                        iteration=code_iteration_count,
+                        images=len(result.artifacts),
+                    ):
+                        image_urls = await upload_artifacts(result.artifacts)
+                    for image_url in image_urls:
+                        yield PartialResponse(text=f"\n\n![plot]({image_url})")
+
+                if image_urls:
+                    # wishlist - call an API that describes what is going on in the image
+                    current_user_simulated_reply += SIMULATED_USER_SUFFIX_IMAGE_FOUND
+                    if not output and not error:
+                        current_user_simulated_reply = SIMULATED_USER_SUFFIX_IMAGE_FOUND
+                else:
+                    if "matplotlib" in code:
+                        current_user_simulated_reply += (
+                            SIMULATED_USER_SUFFIX_IMAGE_NOT_FOUND
+                        )
 
-            current_user_simulated_reply += SIMULATED_USER_SUFFIX_PROMPT
+                current_user_simulated_reply += SIMULATED_USER_SUFFIX_PROMPT
 
-            message = ProtocolMessage(role="user", content=current_user_simulated_reply)
-            request.query.append(message)
+                message = ProtocolMessage(
+                    role="user", content=current_user_simulated_reply
+                )
+                request.query.append(message)
+                # stderr alone, e.g. a warning, is not a failure
+                failed = (
+                    result is None or result.timed_out or result.exception is not None
+                )
+                tool_turns.append(ToolTurn(bot_message, message, failed=failed))
+        finally:
+            # the kernel prepared for the next iteration goes back to the pool
+            prep.close()
+            tracer.log_summary()
 
     async def get_settings(self, setting: SettingsRequest) -> SettingsResponse:
         return SettingsResponse(
@@ -328,8 +435,14 @@ class PythonAgentBot(PoeBot):
 
 image_bot = (
     Image.debian_slim()
-    .pip_install("fastapi-poe==0.0.23", "requests==2.28.2")
-    .env({"POE_ACCESS_KEY": os.environ["POE_ACCESS_KEY"]})
+    .pip_install(
+        "fastapi-poe==0.0.23",
+        "httpx[http2]==0.28.1",
+        "httpcore==1.0.9",
+        "requests==2.28.2",
+        "tiktoken",
+    )
+    .env({"POE_ACCESS_KEY": os.environ["POE_ACCESS_KEY"], **artifact_environment()})
 )
 
 image_exec = Image.debian_slim().pip_install(
@@ -379,11 +492,31 @@ image_exec = Image.debian_slim().pip_install(
 
 stub = Stub("poe-bot-quickstart")
 
+kernel_pool = KernelPool(ModalSandboxBackend(stub, image_exec))
+
+# per-phase timings, set TRACE_EXPORT_PATH to also write the spans out
+tracer = tracer_from_environment()
+
+volume_registry = VolumeRegistry(ModalVolumeBackend())
+
 bot = PythonAgentBot()
 
+# set when the app serves the plots itself, see artifact_server.py
+artifact_store = None
+
+artifact_file_systems = (
+    {ARTIFACT_DIR: NetworkFileSystem.persisted("python-agent-artifacts")}
+    if artifact_environment()
+    else {}
+)
+
 
-@stub.function(image=image_bot)
+@stub.function(image=image_bot, network_file_systems=artifact_file_systems)
 @asgi_app()
 def fastapi_app():
+    global artifact_store
     app = make_app(bot, api_key=os.environ["POE_ACCESS_KEY"])
+    artifact_store = artifact_store_from_environment()
+    if artifact_store is not None:
+        mount_artifacts(app, artifact_store)
     return app
@@ -14,8 +14,8 @@ from io import BytesIO
 from typing import AsyncIterable
 
 import fastapi_poe.client
+import httpx
 import pdftotext
-import requests
 from docx import Document
 from fastapi_poe import PoeBot, make_app
 from fastapi_poe.client import MetaMessage, stream_request
@@ -23,36 +23,38 @@ from fastapi_poe.types import QueryRequest, SettingsRequest, SettingsResponse
 from modal import Image, Stub, asgi_app
 from sse_starlette.sse import ServerSentEvent
 
+from http_client import get_async_client, log_stats
+
 fastapi_poe.client.MAX_EVENT_COUNT = 10000
 
 
 async def parse_pdf_document_from_url(pdf_url: str) -> tuple[bool, str]:
     try:
-        response = requests.get(pdf_url)
+        response = await get_async_client().get(pdf_url)
         with BytesIO(response.content) as f:
             pdf = pdftotext.PDF(f)
         text = "\n\n".join(pdf)
         text = text[:2000]
         return True, text
-    except requests.exceptions.MissingSchema:
+    except httpx.UnsupportedProtocol:
         return False, ""
-    except BaseException:
+    except Exception:
         return False, ""
 
 
 async def parse_pdf_document_from_docx(docx_url: str) -> tuple[bool, str]:
     try:
-        response = requests.get(docx_url)
+        response = await get_async_client().get(docx_url)
         with BytesIO(response.content) as f:
             document = Document(f)
         text = [p.text for p in document.paragraphs]
         text = "\n\n".join(text)
         text = text[:2000]
         return True, text
-    except requests.exceptions.MissingSchema as e:
+    except httpx.UnsupportedProtocol as e:
         print(e)
         return False, ""
-    except BaseException as e:
+    except Exception as e:
         print(e)
         return False, ""
 
@@ -129,6 +131,7 @@ class EchoBot(PoeBot):
                     f"\n\n This is the attached resume: {resume_string}"
                 )
 
+        log_stats()
         current_message = ""
         async for msg in stream_request(query, "ResumeReviewTool", query.api_key):
             # Note: See https://poe.com/ResumeReviewTool for the prompt
@@ -159,7 +162,8 @@ image = (
     .pip_install(
         "fastapi-poe==0.0.23",
         "huggingface-hub==0.16.4",
-        "requests==2.31.0",
+        "httpx[http2]==0.28.1",
+        "httpcore==1.0.9",
         "pdftotext==2.2.2",
         "Pillow==9.5.0",
         "openai==0.27.8",
@@ -7,6 +7,7 @@ assert False
 
 """
 
+import asyncio
 from typing import AsyncIterable
 
 import fastapi_poe.client
@@ -16,26 +17,24 @@ from fastapi_poe.types import QueryRequest, SettingsRequest, SettingsResponse
 from modal import Image, Stub, asgi_app
 from sse_starlette.sse import ServerSentEvent
 
+from executor_client import (
+    EXECUTION_TIMEOUT,
+    MAX_CONCURRENT_EXECUTIONS,
+    executor_from_environment,
+)
+from output_stream import FencedOutput, coalesce_output
+from result_cache import (
+    result_cache_environment,
+    result_cache_from_environment,
+    within_limits,
+)
+
 fastapi_poe.client.MAX_EVENT_COUNT = 10000
 
 # https://modalbetatesters.slack.com/archives/C031Z7H15DG/p1675177408741889?thread_ts=1675174647.477169&cid=C031Z7H15DG
 modal.app._is_container_app = False
 
 
-def format_output(captured_output, captured_error="") -> str:
-    lines = []
-
-    if captured_output:
-        line = f"\n```output\n{captured_output}\n```"
-        lines.append(line)
-
-    if captured_error:
-        line = f"\n```error\n{captured_error}\n```"
-        lines.append(line)
-
-    return "\n".join(lines)
-
-
 def strip_code(code):
     if len(code.strip()) < 6:
         return code
@@ -46,27 +45,59 @@ def strip_code(code):
 
 
 class EchoBot(PoeBot):
+    # at most one event per interval, and nothing past the cap
+    output_coalesce_interval = 0.5
+    output_max_bytes = 5000
+    code_execution_timeout = EXECUTION_TIMEOUT
+
     async def get_response(self, query: QueryRequest) -> AsyncIterable[ServerSentEvent]:
         print("user_statement")
         print(query.query[-1].content)
         code = query.query[-1].content
         code = strip_code(code)
+        fenced_output = FencedOutput()
+        dropped, streamed = 0, False
         try:
-            f = modal.Function.lookup("run-python-code-shared", "execute_code")
-            captured_output = f.remote(code)  # need async await?
-        except modal.exception.TimeoutError:
+            # output and errors are shown while the code runs
+            if result_cache is not None:
+                # identical deterministic code is replayed from the cache
+                items = result_cache.stream(
+                    executor,
+                    "execute_code_stream",
+                    code,
+                    timeout=self.code_execution_timeout,
+                    cacheable=within_limits,
+                )
+            else:
+                items = executor.stream(
+                    "execute_code_stream", code, timeout=self.code_execution_timeout
+                )
+            async for kind, payload in coalesce_output(
+                items,
+                interval=self.output_coalesce_interval,
+                max_bytes=self.output_max_bytes,
+            ):
+                if kind in ("stdout", "stderr"):
+                    streamed = True
+                    yield self.text_event(fenced_output.write(kind, payload))
+                elif kind == "truncated":
+                    dropped += payload
+                elif kind == "result":
+                    dropped += payload["dropped"]
+                    print("metering", payload["metering"])
+        except (asyncio.TimeoutError, modal.exception.TimeoutError):
+            yield self.text_event(fenced_output.close())
             yield self.text_event("Time limit exceeded.")
             return
-        if len(captured_output) > 5000:
+        yield self.text_event(fenced_output.close())
+        if result_cache is not None:
+            print("result_cache", result_cache.stats, result_cache.stats.hit_ratio)
+        if dropped:
             yield self.text_event(
                 "There is too much output, this is the partial output."
             )
-            captured_output = captured_output[:5000]
-        reply_string = format_output(captured_output)
-        if not reply_string:
+        if not streamed:
             yield self.text_event("No output or error recorded.")
-            return
-        yield self.text_event(reply_string)
 
     async def get_settings(self, setting: SettingsRequest) -> SettingsResponse:
         return SettingsResponse(
@@ -76,14 +107,25 @@ class EchoBot(PoeBot):
         )
 
 
+executor = executor_from_environment(
+    "run-python-code-shared", MAX_CONCURRENT_EXECUTIONS
+)
+
+# set EXECUTION_CACHE_TTL to cache the results of deterministic code
+result_cache = result_cache_from_environment()
+
 bot = EchoBot()
 
-image = Image.debian_slim().pip_install("fastapi-poe==0.0.23")
+image = (
+    Image.debian_slim()
+    .pip_install("fastapi-poe==0.0.23")
+    .env(result_cache_environment())
+)
 
 stub = Stub("poe-bot-quickstart")
 
 
-@stub.function(image=image)
+@stub.function(image=image, allow_concurrent_inputs=MAX_CONCURRENT_EXECUTIONS)
 @asgi_app()
 def fastapi_app():
     app = make_app(bot, allow_without_key=True)
@@ -13,9 +13,9 @@ from collections import defaultdict
 from io import BytesIO
 from typing import AsyncIterable
 
+import httpx
 import pdftotext
 import pytesseract
-import requests
 from docx import Document
 from fastapi_poe import PoeBot, make_app
 from fastapi_poe.types import QueryRequest, SettingsResponse
@@ -23,6 +23,8 @@ from modal import Image, Stub, asgi_app
 from PIL import Image as PILImage
 from sse_starlette.sse import ServerSentEvent
 
+from http_client import get_async_client, log_stats
+
 print("version", pytesseract.get_tesseract_version())
 
 SETTINGS = {
@@ -40,45 +42,45 @@ url_cache = {}
 
 async def parse_image_document_from_url(image_url: str) -> tuple[bool, str]:
     try:
-        response = requests.get(image_url.strip())
+        response = await get_async_client().get(image_url.strip())
         img = PILImage.open(BytesIO(response.content))
 
         custom_config = "--psm 4"
         text = pytesseract.image_to_string(img, config=custom_config)
         text = text[:10000]
         return True, text
-    except BaseException as e:
+    except Exception as e:
         print(e)
         return False, ""
 
 
 async def parse_pdf_document_from_url(pdf_url: str) -> tuple[bool, str]:
     try:
-        response = requests.get(pdf_url)
+        response = await get_async_client().get(pdf_url)
         with BytesIO(response.content) as f:
             pdf = pdftotext.PDF(f)
         text = "\n\n".join(pdf)
         text = text[:10000]
         return True, text
-    except requests.exceptions.MissingSchema:
+    except httpx.UnsupportedProtocol:
         return False, ""
-    except BaseException:
+    except Exception:
         return False, ""
 
 
 async def parse_pdf_document_from_docx(docx_url: str) -> tuple[bool, str]:
     try:
-        response = requests.get(docx_url)
+        response = await get_async_client().get(docx_url)
         with BytesIO(response.content) as f:
             document = Document(f)
         text = [p.text for p in document.paragraphs]
         text = "\n\n".join(text)
         text = text[:10000]
         return True, text
-    except requests.exceptions.MissingSchema as e:
+    except httpx.UnsupportedProtocol as e:
         print(e)
         return False, ""
-    except BaseException as e:
+    except Exception as e:
         print(e)
         return False, ""
 
@@ -253,6 +255,7 @@ class EchoBot(PoeBot):
                 yield self.text_event(PARSE_FAILURE_REPLY)
                 return
 
+        log_stats()
         yield self.replace_response_event(resume_string)
         return
 
@@ -309,7 +312,8 @@ image = (
     .pip_install(
         "fastapi-poe==0.0.23",
         "huggingface-hub==0.16.4",
-        "requests==2.31.0",
+        "httpx[http2]==0.28.1",
+        "httpcore==1.0.9",
         "pdftotext==2.2.2",
         "Pillow==9.5.0",
         "openai==0.27.8",
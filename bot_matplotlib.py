@@ -7,6 +7,7 @@ Draw USA map
 
 """
 
+import asyncio
 import os
 import re
 from typing import AsyncIterable
@@ -16,9 +17,28 @@ import modal
 from fastapi_poe import PoeBot, make_app
 from fastapi_poe.client import MetaMessage, stream_request
 from fastapi_poe.types import QueryRequest, SettingsRequest, SettingsResponse
-from modal import Image, Stub, asgi_app
+from modal import Image, NetworkFileSystem, Stub, asgi_app
 from sse_starlette.sse import ServerSentEvent
 
+from artifact_server import (
+    ARTIFACT_DIR,
+    artifact_environment,
+    artifact_store_from_environment,
+    mount_artifacts,
+    publish_artifacts,
+)
+from code_fence import CodeFenceParser
+from executor_client import (
+    EXECUTION_TIMEOUT,
+    MAX_CONCURRENT_EXECUTIONS,
+    executor_from_environment,
+)
+from result_cache import (
+    result_cache_environment,
+    result_cache_from_environment,
+    within_limits,
+)
+
 fastapi_poe.client.MAX_EVENT_COUNT = 10000
 
 # https://modalbetatesters.slack.com/archives/C031Z7H15DG/p1675177408741889?thread_ts=1675174647.477169&cid=C031Z7H15DG
@@ -54,13 +74,12 @@ def strip_code(code):
     return code
 
 
-def extract_code(reply):
-    pattern = r"```python([\s\S]*?)```"
-    matches = re.findall(pattern, reply)
-    return "\n\n".join(matches)
-
-
 class EchoBot(PoeBot):
+    code_execution_timeout = EXECUTION_TIMEOUT
+    # png, webp or svg, every figure of the code is rendered
+    image_format = "png"
+    image_dpi = 100
+
     async def get_response(self, query: QueryRequest) -> AsyncIterable[ServerSentEvent]:
         print("user_statement")
         print(query.query[-1].content)
@@ -69,6 +88,7 @@ class EchoBot(PoeBot):
             statement.content = redact_image_links(statement.content)
 
         current_message = ""
+        code_fence_parser = CodeFenceParser()
         async for msg in stream_request(query, "matplotlibTool", query.api_key):
             # Note: See https://poe.com/CheckPythonTool for the prompt
             if isinstance(msg, MetaMessage):
@@ -79,9 +99,10 @@ class EchoBot(PoeBot):
                 yield self.replace_response_event(msg.text)
             else:
                 current_message += msg.text
+                code_fence_parser.feed(msg.text)
                 yield self.replace_response_event(current_message)
 
-        code = extract_code(current_message)
+        code = code_fence_parser.code
 
         if not code:
             return
@@ -92,17 +113,37 @@ class EchoBot(PoeBot):
         if not code:
             return
 
-        image_url = None
+        image_urls = []
         try:
-            f = modal.Function.lookup(
-                "run-python-code-shared", "execute_code_matplotlib"
-            )
-            captured_output, image_data = f.remote(code)  # need async await?
-            if image_data:
-                f = modal.Function.lookup("image-upload-shared", "upload_file")
-                image_url = f.remote(image_data, "image.png")
-
-        except modal.exception.TimeoutError:
+            if result_cache is not None:
+                # identical deterministic code is answered from the cache
+                captured_output, images, _ = await result_cache.call(
+                    executor,
+                    "execute_code_matplotlib",
+                    code,
+                    self.image_format,
+                    self.image_dpi,
+                    timeout=self.code_execution_timeout,
+                    cacheable=within_limits,
+                )
+                print("result_cache", result_cache.stats, result_cache.stats.hit_ratio)
+            else:
+                captured_output, images, _ = await executor.call(
+                    "execute_code_matplotlib",
+                    code,
+                    self.image_format,
+                    self.image_dpi,
+                    timeout=self.code_execution_timeout,
+                )
+            if images:
+                print("image_sizes", [image["size"] for image in images])
+                files = [
+                    (image["data"], f"image.{image['image_format']}")
+                    for image in images
+                ]
+                image_urls = await publish_artifacts(artifact_store, files)
+
+        except (asyncio.TimeoutError, modal.exception.TimeoutError):
             yield self.text_event("Time limit exceeded.")
             return
         if len(captured_output) > 5000:
@@ -114,12 +155,12 @@ class EchoBot(PoeBot):
 
         if reply_string:
             yield self.text_event(reply_string)
-        if image_url:
+        for image_url in image_urls:
             print("image_url")
             print(image_url)
             yield self.text_event(f"\n\n![image]({image_url})")
 
-        if not reply_string and not image_url:
+        if not reply_string and not image_urls:
             yield self.text_event("\n\nNo output or error recorded.")
             return
 
@@ -129,19 +170,49 @@ class EchoBot(PoeBot):
         )
 
 
+executor = executor_from_environment(
+    "run-python-code-shared", MAX_CONCURRENT_EXECUTIONS
+)
+
 bot = EchoBot()
 
+# set EXECUTION_CACHE_TTL to cache the results of deterministic code
+result_cache = result_cache_from_environment()
+
+# set when the app serves the images itself, see artifact_server.py
+artifact_store = None
+
 image = (
     Image.debian_slim()
     .pip_install("fastapi-poe==0.0.23")
-    .env({"POE_ACCESS_KEY": os.environ["POE_ACCESS_KEY"]})
+    .env(
+        {
+            "POE_ACCESS_KEY": os.environ["POE_ACCESS_KEY"],
+            **artifact_environment(),
+            **result_cache_environment(),
+        }
+    )
 )
 
 stub = Stub("poe-bot-quickstart")
 
+artifact_file_systems = (
+    {ARTIFACT_DIR: NetworkFileSystem.persisted("matplotlib-artifacts")}
+    if artifact_environment()
+    else {}
+)
+
 
-@stub.function(image=image)
+@stub.function(
+    image=image,
+    allow_concurrent_inputs=MAX_CONCURRENT_EXECUTIONS,
+    network_file_systems=artifact_file_systems,
+)
 @asgi_app()
 def fastapi_app():
+    global artifact_store
     app = make_app(bot, api_key=os.environ["POE_ACCESS_KEY"])
+    artifact_store = artifact_store_from_environment()
+    if artifact_store is not None:
+        mount_artifacts(app, artifact_store)
     return app
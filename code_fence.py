@@ -0,0 +1,56 @@
+"""
+
+Incremental detector for ```python code blocks in a streamed reply.
+
+Running re.findall over the whole accumulated reply after every chunk is quadratic
+in the reply length. CodeFenceParser is fed the deltas instead, keeps only the
+fence state and the text that could still be part of a marker, and reports each
+code block as soon as its closing fence arrives. The blocks are the same as those
+found by re.findall(r"```python([\\s\\S]*?)```", reply).
+
+"""
+from __future__ import annotations
+
+OPENING_FENCE = "```python"
+CLOSING_FENCE = "```"
+
+
+class CodeFenceParser:
+    def __init__(self) -> None:
+        self.blocks: list[str] = []
+        self.in_block = False
+        # text that has not been matched against the fence we are looking for
+        self._pending = ""
+        # parts of the block that is currently open
+        self._block: list[str] = []
+
+    def feed(self, delta: str) -> list[str]:
+        """Consume a chunk of the reply and return the blocks it completed."""
+        completed = []
+        pending = self._pending + delta
+        while True:
+            fence = CLOSING_FENCE if self.in_block else OPENING_FENCE
+            index = pending.find(fence)
+            if index == -1:
+                break
+            if self.in_block:
+                self._block.append(pending[:index])
+                block = "".join(self._block)
+                self._block = []
+                self.blocks.append(block)
+                completed.append(block)
+            end = index + len(fence)
+            pending = pending[end:]
+            self.in_block = not self.in_block
+
+        # keep what could be the start of a fence split across chunks
+        split = max(0, len(pending) - len(fence) + 1)
+        if self.in_block:
+            self._block.append(pending[:split])
+        self._pending = pending[split:]
+        return completed
+
+    @property
+    def code(self) -> str:
+        """All completed blocks, joined like extract_code does."""
+        return "\n\n".join(self.blocks)
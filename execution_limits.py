@@ -0,0 +1,360 @@
+"""
+
+Hard limits and metering for each code execution.
+
+run_forked runs a function in a forked child under CPU time, address space and
+open file limits, and streams its output back to the parent over a pipe. The
+parent enforces the wall time limit, reaps the child with wait4 and reports the
+execution's wall time, CPU time, peak RSS and bytes written, together with the
+limit it exceeded, if any:
+
+- cpu: SIGXCPU at the soft limit raises CpuTimeExceeded in the code, the hard
+  limit a few seconds later kills the child
+- memory: allocations beyond the address space limit raise MemoryError
+- open_files: opening more files raises OSError (EMFILE)
+- output: the code printed more than the output limit
+- wall: the parent killed the child at the wall time limit
+
+limits_in_process applies the same limits to a block of the current process,
+e.g. the shared setup of a batch, whose state the snippets then fork from.
+
+The function runs with the state of the parent at the time of the fork, copy on
+write, so warm shells and preloaded modules are free, and nothing the code does
+reaches the parent. The uncaught exception of the code is expected in
+sys.last_value, where IPython and the interactive interpreter leave it. Its
+traceback is printed without the frames of the limit handlers
+(drop_harness_frames), so that it ends in the code.
+
+"""
+from __future__ import annotations
+
+import contextlib
+import errno
+import os
+import pickle
+import resource
+import select
+import signal
+import struct
+import sys
+import time
+from dataclasses import dataclass
+from types import TracebackType
+from typing import Any, Callable, Iterator
+
+import output_capture
+from output_capture import CapturedOutput, OutputCapture
+
+FRAME_HEADER = struct.Struct(">I")
+
+# the modules whose frames end the traceback of a limit raised in the code
+HARNESS_FILES = frozenset(
+    os.path.realpath(path) for path in (__file__, output_capture.__file__)
+)
+
+
+class CpuTimeExceeded(Exception):
+    pass
+
+
+class WallTimeExceeded(Exception):
+    pass
+
+
+@dataclass
+class ExecutionLimits:
+    cpu_seconds: int | None = 20
+    # address space on top of what the process has mapped when it forks
+    memory_bytes: int | None = 4 * 1024**3
+    open_files: int | None = 256
+    wall_seconds: float | None = 25
+
+
+@dataclass
+class Metering:
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_rss: int = 0
+    bytes_written: int = 0
+    # cpu, memory, open_files, output or wall
+    limit_exceeded: str | None = None
+    # the signal that killed the child before it reported, e.g. SIGSEGV
+    killed_by: str | None = None
+
+
+def limit_message(kind: str, limits: ExecutionLimits) -> str:
+    if kind == "cpu":
+        return f"CPU time limit exceeded ({limits.cpu_seconds}s of CPU time)."
+    if kind == "memory":
+        return f"Memory limit exceeded ({limits.memory_bytes // 1024**2} MiB)."
+    if kind == "open_files":
+        return f"Open file limit exceeded ({limits.open_files} open files)."
+    if kind == "output":
+        return "Output limit exceeded, the code printed too much."
+    return f"Time limit exceeded ({limits.wall_seconds}s)."
+
+
+def _on_sigxcpu(signum: int, frame: Any) -> None:
+    raise CpuTimeExceeded("The code used too much CPU time.")
+
+
+def _on_sigalrm(signum: int, frame: Any) -> None:
+    raise WallTimeExceeded("The code ran for too long.")
+
+
+def drop_harness_frames(tb: TracebackType | None) -> TracebackType | None:
+    """Cut the frames of the limit handlers off the end of `tb`, in place.
+
+    The signal handlers and the output capture raise their exceptions from
+    inside the code, so their frames come last.
+
+    """
+    last = None
+    entry = tb
+    while entry is not None:
+        path = os.path.realpath(entry.tb_frame.f_code.co_filename)
+        if path not in HARNESS_FILES:
+            last = entry
+        entry = entry.tb_next
+    if last is None:
+        return tb
+    last.tb_next = None
+    return tb
+
+
+def _mapped_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+
+def _open_files() -> int:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return 0
+
+
+def _bytes_written() -> int:
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_oublock * 512
+
+
+def apply_limits(limits: ExecutionLimits) -> None:
+    """Limit the current process, called in the child."""
+    if limits.cpu_seconds is not None:
+        used = sum(os.times()[:2])
+        soft = int(used) + limits.cpu_seconds
+        signal.signal(signal.SIGXCPU, _on_sigxcpu)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, soft + 2))
+    if limits.memory_bytes is not None:
+        size = _mapped_bytes() + limits.memory_bytes
+        resource.setrlimit(resource.RLIMIT_AS, (size, size))
+    if limits.open_files is not None:
+        count = _open_files() + limits.open_files
+        hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        if hard != resource.RLIM_INFINITY:
+            count = min(count, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (count, hard))
+
+
+@contextlib.contextmanager
+def limits_in_process(limits: ExecutionLimits) -> Iterator[None]:
+    """Limit the current process while the block runs, from the main thread.
+
+    Only the soft limits are lowered, and they are restored on exit, so that
+    the children forked afterwards can be limited by apply_limits. The wall
+    time raises WallTimeExceeded in the code.
+
+    """
+    kinds = [resource.RLIMIT_CPU, resource.RLIMIT_AS, resource.RLIMIT_NOFILE]
+    saved = {kind: resource.getrlimit(kind) for kind in kinds}
+    handlers = signal.getsignal(signal.SIGXCPU), signal.getsignal(signal.SIGALRM)
+
+    def lower(kind: int, soft: int) -> None:
+        hard = saved[kind][1]
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(kind, (soft, hard))
+
+    try:
+        if limits.cpu_seconds is not None:
+            signal.signal(signal.SIGXCPU, _on_sigxcpu)
+            lower(resource.RLIMIT_CPU, int(sum(os.times()[:2])) + limits.cpu_seconds)
+        if limits.memory_bytes is not None:
+            lower(resource.RLIMIT_AS, _mapped_bytes() + limits.memory_bytes)
+        if limits.open_files is not None:
+            lower(resource.RLIMIT_NOFILE, _open_files() + limits.open_files)
+        if limits.wall_seconds is not None:
+            signal.signal(signal.SIGALRM, _on_sigalrm)
+            signal.setitimer(signal.ITIMER_REAL, limits.wall_seconds)
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        for kind, limit in saved.items():
+            resource.setrlimit(kind, limit)
+        signal.signal(signal.SIGXCPU, handlers[0])
+        signal.signal(signal.SIGALRM, handlers[1])
+
+
+def exceeded_limit(error: BaseException | None) -> str | None:
+    """The limit an exception of the code stands for, if any."""
+    if isinstance(error, CpuTimeExceeded):
+        return "cpu"
+    if isinstance(error, WallTimeExceeded):
+        return "wall"
+    if isinstance(error, MemoryError):
+        return "memory"
+    if isinstance(error, OSError) and error.errno == errno.EMFILE:
+        return "open_files"
+    return None
+
+
+def _send(fd: int, message: Any) -> None:
+    data = pickle.dumps(message)
+    view = memoryview(FRAME_HEADER.pack(len(data)) + data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _read_exact(fd: int, size: int, deadline: float | None) -> bytes | None:
+    # None at end of file, raises TimeoutError past the deadline
+    chunks, remaining = [], size
+    while remaining:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if not select.select([fd], [], [], timeout)[0]:
+            raise TimeoutError
+        chunk = os.read(fd, remaining)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def _child(
+    function: Callable[[], Any], limits: ExecutionLimits, fd: int, **capture_kwargs
+) -> None:
+    written = _bytes_written()
+    sys.last_value = None
+    with OutputCapture(
+        on_chunk=lambda stream, text: _send(fd, ("chunk", stream, text)),
+        **capture_kwargs,
+    ) as capture:
+        apply_limits(limits)
+        try:
+            value = function()
+        except BaseException as e:
+            sys.last_value, value = e, None
+    limit = exceeded_limit(sys.last_value)
+    if limit is None and capture.limit_exceeded:
+        limit = "output"
+    _send(fd, ("result", value, capture.result(), _bytes_written() - written, limit))
+
+
+def iter_forked(
+    function: Callable[[], Any], limits: ExecutionLimits, **capture_kwargs: Any
+) -> Iterator[tuple[str, Any]]:
+    """Run `function` in a forked child and yield its output as it is printed.
+
+    Yields ("stdout", text) and ("stderr", text) chunks, then
+    ("result", (value, CapturedOutput, Metering)), where value is what
+    `function` returned, or None if the child did not finish.
+
+    """
+    start = time.monotonic()
+    deadline = None if limits.wall_seconds is None else start + limits.wall_seconds
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child only runs the code and writes to the pipe
+        try:
+            os.close(read_fd)
+            _child(function, limits, write_fd, **capture_kwargs)
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    value, captured, written, limit = None, None, 0, None
+    output, error = [], []
+    try:
+        while True:
+            header = _read_exact(read_fd, FRAME_HEADER.size, deadline)
+            if header is None:
+                break
+            message = pickle.loads(
+                _read_exact(read_fd, FRAME_HEADER.unpack(header)[0], deadline)
+            )
+            if message[0] == "chunk":
+                _, stream, text = message
+                (output if stream == "stdout" else error).append(text)
+                yield stream, text
+            else:
+                _, value, captured, written, limit = message
+    except TimeoutError:
+        limit = "wall"
+    finally:
+        if captured is None:
+            # killed at the wall time limit, or the caller stopped reading
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGKILL)
+        os.close(read_fd)
+        _, status, usage = os.wait4(pid, 0)
+
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    message, killed_by = "", None
+    if captured is None:
+        # the child died, or was killed, before it could report
+        if os.WIFSIGNALED(status):
+            signum = os.WTERMSIG(status)
+            killed_by = signal.Signals(signum).name
+            over_cpu = (
+                limits.cpu_seconds is not None and cpu_seconds >= limits.cpu_seconds
+            )
+            if limit is None and (
+                signum == signal.SIGXCPU or (signum == signal.SIGKILL and over_cpu)
+            ):
+                # past the hard CPU limit
+                limit = "cpu"
+            elif limit is None:
+                message = f"The Python process was killed by {killed_by}."
+        elif limit is None:
+            message = "The Python process exited unexpectedly."
+        captured = CapturedOutput("".join(output), "".join(error))
+    if limit is not None:
+        message = limit_message(limit, limits)
+    if message:
+        captured.error += f"\n{message}\n"
+        yield "stderr", f"\n{message}\n"
+
+    yield "result", (
+        value,
+        captured,
+        Metering(
+            wall_seconds=time.monotonic() - start,
+            cpu_seconds=cpu_seconds,
+            peak_rss=usage.ru_maxrss * 1024,
+            bytes_written=written,
+            limit_exceeded=limit,
+            killed_by=killed_by,
+        ),
+    )
+
+
+def run_forked(
+    function: Callable[[], Any], limits: ExecutionLimits, **capture_kwargs: Any
+) -> tuple[Any, CapturedOutput, Metering]:
+    """Run `function` in a forked child, see iter_forked."""
+    for kind, payload in iter_forked(function, limits, **capture_kwargs):
+        if kind == "result":
+            return payload
+    raise RuntimeError("the child did not report a result")
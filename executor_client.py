@@ -0,0 +1,301 @@
+"""
+
+Async client for the code execution functions.
+
+The code-running bots called `f.remote(code)` inside `async def get_response`,
+which blocks the event loop, and with it every other request on the container,
+for the whole execution. ExecutorClient awaits the executions instead, runs at
+most `max_concurrency` of them at once per container, and supports timeouts and
+cancellation (a cancelled or timed out call is cancelled on the backend too).
+
+Backends:
+- RemoteFunctionBackend calls the functions deployed from function_exec.py.
+- LocalProcessBackend runs them in a pool of local worker processes.
+- InProcessBackend runs them in threads of the current process.
+
+The local backends take the functions by name, e.g. function_exec.LOCAL_FUNCTIONS,
+and are selected with EXECUTOR_BACKEND=process or EXECUTOR_BACKEND=inprocess.
+
+    executor = ExecutorClient(RemoteFunctionBackend("run-python-code-shared"))
+    output = await executor.call("execute_code", code, timeout=30)
+
+"""
+from __future__ import annotations
+
+import asyncio
+import inspect
+import multiprocessing
+import multiprocessing.connection
+import os
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable
+
+from output_stream import iterate_in_thread
+
+# bump when the functions of function_exec.py change what they return for the
+# same code, it is part of the keys of result_cache.py
+EXECUTOR_VERSION = "2"
+
+# executions are awaited, so one container of a bot serves many users at once
+MAX_CONCURRENT_EXECUTIONS = 8
+
+# how long the bots wait for an execution, above the time limit of the
+# functions of function_exec.py, which report their own timeout
+EXECUTION_TIMEOUT = 40
+
+
+class ExecutorBackend:
+    async def call(self, name: str, args: tuple) -> Any:
+        raise NotImplementedError
+
+    async def stream(self, name: str, args: tuple) -> AsyncIterator[Any]:
+        """Yield the items of a generator function, by default once it is done."""
+        for item in await self.call(name, args):
+            yield item
+
+
+class RemoteFunctionBackend(ExecutorBackend):
+    def __init__(self, app_name: str) -> None:
+        self.app_name = app_name
+        self._functions: dict[str, Any] = {}
+
+    async def _lookup(self, name: str) -> Any:
+        import modal
+
+        if name not in self._functions:
+            loop = asyncio.get_running_loop()
+            self._functions[name] = await loop.run_in_executor(
+                None, modal.Function.lookup, self.app_name, name
+            )
+        return self._functions[name]
+
+    async def call(self, name: str, args: tuple) -> Any:
+        loop = asyncio.get_running_loop()
+        f = await self._lookup(name)
+        function_call = await loop.run_in_executor(None, f.spawn, *args)
+        try:
+            return await loop.run_in_executor(None, function_call.get)
+        except asyncio.CancelledError:
+            # do not wait for the cancellation, the caller has moved on
+            loop.run_in_executor(None, function_call.cancel)
+            raise
+
+    async def stream(self, name: str, args: tuple) -> AsyncIterator[Any]:
+        f = await self._lookup(name)
+        async for item in iterate_in_thread(f.remote_gen(*args)):
+            yield item
+
+
+def _serve(
+    functions: dict[str, Callable], connection: multiprocessing.connection.Connection
+) -> None:
+    # the loop of a worker process
+    while True:
+        try:
+            name, args = connection.recv()
+        except EOFError:
+            return
+        try:
+            result = functions[name](*args)
+            if inspect.isgenerator(result):
+                result = list(result)
+            connection.send((True, result))
+        except Exception as e:
+            connection.send((False, e))
+
+
+class _Worker:
+    def __init__(self, context: Any, functions: dict[str, Callable]) -> None:
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(functions, child_connection), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+
+    async def call(self, name: str, args: tuple) -> tuple[bool, Any]:
+        loop = asyncio.get_running_loop()
+        self.connection.send((name, args))
+        readable = loop.create_future()
+
+        def on_readable():
+            if not readable.done():
+                readable.set_result(None)
+
+        fd = self.connection.fileno()
+        loop.add_reader(fd, on_readable)
+        try:
+            await readable
+        finally:
+            loop.remove_reader(fd)
+        # (False, exception) when the function raised
+        return self.connection.recv()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class LocalProcessBackend(ExecutorBackend):
+    """Up to `max_workers` worker processes, each running one call at a time.
+
+    A call that times out or is cancelled kills its worker, since the code
+    cannot be interrupted otherwise; the next call starts a new one.
+
+    """
+
+    def __init__(self, functions: dict[str, Callable], max_workers: int = 4) -> None:
+        self.functions = functions
+        self.max_workers = max_workers
+        self.context = multiprocessing.get_context("forkserver")
+        self._idle: list[_Worker] = []
+        self._slots: asyncio.Semaphore | None = None
+
+    async def call(self, name: str, args: tuple) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers)
+        async with self._slots:
+            worker = self._idle.pop() if self._idle else None
+            if worker is None:
+                worker = _Worker(self.context, self.functions)
+            try:
+                ok, result = await worker.call(name, args)
+            except BaseException:
+                worker.kill()
+                raise
+            self._idle.append(worker)
+            if not ok:
+                raise result
+            return result
+
+    def close(self) -> None:
+        while self._idle:
+            self._idle.pop().kill()
+
+
+class InProcessBackend(ExecutorBackend):
+    """Runs the functions in threads. Timed out calls keep running in the thread."""
+
+    def __init__(self, functions: dict[str, Callable]) -> None:
+        self.functions = functions
+
+    async def call(self, name: str, args: tuple) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.functions[name], *args)
+
+    async def stream(self, name: str, args: tuple) -> AsyncIterator[Any]:
+        async for item in iterate_in_thread(self.functions[name](*args)):
+            yield item
+
+
+@dataclass
+class ExecutorStats:
+    calls: int = 0
+    active: int = 0
+    peak_active: int = 0
+    # calls waiting for a free slot
+    waiting: int = 0
+    timeouts: int = 0
+    cancelled: int = 0
+    errors: int = 0
+
+
+class ExecutorClient:
+    """At most `max_concurrency` executions at once, each within `timeout` seconds."""
+
+    def __init__(
+        self,
+        backend: ExecutorBackend,
+        max_concurrency: int = 8,
+        timeout: float | None = None,
+    ) -> None:
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.stats = ExecutorStats()
+        self._semaphore: asyncio.Semaphore | None = None
+
+    def _slot(self) -> asyncio.Semaphore:
+        # created on first use, inside the event loop of the app
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _enter(self) -> None:
+        self.stats.calls += 1
+        self.stats.waiting += 1
+        try:
+            await self._slot().acquire()
+        finally:
+            self.stats.waiting -= 1
+        self.stats.active += 1
+        self.stats.peak_active = max(self.stats.peak_active, self.stats.active)
+
+    def _exit(self, error: BaseException | None) -> None:
+        self.stats.active -= 1
+        self._slot().release()
+        if isinstance(error, asyncio.TimeoutError):
+            self.stats.timeouts += 1
+        elif isinstance(error, asyncio.CancelledError):
+            self.stats.cancelled += 1
+        elif error is not None and not isinstance(error, GeneratorExit):
+            self.stats.errors += 1
+
+    async def call(self, name: str, *args: Any, timeout: float | None = None) -> Any:
+        """Call the function `name`, raises asyncio.TimeoutError past `timeout`."""
+        await self._enter()
+        error = None
+        try:
+            return await asyncio.wait_for(
+                self.backend.call(name, args), timeout or self.timeout
+            )
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._exit(error)
+
+    async def stream(
+        self, name: str, *args: Any, timeout: float | None = None
+    ) -> AsyncIterator[Any]:
+        """Yield the items of the generator function `name` as they come."""
+        loop = asyncio.get_running_loop()
+        timeout = timeout or self.timeout
+        deadline = None if timeout is None else loop.time() + timeout
+        await self._enter()
+        error = None
+        items = self.backend.stream(name, args)
+        try:
+            while True:
+                remaining = None if deadline is None else deadline - loop.time()
+                try:
+                    item = await asyncio.wait_for(items.__anext__(), remaining)
+                except StopAsyncIteration:
+                    return
+                yield item
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            await items.aclose()
+            self._exit(error)
+
+
+def executor_from_environment(
+    app_name: str = "run-python-code-shared", max_concurrency: int = 8
+) -> ExecutorClient:
+    """The remote functions, or local ones if EXECUTOR_BACKEND is process/inprocess."""
+    kind = os.environ.get("EXECUTOR_BACKEND", "remote")
+    if kind == "remote":
+        return ExecutorClient(RemoteFunctionBackend(app_name), max_concurrency)
+
+    import function_exec
+
+    if kind == "process":
+        backend = LocalProcessBackend(function_exec.LOCAL_FUNCTIONS, max_concurrency)
+    elif kind == "inprocess":
+        backend = InProcessBackend(function_exec.LOCAL_FUNCTIONS)
+    else:
+        raise ValueError(f"unknown EXECUTOR_BACKEND {kind!r}")
+    return ExecutorClient(backend, max_concurrency)
@@ -0,0 +1,165 @@
+"""
+
+In-memory rendering of the matplotlib figures of an execution.
+
+Patching plt.show to savefig("image.png") kept one figure per execution,
+encoded it at the default DPI, and made the executions of a container race on
+the same file. FigureCapture instead renders every figure into a buffer when
+the code calls plt.show, and the figures still open when the code is done, in
+the requested format and DPI. Nothing touches the disk. The files the rendered
+figures were saved to by the code are listed in saved_files, so that the
+caller can leave out those copies of the same figures.
+
+    use_agg()
+    with FigureCapture(image_format="webp", dpi=80) as capture:
+        exec(code)
+    capture.images  # [RenderedImage(data=b"...", image_format="webp", ...)]
+
+"""
+from __future__ import annotations
+
+import io
+import os
+import sys
+import traceback
+from dataclasses import dataclass
+from typing import Any
+
+CONTENT_TYPES = {"png": "image/png", "webp": "image/webp", "svg": "image/svg+xml"}
+
+# figures beyond this are closed without being rendered
+MAX_FIGURES = 10
+
+
+@dataclass
+class RenderedImage:
+    data: bytes
+    image_format: str
+    size: int
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES[self.image_format]
+
+
+def use_agg() -> None:
+    """Render without a display, call before pyplot is imported."""
+    import matplotlib
+
+    matplotlib.use("Agg", force=True)
+
+
+def check_options(image_format: str, dpi: int) -> None:
+    if image_format not in CONTENT_TYPES:
+        raise ValueError(
+            f"unsupported image format {image_format!r},"
+            f" expected one of {', '.join(CONTENT_TYPES)}"
+        )
+    if not 10 <= dpi <= 600:
+        raise ValueError(f"dpi {dpi} is out of range, expected 10 to 600")
+
+
+def render_figure(figure: Any, image_format: str, dpi: int) -> bytes:
+    buffer = io.BytesIO()
+    if image_format == "webp" and "webp" not in figure.canvas.get_supported_filetypes():
+        # older matplotlib, encode the pixels with Pillow
+        import numpy as np
+        from PIL import Image
+
+        figure.set_dpi(dpi)
+        figure.canvas.draw()
+        pixels = np.asarray(figure.canvas.buffer_rgba())
+        Image.fromarray(pixels).save(buffer, format="webp")
+    else:
+        figure.savefig(buffer, format=image_format, dpi=dpi)
+    return buffer.getvalue()
+
+
+class FigureCapture:
+    """Render the figures of the code run inside the `with` block."""
+
+    def __init__(self, image_format: str = "png", dpi: int = 100) -> None:
+        check_options(image_format, dpi)
+        self.image_format = image_format
+        self.dpi = dpi
+        self.images: list[RenderedImage] = []
+        self.skipped = 0
+        # absolute paths of the files the rendered figures were saved to
+        self.saved_files: list[str] = []
+        self._rendered: set[Any] = set()
+        self._saved: list[tuple[Any, str]] = []
+        self._show = None
+        self._savefig = None
+
+    def _record_save(self, figure: Any, fname: Any, image_format: Any) -> None:
+        import matplotlib
+
+        if not isinstance(fname, (str, os.PathLike)):
+            # a buffer, also how the figures are rendered here
+            return
+        path = os.fspath(fname)
+        if not os.path.splitext(path)[1]:
+            # savefig adds the extension of the format
+            path += "." + (image_format or matplotlib.rcParams["savefig.format"])
+        self._saved.append((figure, os.path.realpath(path)))
+
+    def render(self) -> None:
+        """Render the open figures and close them."""
+        import matplotlib.pyplot as plt
+
+        for number in plt.get_fignums():
+            figure = plt.figure(number)
+            if len(self.images) >= MAX_FIGURES:
+                self.skipped += 1
+            else:
+                try:
+                    data = render_figure(figure, self.image_format, self.dpi)
+                    self.images.append(
+                        RenderedImage(data, self.image_format, len(data))
+                    )
+                    self._rendered.add(figure)
+                except Exception:
+                    print("Could not render the figure.", file=sys.stderr)
+                    traceback.print_exc()
+            plt.close(figure)
+
+    def __enter__(self) -> FigureCapture:
+        import matplotlib.pyplot as plt
+        from matplotlib.figure import Figure
+
+        # a function rather than a bound method, pyplot sets attributes on it
+        # when it resolves the backend
+        def show(*args: Any, **kwargs: Any) -> None:
+            self.render()
+
+        savefig = self._savefig = Figure.savefig
+
+        def record_savefig(figure: Any, *args: Any, **kwargs: Any) -> Any:
+            result = savefig(figure, *args, **kwargs)
+            fname = args[0] if args else kwargs.get("fname")
+            self._record_save(figure, fname, kwargs.get("format"))
+            return result
+
+        self._show = plt.show
+        plt.show = show
+        Figure.savefig = record_savefig
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        import matplotlib.pyplot as plt
+        from matplotlib.figure import Figure
+
+        try:
+            self.render()
+        finally:
+            plt.show = self._show
+            Figure.savefig = self._savefig
+        self.saved_files = [
+            path for figure, path in self._saved if figure in self._rendered
+        ]
+        if self.skipped:
+            print(
+                f"Only the first {MAX_FIGURES} figures are shown,"
+                f" {self.skipped} more were left out.",
+                file=sys.stderr,
+            )
@@ -0,0 +1,273 @@
+"""
+
+Fork-server executor with preloaded heavy packages.
+
+The exec images install torch, tensorflow, transformers, geopandas and more, and
+a fresh interpreter pays their import cost on every execution. The fork server
+is a process that imports a manifest of heavy modules once; every execution
+runs in a child forked from it, which shares the imported modules copy-on-write
+and exits when the code is done. Executions are isolated from each other, and
+importing a preloaded module in the code is a lookup in sys.modules. The code
+runs under the CPU, memory and open file limits of execution_limits.py, and the
+results carry its metering.
+
+Built on the "forkserver" start method of multiprocessing, so it is only
+available on POSIX platforms.
+
+    executor = ForkServerExecutor(preload=["numpy", "pandas"])
+    executor.warm()
+    result = executor.execute("import pandas as pd; print(pd.__version__)")
+
+execute_batch runs a shared setup once and every snippet of the batch in its own
+fork of the process that ran the setup, e.g. a solution and its test cases.
+
+"""
+from __future__ import annotations
+
+import dataclasses
+import multiprocessing
+import multiprocessing.connection
+import sys
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Any, Sequence
+
+from execution_limits import (
+    ExecutionLimits,
+    Metering,
+    drop_harness_frames,
+    exceeded_limit,
+    limit_message,
+    limits_in_process,
+    run_forked,
+)
+from output_capture import OutputCapture
+from scratch import ScratchDirectory
+
+# the heavy packages of the exec images, missing ones are skipped
+PRELOAD_MANIFEST = [
+    "numpy",
+    "pandas",
+    "scipy",
+    "matplotlib",
+    "matplotlib.pyplot",
+    "sklearn",
+    "torch",
+    "tensorflow",
+    "transformers",
+    "geopandas",
+]
+
+# the child is stopped once it has printed this much
+OUTPUT_LIMIT_BYTES = 10 * 1024 * 1024
+
+
+@dataclass
+class ForkResult:
+    output: str
+    error: str
+    duration: float = 0.0
+    timed_out: bool = False
+    metering: Metering | None = None
+
+
+@dataclass
+class SnippetResult:
+    output: str
+    error: str
+    wall: float = 0.0
+    # peak resident bytes of the process that ran the snippet
+    peak_memory: int = 0
+    timed_out: bool = False
+    cpu_seconds: float = 0.0
+    bytes_written: int = 0
+    limit_exceeded: str | None = None
+
+
+def _exec(code: str, namespace: dict, filename: str) -> BaseException | None:
+    # the exception the code raised, if any
+    try:
+        exec(compile(code, filename, "exec"), namespace)
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        # for the limits, as the interactive interpreter does
+        sys.last_type, sys.last_value, sys.last_traceback = etype, value, tb
+        # without the frame of this function, nor those of the limit handlers
+        traceback.print_exception(etype, value, drop_harness_frames(tb.tb_next))
+        return value
+    return None
+
+
+def _run(
+    code: str,
+    limits: ExecutionLimits,
+    connection: multiprocessing.connection.Connection,
+) -> None:
+    # runs in the forked child, the code in a child of its own under the limits
+    with ScratchDirectory() as scratch:
+        _, captured, metering = run_forked(
+            scratch.wrap(lambda: _exec(code, {"__name__": "__main__"}, "<cell>")),
+            limits,
+            limit_bytes=OUTPUT_LIMIT_BYTES,
+        )
+    connection.send((captured.output, captured.error, metering))
+    connection.close()
+
+
+def _run_snippet(
+    snippet: str, namespace: dict, limits: ExecutionLimits
+) -> SnippetResult:
+    # a grandchild per snippet, so that snippets only see the state of the setup
+    _, captured, metering = run_forked(
+        lambda: _exec(snippet, namespace, "<snippet>"),
+        limits,
+        limit_bytes=OUTPUT_LIMIT_BYTES,
+    )
+    return SnippetResult(
+        captured.output,
+        captured.error,
+        wall=metering.wall_seconds,
+        peak_memory=metering.peak_rss,
+        timed_out=metering.limit_exceeded == "wall",
+        cpu_seconds=metering.cpu_seconds,
+        bytes_written=metering.bytes_written,
+        limit_exceeded=metering.limit_exceeded,
+    )
+
+
+def _run_batch(
+    snippets: list[str],
+    shared_setup: str,
+    limits: ExecutionLimits,
+    connection: multiprocessing.connection.Connection,
+) -> None:
+    # runs in the forked child, the files of the setup are seen by the snippets;
+    # the setup runs in this process, under the limits until it is done
+    namespace = {"__name__": "__main__"}
+    with ScratchDirectory() as scratch:
+        scratch.enter()
+        with OutputCapture(limit_bytes=OUTPUT_LIMIT_BYTES) as capture:
+            with limits_in_process(limits):
+                error = _exec(shared_setup, namespace, "<setup>")
+        limit = exceeded_limit(error)
+        if limit is None and capture.limit_exceeded:
+            limit = "output"
+        if error is not None or limit is not None:
+            message = capture.result().error
+            if limit is not None:
+                message += f"\n{limit_message(limit, limits)}\n"
+            results = [
+                SnippetResult(
+                    "",
+                    "The shared setup failed.\n" + message,
+                    timed_out=limit == "wall",
+                    limit_exceeded=limit,
+                )
+                for _ in snippets
+            ]
+        else:
+            results = [_run_snippet(snippet, namespace, limits) for snippet in snippets]
+    connection.send(results)
+    connection.close()
+
+
+class ForkServerExecutor:
+    """Runs each execution in a child of a server with `preload` imported.
+
+    The server is shared by all executors of the process and started on the
+    first execution, or by warm(). The preload list is read when it starts.
+
+    """
+
+    def __init__(
+        self,
+        preload: Sequence[str] = PRELOAD_MANIFEST,
+        limits: ExecutionLimits | None = None,
+    ) -> None:
+        self.preload = list(preload)
+        self.limits = limits or ExecutionLimits()
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload(self.preload)
+
+    def _limits(self, timeout: float | None) -> ExecutionLimits:
+        if timeout is None:
+            return self.limits
+        return dataclasses.replace(self.limits, wall_seconds=timeout)
+
+    def warm(self) -> None:
+        """Start the server and wait until it has imported the preload modules."""
+        self.execute("pass")
+
+    def _call(self, target: Any, args: tuple, timeout: float | None) -> Any:
+        """Run `target(*args, sender)` in a forked child and return what it sends.
+
+        Raises TimeoutError, or ChildProcessError if the child died first.
+
+        """
+        receiver, sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=target, args=(*args, sender), daemon=True)
+        process.start()
+        sender.close()
+        try:
+            if not receiver.poll(timeout):
+                process.kill()
+                raise TimeoutError
+            return receiver.recv()
+        except EOFError:
+            process.join()
+            raise ChildProcessError(
+                f"The Python process exited unexpectedly ({process.exitcode})."
+            )
+        finally:
+            receiver.close()
+            process.join()
+
+    def execute(self, code: str, timeout: float | None = None) -> ForkResult:
+        """Run `code` under the limits, `timeout` overrides their wall time."""
+        start = time.monotonic()
+        limits = self._limits(timeout)
+        try:
+            output, error, metering = self._call(
+                _run, (code, limits), _grace(limits.wall_seconds)
+            )
+        except TimeoutError:
+            return ForkResult(
+                "", "Time limit exceeded.", time.monotonic() - start, True
+            )
+        except ChildProcessError as e:
+            return ForkResult("", str(e), time.monotonic() - start)
+        return ForkResult(
+            output,
+            error,
+            time.monotonic() - start,
+            timed_out=metering.limit_exceeded == "wall",
+            metering=metering,
+        )
+
+    def execute_batch(
+        self, snippets: list[str], shared_setup: str = "", timeout: float | None = None
+    ) -> list[SnippetResult]:
+        """Run `shared_setup` once, then each snippet on a copy of its state.
+
+        `timeout` applies to each snippet, and to the setup.
+
+        """
+        limits = self._limits(timeout)
+        deadline = _grace(limits.wall_seconds)
+        if deadline is not None:
+            deadline *= len(snippets) + 1
+        try:
+            return self._call(_run_batch, (snippets, shared_setup, limits), deadline)
+        except TimeoutError:
+            return [
+                SnippetResult("", "Time limit exceeded.", timed_out=True)
+                for _ in snippets
+            ]
+        except ChildProcessError as e:
+            return [SnippetResult("", str(e)) for _ in snippets]
+
+
+def _grace(seconds: float | None) -> float | None:
+    # the child enforces the wall time itself, this only catches a stuck child
+    return None if seconds is None else seconds + 5
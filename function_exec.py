@@ -5,12 +5,25 @@ Helper function to execute Python code
 modal deploy function_exec.py
 """
 
+import dataclasses
+import json
 import os
-import sys
-import textwrap
-from io import StringIO
+import tempfile
+import threading
 
-from modal import Image, Stub
+from modal import Image, Stub, enter, method
+
+from execution_limits import ExecutionLimits, iter_forked
+from figure_capture import (
+    MAX_FIGURES,
+    FigureCapture,
+    RenderedImage,
+    check_options,
+    use_agg,
+)
+from fork_server import PRELOAD_MANIFEST, ForkServerExecutor
+from scratch import IMAGE_EXTENSIONS, ScratchDirectory
+from shell_pool import ShellPool
 
 image = Image.debian_slim().pip_install(
     "fastapi-poe==0.0.23",
@@ -59,76 +72,207 @@ image = Image.debian_slim().pip_install(
 stub = Stub("poe-bot-quickstart")
 
 
-@stub.function(image=image, timeout=30)
-def execute_code(code):
-    import traitlets.config
-    from IPython.terminal.embed import InteractiveShellEmbed
+# imported once per container, cells importing them only pay for a lookup
+PRELOAD_MODULES = ["numpy", "pandas", "matplotlib", "matplotlib.pyplot"]
+
+# kept from the start and the end of each stream, the cell is stopped beyond
+# the limit
+OUTPUT_HEAD_BYTES = 20000
+OUTPUT_TAIL_BYTES = 5000
+OUTPUT_LIMIT_BYTES = 10 * 1024 * 1024
+
+SNIPPET_TIMEOUT = 10
+
+# executions of a container at once, each one in a forked child with its own
+# shell and scratch directory
+MAX_CONCURRENT_EXECUTIONS = 8
+
+# every execution gets a directory of its own in here
+SCRATCH_ROOT = os.path.join(tempfile.gettempdir(), "executions")
+
+# the wall time stays below the timeout of the functions, so that the limit is
+# reported rather than the function killed
+LIMITS = ExecutionLimits(
+    cpu_seconds=20, memory_bytes=4 * 1024**3, open_files=256, wall_seconds=25
+)
 
-    config = traitlets.config.Config()
-    config.InteractiveShell.colors = "NoColor"
-    # config.PlainTextFormatter.max_width = 40  # not working
-    # config.InteractiveShell.width = 40  # not working
-    ipython = InteractiveShellEmbed(config=config)
+shell_pool = None
+fork_server = None
+# the first concurrent calls would each create a pool
+shell_pool_lock = threading.Lock()
 
-    # Redirect stdout temporarily to capture the output of the code snippet
-    old_stdout = sys.stdout
-    sys.stdout = StringIO()
 
+def get_shell_pool():
+    # created on the first call, not when the app is deployed
+    global shell_pool
+    with shell_pool_lock:
+        if shell_pool is None:
+            use_agg()
+            shell_pool = ShellPool(preload=PRELOAD_MODULES)
+    return shell_pool
+
+
+def get_fork_server():
+    # started at container start by ForkServer, the preload takes longer than
+    # the timeout of a request
+    global fork_server
+    if fork_server is None:
+        fork_server = ForkServerExecutor(preload=PRELOAD_MANIFEST, limits=LIMITS)
+        fork_server.warm()
+    return fork_server
+
+
+def run_cell(ipython, code):
     # Execute the code with the silent parameter set to True
     _ = ipython.run_cell(code, silent=True, store_history=False, shell_futures=False)
 
-    # Restore the original stdout and retrieve the captured output
-    captured_output = sys.stdout.getvalue()
-    sys.stdout = old_stdout
 
-    return captured_output
+def forked(run, scratch):
+    # each cell runs under the limits in a fork of the container, with its own
+    # copy of a warm shell and its own scratch directory, so nothing it does
+    # reaches the next cell or the cells running next to it. The shell is
+    # taken from the pool here, in the parent: the child exits after the cell,
+    # so the shell goes back without a reset (a full garbage collection)
+    with get_shell_pool().lend() as ipython:
+        yield from iter_forked(
+            scratch.wrap(lambda: run(ipython)),
+            LIMITS,
+            head_bytes=OUTPUT_HEAD_BYTES,
+            tail_bytes=OUTPUT_TAIL_BYTES,
+            limit_bytes=OUTPUT_LIMIT_BYTES,
+        )
+
+
+def forked_cell(code, scratch):
+    return forked(lambda ipython: run_cell(ipython, code), scratch)
+
+
+def log_metering(metering):
+    print("metering", json.dumps(dataclasses.asdict(metering)))
+    if shell_pool is not None:
+        print("shell_pool", shell_pool.stats)
+
 
+def run_code(code):
+    with ScratchDirectory(SCRATCH_ROOT) as scratch:
+        for kind, payload in forked_cell(code, scratch):
+            if kind == "result":
+                _, result, metering = payload
+                log_metering(metering)
+    return result.output + result.error
 
-@stub.function(image=image, timeout=30)
-def execute_code_matplotlib(code):
-    MATPLOTLIB_SHOW_OVERRIDE = textwrap.dedent(
-        """\
-    import matplotlib.pyplot as plt
 
-    def save_image(filename):
-        def decorator(func):
-            def wrapper(*args, **kwargs):
-                func(*args, **kwargs)
-                plt.savefig(filename)
-            return wrapper
-        return decorator
+def stream_code(code):
+    # ("stdout", text) and ("stderr", text) while the code runs, then
+    # ("result", {"output": ..., "error": ..., "dropped": ..., "metering": ...})
+    with ScratchDirectory(SCRATCH_ROOT) as scratch:
+        for kind, payload in forked_cell(code, scratch):
+            if kind == "result":
+                _, result, metering = payload
+                log_metering(metering)
+                payload = dict(
+                    dataclasses.asdict(result), metering=dataclasses.asdict(metering)
+                )
+            yield kind, payload
 
-    plt.show = save_image('image.png')(plt.show)
-    """
+
+def run_code_forked(code):
+    # a forked child per call, nothing leaks into the next call
+    result = get_fork_server().execute(code)
+    if result.metering is not None:
+        log_metering(result.metering)
+    return result.output + result.error
+
+
+def run_batch(snippets, shared_setup=""):
+    # one round trip for e.g. a solution and its test cases, every snippet sees
+    # the state of the setup but not the changes of the other snippets
+    results = get_fork_server().execute_batch(
+        snippets, shared_setup, timeout=SNIPPET_TIMEOUT
     )
+    return [dataclasses.asdict(result) for result in results]
 
-    code = MATPLOTLIB_SHOW_OVERRIDE + code
 
-    import traitlets.config
-    from IPython.terminal.embed import InteractiveShellEmbed
+def render_cell(ipython, code, image_format, dpi):
+    # runs in the forked child, the images come back with the result, and the
+    # files the same figures were saved to
+    with FigureCapture(image_format, dpi) as capture:
+        ipython.run_cell(code, silent=True, store_history=False, shell_futures=False)
+    return capture.images, capture.saved_files
 
-    config = traitlets.config.Config()
-    config.InteractiveShell.colors = "NoColor"
-    # config.PlainTextFormatter.max_width = 40  # not working
-    # config.InteractiveShell.width = 40  # not working
-    ipython = InteractiveShellEmbed(config=config)
 
-    # Redirect stdout temporarily to capture the output of the code snippet
-    old_stdout = sys.stdout
-    sys.stdout = StringIO()
+def run_code_matplotlib(code, image_format="png", dpi=100):
+    # every figure of the code, as [{"data": ..., "image_format": ..., "size": ...}],
+    # then the images it saved to its scratch directory, and the metering
+    check_options(image_format, dpi)
+    images, rendered_files = [], []
+    with ScratchDirectory(SCRATCH_ROOT) as scratch:
+        for kind, payload in forked(
+            lambda ipython: render_cell(ipython, code, image_format, dpi), scratch
+        ):
+            if kind == "result":
+                value, result, metering = payload
+                log_metering(metering)
+                images, rendered_files = value or ([], [])
+        saved = scratch.collect(IMAGE_EXTENSIONS, max_files=MAX_FIGURES)
+        root = os.path.realpath(scratch.path)
+    # a figure that was rendered and saved to a file is only returned once
+    for file in saved:
+        if os.path.join(root, file.name) not in rendered_files:
+            extension = os.path.splitext(file.name)[1].lstrip(".").lower()
+            images.append(RenderedImage(file.data, extension, file.size))
+    print("images", [image.size for image in images])
+    return (
+        result.output + result.error,
+        [dataclasses.asdict(image) for image in images[:MAX_FIGURES]],
+        dataclasses.asdict(metering),
+    )
 
-    # Execute the code with the silent parameter set to True
-    _ = ipython.run_cell(code, silent=True, store_history=False, shell_futures=False)
 
-    # Restore the original stdout and retrieve the captured output
-    captured_output = sys.stdout.getvalue()
-    sys.stdout = old_stdout
+# the functions by the name they are deployed under, for executors that run
+# them outside of Modal (see executor_client.py)
+LOCAL_FUNCTIONS = {
+    "execute_code": run_code,
+    "execute_code_stream": stream_code,
+    "ForkServer.execute_code_forked": run_code_forked,
+    "ForkServer.execute_batch": run_batch,
+    "execute_code_matplotlib": run_code_matplotlib,
+}
+
+
+@stub.function(
+    image=image, timeout=30, allow_concurrent_inputs=MAX_CONCURRENT_EXECUTIONS
+)
+def execute_code(code):
+    return run_code(code)
+
+
+@stub.function(
+    image=image, timeout=30, allow_concurrent_inputs=MAX_CONCURRENT_EXECUTIONS
+)
+def execute_code_stream(code):
+    yield from stream_code(code)
+
 
-    image_data = None
-    filename = "image.png"
-    if os.path.isfile(filename):
-        with open(filename, "rb") as f:
-            image_data = f.read()
-        os.remove(filename)
+# the fork server executions run under LIMITS, the timeout is for the batches
+@stub.cls(image=image, timeout=120, allow_concurrent_inputs=MAX_CONCURRENT_EXECUTIONS)
+class ForkServer:
+    @enter()
+    def start(self):
+        # before the first input, with the preload of the heavy packages
+        get_fork_server()
 
-    return captured_output, image_data
+    @method()
+    def execute_code_forked(self, code):
+        return run_code_forked(code)
+
+    @method()
+    def execute_batch(self, snippets, shared_setup=""):
+        return run_batch(snippets, shared_setup)
+
+
+@stub.function(
+    image=image, timeout=30, allow_concurrent_inputs=MAX_CONCURRENT_EXECUTIONS
+)
+def execute_code_matplotlib(code, image_format="png", dpi=100):
+    return run_code_matplotlib(code, image_format, dpi)
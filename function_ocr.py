@@ -7,10 +7,13 @@ modal deploy function_ocr.py
 
 import os
 
-import requests
 from modal import Image, Stub
 
-image = Image.debian_slim().apt_install("wget").pip_install("nougat-ocr==0.1.14")
+from http_client import get_client, log_stats
+
+image = Image.debian_slim().pip_install(
+    "nougat-ocr==0.1.14", "httpx[http2]==0.28.1", "httpcore==1.0.9"
+)
 
 stub = Stub("poe-bot-quickstart")
 
@@ -19,15 +22,14 @@ stub = Stub("poe-bot-quickstart")
 def nougat_ocr(url):
     local_filename = "downloaded.pdf"
 
-    r = requests.get(url)
+    # the client of the container keeps its connections between calls
+    r = get_client().get(url, timeout=60)
+    log_stats()
 
     with open(local_filename, "wb") as f:
         f.write(r.content)
 
-    # not sure if I really need to chain them
-    os.system(
-        f"wget -O {local_filename} {url} && nougat {local_filename} --out output --pages 1"
-    )
+    os.system(f"nougat {local_filename} --out output --pages 1")
 
     with open("output/downloaded.mmd") as f:
         output = f.read()
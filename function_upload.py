@@ -7,7 +7,9 @@ modal deploy function_upload.py
 
 import os
 
-from modal import Image, Stub
+from modal import Image, NetworkFileSystem, Stub
+
+from upload_cache import CloudinaryStorage, DirectoryIndex, UploadCache
 
 image = (
     Image.debian_slim()
@@ -23,23 +25,36 @@ image = (
 
 stub = Stub("poe-bot-quickstart")
 
+# URLs of past uploads by content, shared by the containers of the function
+URL_INDEX_DIR = "/url-index"
+url_index = NetworkFileSystem.persisted("upload-url-index")
 
-@stub.function(image=image, timeout=30)
-def upload_file(data, file_name):
-    import cloudinary.uploader
+upload_cache = None
 
-    with open(file_name, "wb") as f:
-        f.write(data)
 
-    cloudinary.config(
-        cloud_name=os.environ["CLOUDINARY_CLOUD_NAME"],
-        api_key=os.environ["CLOUDINARY_API_KEY"],
-        api_secret=os.environ["CLOUDINARY_API_SECRET"],
-    )
+def get_upload_cache():
+    global upload_cache
+    if upload_cache is None:
+        upload_cache = UploadCache(CloudinaryStorage(), DirectoryIndex(URL_INDEX_DIR))
+    return upload_cache
+
 
-    # reject if file size is too big
-    reply = cloudinary.uploader.upload(file_name)
-    file_url = reply["secure_url"]
+@stub.function(image=image, timeout=30, network_file_systems={URL_INDEX_DIR: url_index})
+def upload_file(data, file_name):
+    cache = get_upload_cache()
+    file_url = cache.upload(data, file_name)
     print("file_url")
     print(file_url)
+    print("upload_cache", cache.stats)
     return file_url
+
+
+@stub.function(image=image, timeout=60, network_file_systems={URL_INDEX_DIR: url_index})
+def upload_files(files):
+    # [(data, file_name), ...] in one call, uploaded concurrently
+    cache = get_upload_cache()
+    file_urls = cache.upload_many(files)
+    print("file_urls")
+    print(file_urls)
+    print("upload_cache", cache.stats)
+    return file_urls
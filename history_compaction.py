@@ -0,0 +1,131 @@
+"""
+
+Keep the prompt of the Python agent loop within a token budget.
+
+Every code iteration appends the bot reply and a simulated user reply with the
+execution output to the query, so the prompt grows with each turn. The compactor
+truncates long outputs to their head and tail when the simulated reply is built,
+and before each upstream call it compacts earlier iterations in stages until the
+query fits the budget:
+
+1. code blocks of failed iterations that a later reply superseded are collapsed
+2. tracebacks of earlier iterations are reduced to their last line
+3. outputs of earlier iterations are truncated further
+
+"""
+from __future__ import annotations
+
+import functools
+import re
+from dataclasses import dataclass, field
+from typing import Any
+
+CODE_BLOCK = re.compile(r"```python[\s\S]*?```")
+ERROR_BLOCK = re.compile(r"```error\n([\s\S]*?)```")
+OUTPUT_BLOCK = re.compile(r"```output\n([\s\S]*?)```")
+
+SUPERSEDED_CODE = "```python\n# superseded by the code below\n```"
+
+
+@functools.lru_cache(maxsize=1)
+def get_encoding() -> Any:
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        # rough estimate for English text and code
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_middle(text: str, max_tokens: int) -> str:
+    """Keep the head and the tail of `text` within about `max_tokens` tokens."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = get_encoding()
+    if encoding is None:
+        tokens, join = text, "".join
+        head_size = tail_size = max_tokens * 2
+    else:
+        tokens, join = encoding.encode(text, disallowed_special=()), encoding.decode
+        head_size = tail_size = max_tokens // 2
+    tail_start = len(tokens) - tail_size
+    omitted = tail_start - head_size
+    return (
+        join(tokens[:head_size])
+        + f"\n... ({omitted} {'tokens' if encoding else 'characters'} omitted) ...\n"
+        + join(tokens[tail_start:])
+    )
+
+
+@dataclass
+class ToolTurn:
+    # the bot message with the code and the simulated user reply with its result
+    reply: Any
+    result: Any
+    failed: bool
+
+
+@dataclass
+class CompactionRecord:
+    iteration: int
+    tokens_before: int
+    tokens_after: int
+
+
+@dataclass
+class HistoryCompactor:
+    budget_tokens: int = 6000
+    max_output_tokens: int = 1000
+    records: list = field(default_factory=list)
+
+    def truncate(self, text: str) -> str:
+        return truncate_middle(text, self.max_output_tokens)
+
+    def count(self, messages: list[Any]) -> int:
+        return sum(count_tokens(message.content) for message in messages)
+
+    def compact(self, messages: list[Any], turns: list[ToolTurn]) -> CompactionRecord:
+        """Compact the earlier `turns` in place until `messages` fit the budget."""
+        tokens_before = tokens = self.count(messages)
+        earlier = turns[:-1]
+        stages = [
+            self._collapse_superseded_code,
+            self._drop_stale_tracebacks,
+            self._shrink_outputs,
+        ]
+        for stage in stages:
+            if tokens <= self.budget_tokens:
+                break
+            for turn in earlier:
+                stage(turn)
+            tokens = self.count(messages)
+
+        record = CompactionRecord(len(turns), tokens_before, tokens)
+        self.records.append(record)
+        return record
+
+    def _collapse_superseded_code(self, turn: ToolTurn) -> None:
+        if turn.failed:
+            turn.reply.content = CODE_BLOCK.sub(SUPERSEDED_CODE, turn.reply.content)
+
+    def _drop_stale_tracebacks(self, turn: ToolTurn) -> None:
+        def last_line(match):
+            lines = match.group(1).strip().splitlines() or [""]
+            return f"```error\n{lines[-1]}\n```"
+
+        turn.result.content = ERROR_BLOCK.sub(last_line, turn.result.content)
+
+    def _shrink_outputs(self, turn: ToolTurn) -> None:
+        def shrink(match):
+            output = truncate_middle(match.group(1), self.max_output_tokens // 4)
+            return f"```output\n{output}```"
+
+        turn.result.content = OUTPUT_BLOCK.sub(shrink, turn.result.content)
@@ -0,0 +1,289 @@
+"""
+
+Shared HTTP clients of a process.
+
+The bots fetched pages, documents and images with module-level requests.get,
+which opens a new connection, with a new DNS lookup and TLS handshake, for
+every fetch. All fetches now go through shared pooled clients, which keep
+connections alive between requests, speak HTTP/2 when the h2 package is
+installed and cache DNS answers for DNS_TTL seconds. A process has one client
+for blocking code and one client per event loop, and each of them opens at
+most MAX_CONNECTIONS connections. The client of an event loop that has been
+closed is closed with it. `stats` counts the requests that got a response,
+those that failed, the connections opened and the DNS lookups, for every
+client of the process.
+
+The DNS cache and the connection count are a network backend of the httpcore
+pool inside the httpx transport, which httpx has no public way to set. The
+images pin the httpx and httpcore versions it is written for; with others the
+clients work without the cache and the connection count.
+
+    response = await get_async_client().get(url, timeout=10)
+    response = get_client().get(url)
+    log_stats()
+
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import importlib.util
+import json
+import socket
+import threading
+import time
+import weakref
+from dataclasses import asdict, dataclass
+from typing import Any
+
+import httpcore
+import httpx
+
+MAX_CONNECTIONS = 64
+MAX_KEEPALIVE_CONNECTIONS = 32
+KEEPALIVE_EXPIRY = 60.0
+DNS_TTL = 300.0
+TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+
+@dataclass
+class ConnectionStats:
+    # requests that got a response
+    requests: int = 0
+    # requests that raised, left out of the reuse
+    failed: int = 0
+    # connections opened, the other requests reused one
+    connections: int = 0
+    dns_lookups: int = 0
+    dns_hits: int = 0
+
+    @property
+    def reused(self) -> int:
+        return max(self.requests - self.connections, 0)
+
+    @property
+    def reuse_ratio(self) -> float:
+        return self.reused / self.requests if self.requests else 0.0
+
+
+stats = ConnectionStats()
+
+
+class _DnsCache:
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._addresses: dict[tuple[str, int], tuple[list[str], float]] = {}
+
+    def get(self, host: str, port: int) -> list[str] | None:
+        cached = self._addresses.get((host, port))
+        if cached is None or cached[1] < time.monotonic():
+            return None
+        stats.dns_hits += 1
+        return cached[0]
+
+    def put(self, host: str, port: int, infos: list[Any]) -> list[str]:
+        stats.dns_lookups += 1
+        # in the resolver's order, without the duplicates of each socket type
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        self._addresses[host, port] = (addresses, time.monotonic() + self.ttl)
+        return addresses
+
+
+def _is_address(host: str) -> bool:
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+class _AsyncBackend(httpcore.AsyncNetworkBackend):
+    # connects to the cached addresses of the host, and counts the connections;
+    # TLS still checks the host name, httpcore passes it to start_tls
+    def __init__(self, backend: httpcore.AsyncNetworkBackend, dns: _DnsCache) -> None:
+        self.backend = backend
+        self.dns = dns
+        # the open connections, closed with the event loop of the client
+        self.streams: weakref.WeakSet = weakref.WeakSet()
+
+    async def connect_tcp(
+        self, host: str, port: int, **kwargs: Any
+    ) -> httpcore.AsyncNetworkStream:
+        stream = await self._connect_tcp(host, port, **kwargs)
+        stats.connections += 1
+        self.streams.add(stream)
+        return stream
+
+    async def _connect_tcp(
+        self, host: str, port: int, **kwargs: Any
+    ) -> httpcore.AsyncNetworkStream:
+        if _is_address(host):
+            return await self.backend.connect_tcp(host, port, **kwargs)
+        addresses = self.dns.get(host, port)
+        if addresses is None:
+            loop = asyncio.get_running_loop()
+            try:
+                infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            except OSError as e:
+                # httpx turns this one into httpx.ConnectError
+                raise httpcore.ConnectError(str(e)) from e
+            addresses = self.dns.put(host, port, infos)
+        error: Exception = httpcore.ConnectError(f"no address for {host}")
+        for address in addresses:
+            try:
+                return await self.backend.connect_tcp(address, port, **kwargs)
+            except httpcore.ConnectError as e:
+                error = e
+        raise error
+
+    async def connect_unix_socket(
+        self, path: str, **kwargs: Any
+    ) -> httpcore.AsyncNetworkStream:
+        return await self.backend.connect_unix_socket(path, **kwargs)
+
+    async def sleep(self, seconds: float) -> None:
+        await self.backend.sleep(seconds)
+
+
+class _SyncBackend(httpcore.NetworkBackend):
+    def __init__(self, backend: httpcore.NetworkBackend, dns: _DnsCache) -> None:
+        self.backend = backend
+        self.dns = dns
+
+    def connect_tcp(
+        self, host: str, port: int, **kwargs: Any
+    ) -> httpcore.NetworkStream:
+        stream = self._connect_tcp(host, port, **kwargs)
+        stats.connections += 1
+        return stream
+
+    def _connect_tcp(
+        self, host: str, port: int, **kwargs: Any
+    ) -> httpcore.NetworkStream:
+        if _is_address(host):
+            return self.backend.connect_tcp(host, port, **kwargs)
+        addresses = self.dns.get(host, port)
+        if addresses is None:
+            try:
+                infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            except OSError as e:
+                raise httpcore.ConnectError(str(e)) from e
+            addresses = self.dns.put(host, port, infos)
+        error: Exception = httpcore.ConnectError(f"no address for {host}")
+        for address in addresses:
+            try:
+                return self.backend.connect_tcp(address, port, **kwargs)
+            except httpcore.ConnectError as e:
+                error = e
+        raise error
+
+    def connect_unix_socket(self, path: str, **kwargs: Any) -> httpcore.NetworkStream:
+        return self.backend.connect_unix_socket(path, **kwargs)
+
+    def sleep(self, seconds: float) -> None:
+        self.backend.sleep(seconds)
+
+
+class _AsyncTransport(httpx.AsyncHTTPTransport):
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            stats.failed += 1
+            raise
+        stats.requests += 1
+        return response
+
+
+class _SyncTransport(httpx.HTTPTransport):
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            response = super().handle_request(request)
+        except BaseException:
+            stats.failed += 1
+            raise
+        stats.requests += 1
+        return response
+
+
+_dns = _DnsCache(DNS_TTL)
+_limits = httpx.Limits(
+    max_connections=MAX_CONNECTIONS,
+    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=KEEPALIVE_EXPIRY,
+)
+# the client of each event loop, with its backend
+_async_clients: dict[
+    asyncio.AbstractEventLoop, tuple[httpx.AsyncClient, _AsyncBackend | None]
+] = {}
+_client: httpx.Client | None = None
+_lock = threading.Lock()
+
+
+def _wrap_backend(transport: Any, wrapper: type) -> Any:
+    # httpx does not take a network backend, its httpcore pool does (httpx 0.28,
+    # httpcore 1.0, as pinned in the images)
+    pool = getattr(transport, "_pool", None)
+    backend = getattr(pool, "_network_backend", None)
+    if backend is None:
+        print("http_client", "no network backend, DNS answers are not cached")
+        return None
+    pool._network_backend = wrapper(backend, _dns)
+    return pool._network_backend
+
+
+def _close_connections(backend: _AsyncBackend) -> None:
+    # the event loop of the client is closed, so aclose() cannot run; its
+    # connections are shut down, and the sockets freed with the client
+    for stream in list(backend.streams):
+        sock = stream.get_extra_info("socket")
+        if sock is not None:
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """The client of the running event loop, created on first use.
+
+    The clients of event loops closed since the last call are closed here.
+
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        for stale in [other for other in _async_clients if other.is_closed()]:
+            _, backend = _async_clients.pop(stale)
+            if backend is not None:
+                _close_connections(backend)
+        if loop not in _async_clients:
+            transport = _AsyncTransport(http2=HTTP2, limits=_limits)
+            backend = _wrap_backend(transport, _AsyncBackend)
+            client = httpx.AsyncClient(
+                transport=transport, timeout=TIMEOUT, follow_redirects=True
+            )
+            _async_clients[loop] = (client, backend)
+        return _async_clients[loop][0]
+
+
+def get_client() -> httpx.Client:
+    """The client for blocking code, shared by all threads."""
+    global _client
+    with _lock:
+        if _client is None:
+            transport = _SyncTransport(http2=HTTP2, limits=_limits)
+            _wrap_backend(transport, _SyncBackend)
+            _client = httpx.Client(
+                transport=transport, timeout=TIMEOUT, follow_redirects=True
+            )
+    return _client
+
+
+def log_stats() -> None:
+    print(
+        "http_client",
+        json.dumps(
+            {**asdict(stats), "reused": stats.reused, "reuse_ratio": stats.reuse_ratio}
+        ),
+    )
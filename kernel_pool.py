@@ -0,0 +1,660 @@
+"""
+
+Pool of long-lived Python interpreters ("kernels"), one per conversation.
+
+A kernel keeps its globals in memory between code iterations, so the agent loop
+does not pay for interpreter start-up, imports and session reload on every cell.
+Kernels are evicted when idle for too long or when they grow past a memory cap,
+but never while a request has them checked out.
+Matplotlib figures are rendered in memory when a cell shows them, and when the
+cell ends for those left open, and returned as artifacts.
+
+The transport is hidden behind KernelBackend. LocalSubprocessBackend runs the
+kernels as local subprocesses so the pool can be load-tested offline, and
+ModalSandboxBackend runs them in Modal sandboxes for the deployed bots.
+
+"""
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+TIMEOUT_MESSAGE = "Time limit exceeded."
+
+# every protocol message from the kernel starts with this prefix; the kernel's
+# stdout only carries messages, what the cell writes to fd 1 and 2 is forwarded
+# in them by the driver
+RESPONSE_PREFIX = "\x1ekernel\x1e"
+
+KERNEL_DRIVER = r"""
+import base64, builtins, codecs, io, json, os, select, sys, threading, time
+import traceback, types
+
+PREFIX = "\x1ekernel\x1e"
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+if len(sys.argv) > 1:
+    os.chdir(sys.argv[1])
+sys.path.insert(0, os.getcwd())
+
+# user code runs in a fresh __main__ so that the driver does not leak into it
+main = types.ModuleType("__main__")
+main.__builtins__ = builtins
+sys.modules["__main__"] = main
+
+# the protocol keeps the original stdin and stdout to itself, the cell and its
+# subprocesses get /dev/null and a pipe per output stream instead, so that
+# nothing they write ends up in the middle of a message
+protocol_in = os.fdopen(os.dup(0), "r")
+protocol_out = os.fdopen(os.dup(1), "w")
+protocol_lock = threading.RLock()
+null_fd = os.open(os.devnull, os.O_RDONLY)
+os.dup2(null_fd, 0)
+os.close(null_fd)
+raw_streams = {}
+for fd, name in ((1, "stdout"), (2, "stderr")):
+    read_fd, write_fd = os.pipe()
+    os.dup2(write_fd, fd)
+    os.close(write_fd)
+    os.set_blocking(read_fd, False)
+    raw_streams[read_fd] = (name, codecs.getincrementaldecoder("utf-8")("replace"))
+
+
+def resident_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reply(message):
+    with protocol_lock:
+        protocol_out.write(PREFIX + json.dumps(message) + "\n")
+        protocol_out.flush()
+
+
+class OutputBudget:
+    def __init__(self, limit):
+        self.remaining = limit
+        self.dropped = 0
+        self.reported = 0
+        self.reported_at = 0.0
+
+    def take(self, text):
+        # the limit is in UTF-8 bytes, a character cut in two is dropped
+        if self.remaining is None:
+            return text
+        data = text.encode(errors="replace")
+        kept = data[: self.remaining]
+        self.remaining -= len(kept)
+        self.dropped += len(data) - len(kept)
+        return kept.decode(errors="ignore")
+
+    def due(self):
+        # the pool keeps the last count it was sent in case the cell times out,
+        # send it once a second or when it doubles
+        if self.dropped == self.reported:
+            return False
+        return (
+            self.dropped >= 2 * self.reported
+            or time.monotonic() - self.reported_at >= 1
+        )
+
+    def report(self):
+        self.reported, self.reported_at = self.dropped, time.monotonic()
+        return self.dropped
+
+
+budget = OutputBudget(None)
+
+
+def send_stream(name, text):
+    with protocol_lock:
+        text = budget.take(text)
+        if text or budget.due():
+            reply({"stream": name, "text": text, "dropped": budget.report()})
+
+
+def forward_raw(read_fds):
+    # what was written to fd 1 and 2, e.g. by a subprocess
+    with protocol_lock:
+        for read_fd in read_fds:
+            name, decoder = raw_streams[read_fd]
+            while True:
+                try:
+                    data = os.read(read_fd, 65536)
+                except BlockingIOError:
+                    break
+                if not data:
+                    break
+                send_stream(name, decoder.decode(data))
+
+
+def forward_raw_output():
+    while True:
+        ready, _, _ = select.select(list(raw_streams), [], [])
+        forward_raw(ready)
+
+
+threading.Thread(target=forward_raw_output, daemon=True).start()
+
+
+class StreamWriter(io.TextIOBase):
+    # forwards complete lines to the pool while the cell is still running
+
+    def __init__(self, name):
+        self.name = name
+        self.pending = ""
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.pending += text
+        if "\n" in self.pending or len(self.pending) > 4096:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        text, self.pending = self.pending, ""
+        send_stream(self.name, text)
+
+
+# figures of the current cell, encoded in memory
+MAX_FIGURES = 10
+artifacts = []
+skipped_figures = 0
+
+
+def render_figures():
+    # every open figure, closed once encoded
+    global skipped_figures
+    pyplot = sys.modules.get("matplotlib.pyplot")
+    if pyplot is None:
+        return
+    for number in pyplot.get_fignums():
+        figure = pyplot.figure(number)
+        if not (figure.axes or figure.artists or figure.texts or figure.images):
+            # e.g. the new figure of plt.clf() after plt.show()
+            pyplot.close(figure)
+            continue
+        if len(artifacts) >= MAX_FIGURES:
+            skipped_figures += 1
+            pyplot.close(figure)
+            continue
+        buffer = io.BytesIO()
+        try:
+            figure.savefig(buffer, format="png")
+        except Exception:
+            traceback.print_exc()
+        else:
+            artifacts.append(
+                {
+                    "name": f"figure_{len(artifacts) + 1}.png",
+                    "mime_type": "image/png",
+                    "data": base64.b64encode(buffer.getvalue()).decode(),
+                }
+            )
+        pyplot.close(figure)
+
+
+def show(*args, **kwargs):
+    # a figure is kept as it is when shown, even if the cell clears it afterwards
+    render_figures()
+
+
+try:
+    import matplotlib.pyplot
+
+    matplotlib.pyplot.show = show
+except ImportError:
+    pass
+
+
+while True:
+    line = protocol_in.readline()
+    if not line:
+        break
+    request = json.loads(line)
+    budget = OutputBudget(request.get("max_output_bytes"))
+    output, error = StreamWriter("stdout"), StreamWriter("stderr")
+    sys.stdin, sys.stdout, sys.stderr = io.StringIO(), output, error
+    artifacts.clear()
+    skipped_figures = 0
+    exception = None
+    try:
+        exec(compile(request["code"], "<cell>", "exec"), main.__dict__)
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        exception = etype.__name__
+        # drop the driver frame from the traceback
+        error.write("".join(traceback.format_exception(etype, value, tb.tb_next)))
+    finally:
+        # the figures that were never shown
+        artifact_start = time.perf_counter()
+        render_figures()
+        artifact_seconds = time.perf_counter() - artifact_start
+        if skipped_figures:
+            error.write(
+                f"Only the first {MAX_FIGURES} figures are shown,"
+                f" {skipped_figures} more were left out.\n"
+            )
+        # threads the cell left running print through the pipes
+        sys.stdin, sys.stdout, sys.stderr = sys.__stdin__, sys.__stdout__, sys.__stderr__
+    with protocol_lock:
+        # everything written during the cell goes out before its result
+        output.flush()
+        error.flush()
+        forward_raw(raw_streams)
+        reply(
+            {
+                "memory": resident_memory(),
+                "dropped": budget.dropped,
+                "exception": exception,
+                "artifacts": artifacts,
+                "artifact_seconds": artifact_seconds,
+            }
+        )
+"""
+
+
+class KernelDied(Exception):
+    pass
+
+
+@dataclass
+class Artifact:
+    name: str
+    mime_type: str
+    data: bytes
+
+
+@dataclass
+class ExecutionResult:
+    output: str
+    error: str
+    memory: int = 0
+    duration: float = 0.0
+    timed_out: bool = False
+    dropped: int = 0
+    # the name of the exception the cell did not catch, warnings only go to error
+    exception: str | None = None
+    artifacts: list = field(default_factory=list)
+    # time spent encoding the artifacts in the kernel
+    artifact_seconds: float = 0.0
+
+
+class Kernel:
+    """A running interpreter. Subclasses implement the transport."""
+
+    def __init__(self, conversation_id: str) -> None:
+        self.conversation_id = conversation_id
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.memory = 0
+        self.executions = 0
+        # requests holding the kernel, it is not evicted while they run
+        self.checkouts = 0
+        self._lock = asyncio.Lock()
+
+    async def _send(self, data: str) -> None:
+        raise NotImplementedError
+
+    async def _readline(self) -> str:
+        raise NotImplementedError
+
+    def alive(self) -> bool:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        raise NotImplementedError
+
+    async def stream(
+        self,
+        code: str,
+        timeout: float | None = None,
+        max_output_bytes: int | None = None,
+    ) -> AsyncIterator[tuple[str, Any]]:
+        """Run a cell and yield its output while it runs.
+
+        Yields ("stdout", text) and ("stderr", text) as lines are printed,
+        ("stderr", TIMEOUT_MESSAGE) if the cell runs past `timeout`, and
+        ("result", ExecutionResult) once the cell has finished.
+
+        """
+        async with self._lock:
+            start = time.monotonic()
+            output, error = [], []
+            # output dropped by the budget of the kernel, at least this much
+            dropped = 0
+            finished = False
+            try:
+                await self._send(
+                    json.dumps({"code": code, "max_output_bytes": max_output_bytes})
+                    + "\n"
+                )
+                while True:
+                    remaining = None
+                    if timeout is not None:
+                        remaining = max(0.0, timeout - (time.monotonic() - start))
+                    line = await asyncio.wait_for(self._readline(), remaining)
+                    if not line:
+                        raise KernelDied(f"kernel for {self.conversation_id} exited")
+                    text, prefix, frame = line.partition(RESPONSE_PREFIX)
+                    if text:
+                        # not from the driver, e.g. the interpreter failing to start
+                        output.append(text)
+                        yield "stdout", text
+                    if not prefix:
+                        continue
+                    message = json.loads(frame)
+                    if "stream" in message:
+                        dropped = message.get("dropped", dropped)
+                        if message["text"]:
+                            (output if message["stream"] == "stdout" else error).append(
+                                message["text"]
+                            )
+                            yield message["stream"], message["text"]
+                        continue
+                    break
+            except asyncio.TimeoutError:
+                # the kernel is stuck in user code, its state is lost
+                finished = True
+                await self.close()
+                error.append(TIMEOUT_MESSAGE)
+                yield "stderr", TIMEOUT_MESSAGE
+                yield "result", ExecutionResult(
+                    output="".join(output),
+                    error="".join(error),
+                    duration=time.monotonic() - start,
+                    timed_out=True,
+                    dropped=dropped,
+                )
+                return
+            else:
+                finished = True
+            finally:
+                self.last_used = time.monotonic()
+                if not finished:
+                    # the caller stopped reading mid-cell, the protocol is out of sync
+                    await self.close()
+
+            self.executions += 1
+            self.memory = message["memory"]
+            yield "result", ExecutionResult(
+                output="".join(output),
+                error="".join(error),
+                memory=message["memory"],
+                duration=time.monotonic() - start,
+                dropped=message["dropped"],
+                exception=message.get("exception"),
+                artifacts=[
+                    Artifact(
+                        name=artifact["name"],
+                        mime_type=artifact["mime_type"],
+                        data=base64.b64decode(artifact["data"]),
+                    )
+                    for artifact in message["artifacts"]
+                ],
+                artifact_seconds=message["artifact_seconds"],
+            )
+
+    async def execute(
+        self,
+        code: str,
+        timeout: float | None = None,
+        max_output_bytes: int | None = None,
+    ) -> ExecutionResult:
+        async for kind, payload in self.stream(code, timeout, max_output_bytes):
+            if kind == "result":
+                return payload
+        raise KernelDied(f"kernel for {self.conversation_id} returned no result")
+
+
+class KernelBackend:
+    """Starts kernels. `start` receives the keyword arguments given to the pool."""
+
+    async def start(self, conversation_id: str, **kwargs: Any) -> Kernel:
+        raise NotImplementedError
+
+
+class SubprocessKernel(Kernel):
+    def __init__(
+        self, conversation_id: str, process: asyncio.subprocess.Process
+    ) -> None:
+        super().__init__(conversation_id)
+        self.process = process
+
+    async def _send(self, data: str) -> None:
+        self.process.stdin.write(data.encode())
+        await self.process.stdin.drain()
+
+    async def _readline(self) -> str:
+        return (await self.process.stdout.readline()).decode(errors="replace")
+
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+    async def close(self) -> None:
+        if self.alive():
+            self.process.kill()
+            await self.process.wait()
+
+
+class LocalSubprocessBackend(KernelBackend):
+    def __init__(self, python: str = sys.executable, workdir: str = ".") -> None:
+        self.python = python
+        self.workdir = workdir
+
+    async def start(self, conversation_id: str, **kwargs: Any) -> Kernel:
+        process = await asyncio.create_subprocess_exec(
+            self.python,
+            "-u",
+            "-c",
+            KERNEL_DRIVER,
+            kwargs.get("workdir", self.workdir),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            # the driver forwards the cell's stderr, the rest goes to the logs
+            # as in a sandbox
+            stderr=None,
+            limit=64 * 1024 * 1024,
+        )
+        return SubprocessKernel(conversation_id, process)
+
+
+class SandboxKernel(Kernel):
+    def __init__(self, conversation_id: str, sandbox: Any) -> None:
+        super().__init__(conversation_id)
+        self.sandbox = sandbox
+        self._lines = None
+
+    async def _send(self, data: str) -> None:
+        loop = asyncio.get_running_loop()
+        self.sandbox.stdin.write(data.encode())
+        await loop.run_in_executor(None, self.sandbox.stdin.drain)
+
+    async def _readline(self) -> str:
+        # sandbox streams are blocking iterators, read them off the event loop
+        if self._lines is None:
+            self._lines = iter(self.sandbox.stdout)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, next, self._lines, "")
+
+    def alive(self) -> bool:
+        return self.sandbox.returncode is None
+
+    async def close(self) -> None:
+        if self.alive():
+            self.sandbox.terminate()
+
+
+class ModalSandboxBackend(KernelBackend):
+    def __init__(self, stub: Any, image: Any, timeout: int = 60 * 60) -> None:
+        self.stub = stub
+        self.image = image
+        self.timeout = timeout
+
+    async def start(self, conversation_id: str, **kwargs: Any) -> Kernel:
+        loop = asyncio.get_running_loop()
+        sandbox = await loop.run_in_executor(
+            None,
+            lambda: self.stub.spawn_sandbox(
+                "python",
+                "-u",
+                "-c",
+                KERNEL_DRIVER,
+                kwargs.get("workdir", "/cache"),
+                image=self.image,
+                network_file_systems=kwargs.get("network_file_systems", {}),
+                timeout=self.timeout,
+            ),
+        )
+        return SandboxKernel(conversation_id, sandbox)
+
+
+@dataclass
+class KernelPoolStats:
+    started: int = 0
+    reused: int = 0
+    evicted_idle: int = 0
+    evicted_memory: int = 0
+    evicted_capacity: int = 0
+    start_seconds: list = field(default_factory=list)
+
+
+class KernelPool:
+    """Kernels keyed by conversation_id.
+
+    Arguments:
+        - backend: the KernelBackend used to start kernels.
+        - idle_timeout: seconds without an execution before a kernel is evicted.
+        - max_memory: resident bytes above which a kernel is evicted after it runs.
+        - max_kernels: kernels kept at once, the least recently used is evicted first.
+        - sweep_interval: seconds between checks for idle kernels while the pool
+          has kernels, so that they are evicted without new requests.
+
+    """
+
+    def __init__(
+        self,
+        backend: KernelBackend,
+        idle_timeout: float = 10 * 60,
+        max_memory: int = 2 * 1024**3,
+        max_kernels: int = 32,
+        sweep_interval: float = 60,
+    ) -> None:
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.max_memory = max_memory
+        self.max_kernels = max_kernels
+        self.sweep_interval = sweep_interval
+        self._sweeper: asyncio.Task | None = None
+        self.kernels: dict[str, Kernel] = {}
+        self.stats = KernelPoolStats()
+        # (lock, users) of the starts in progress, removed once nobody waits
+        self._start_locks: dict[str, tuple[asyncio.Lock, int]] = {}
+
+    async def acquire(self, conversation_id: str, **kwargs: Any) -> Kernel:
+        """The kernel of the conversation, checked out until release()."""
+        await self.evict_idle()
+        lock, users = self._start_locks.get(conversation_id, (asyncio.Lock(), 0))
+        self._start_locks[conversation_id] = (lock, users + 1)
+        try:
+            async with lock:
+                kernel = await self._get_or_start(conversation_id, **kwargs)
+                kernel.checkouts += 1
+                self._start_sweeper()
+                return kernel
+        finally:
+            lock, users = self._start_locks[conversation_id]
+            if users == 1:
+                del self._start_locks[conversation_id]
+            else:
+                self._start_locks[conversation_id] = (lock, users - 1)
+
+    def _start_sweeper(self) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.ensure_future(self._sweep())
+
+    async def _sweep(self) -> None:
+        # stops with the last kernel, the next acquire starts it again
+        while self.kernels:
+            await asyncio.sleep(self.sweep_interval)
+            await self.evict_idle()
+
+    async def _get_or_start(self, conversation_id: str, **kwargs: Any) -> Kernel:
+        kernel = self.kernels.get(conversation_id)
+        if kernel is not None and kernel.alive():
+            self.stats.reused += 1
+            return kernel
+        if kernel is not None:
+            del self.kernels[conversation_id]
+
+        while len(self.kernels) >= self.max_kernels:
+            idle = [k for k in self.kernels.values() if not k.checkouts]
+            if not idle:
+                print("kernel pool over capacity", len(self.kernels))
+                break
+            oldest = min(idle, key=lambda k: k.last_used)
+            await self.evict(oldest.conversation_id)
+            self.stats.evicted_capacity += 1
+
+        start = time.monotonic()
+        kernel = await self.backend.start(conversation_id, **kwargs)
+        self.stats.start_seconds.append(time.monotonic() - start)
+        self.stats.started += 1
+        self.kernels[conversation_id] = kernel
+        return kernel
+
+    async def release(self, kernel: Kernel) -> None:
+        """Check the kernel back in, evict it if it has outgrown the memory cap."""
+        kernel.checkouts = max(0, kernel.checkouts - 1)
+        if kernel.memory > self.max_memory and not kernel.checkouts:
+            print("evicting kernel", kernel.conversation_id, "memory", kernel.memory)
+            await self.evict(kernel.conversation_id)
+            self.stats.evicted_memory += 1
+
+    async def execute(
+        self,
+        conversation_id: str,
+        code: str,
+        timeout: float | None = None,
+        max_output_bytes: int | None = None,
+        **kwargs: Any,
+    ) -> ExecutionResult:
+        kernel = await self.acquire(conversation_id, **kwargs)
+        try:
+            return await kernel.execute(code, timeout, max_output_bytes)
+        except KernelDied:
+            await self.evict(conversation_id)
+            raise
+        finally:
+            await self.release(kernel)
+
+    async def evict(self, conversation_id: str) -> None:
+        kernel = self.kernels.pop(conversation_id, None)
+        if kernel is not None:
+            await kernel.close()
+
+    async def evict_idle(self) -> None:
+        now = time.monotonic()
+        for conversation_id, kernel in list(self.kernels.items()):
+            if not kernel.alive() or (
+                not kernel.checkouts and now - kernel.last_used > self.idle_timeout
+            ):
+                await self.evict(conversation_id)
+                self.stats.evicted_idle += 1
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        for conversation_id in list(self.kernels):
+            await self.evict(conversation_id)
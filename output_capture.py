@@ -0,0 +1,185 @@
+"""
+
+Bounded capture of the stdout and stderr of one execution.
+
+Replacing sys.stdout with a StringIO buffers everything a cell prints, so a
+`while True: print(...)` cell grows until the time limit, and it mixes the
+output of executions that run concurrently in one process. Instead, sys.stdout
+and sys.stderr are replaced once by streams that write to the capture of the
+current execution (tracked with a context variable, so each thread or task
+sees its own), or to the original stream outside of any execution.
+
+Each stream keeps at most `head_bytes` from the start of the output and
+`tail_bytes` from its end, in a ring buffer, and counts what was dropped in
+between. Chunks within the head can also be passed to a callback as they are
+written, which is how execution_limits.py streams them to the parent.
+
+    with OutputCapture(head_bytes=10000, tail_bytes=2000) as capture:
+        exec(code)
+    capture.result()  # CapturedOutput(output=..., error=..., dropped=...)
+
+"""
+from __future__ import annotations
+
+import contextvars
+import io
+import sys
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable
+
+STREAMS = ("stdout", "stderr")
+
+_current: contextvars.ContextVar = contextvars.ContextVar("output_capture")
+_install_lock = threading.Lock()
+
+
+class OutputLimitExceeded(Exception):
+    pass
+
+
+@dataclass
+class CapturedOutput:
+    output: str
+    error: str
+    # bytes left out between the head and the tail, over both streams
+    dropped: int = 0
+
+
+class RingCapture:
+    """The head and the tail of a stream, bounded in bytes."""
+
+    def __init__(self, head_bytes: int, tail_bytes: int) -> None:
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head: list[bytes] = []
+        self.head_size = 0
+        self.tail: deque = deque()
+        self.tail_size = 0
+        self.total = 0
+
+    def write(self, data: bytes) -> bytes:
+        """Keep `data` and return the part of it that went to the head."""
+        self.total += len(data)
+        room = max(0, self.head_bytes - self.head_size)
+        kept, data = data[:room], data[room:]
+        if kept:
+            self.head.append(kept)
+            self.head_size += len(kept)
+        if data and self.tail_bytes:
+            self.tail.append(data)
+            self.tail_size += len(data)
+            while self.tail_size > self.tail_bytes:
+                excess = self.tail_size - self.tail_bytes
+                oldest = self.tail.popleft()
+                if len(oldest) > excess:
+                    self.tail.appendleft(oldest[excess:])
+                self.tail_size -= min(len(oldest), excess)
+        return kept
+
+    @property
+    def dropped(self) -> int:
+        return self.total - self.head_size - self.tail_size
+
+    def getvalue(self) -> str:
+        head = b"".join(self.head).decode(errors="replace")
+        tail = b"".join(self.tail).decode(errors="replace")
+        if self.dropped:
+            return f"{head}\n... ({self.dropped} bytes omitted) ...\n{tail}"
+        return head + tail
+
+
+class OutputCapture:
+    """Capture the output of the code run inside the `with` block.
+
+    Arguments:
+        - head_bytes, tail_bytes: kept from the start and the end of each stream.
+        - limit_bytes: raise OutputLimitExceeded in the code once it has printed
+          more than this, to stop runaway loops early.
+        - on_chunk: called with (stream, text) for the text kept in the head.
+
+    """
+
+    def __init__(
+        self,
+        head_bytes: int = 20000,
+        tail_bytes: int = 5000,
+        limit_bytes: int | None = None,
+        on_chunk: Callable[[str, str], Any] | None = None,
+    ) -> None:
+        self.streams = {name: RingCapture(head_bytes, tail_bytes) for name in STREAMS}
+        self.limit_bytes = limit_bytes
+        self.on_chunk = on_chunk
+        self.limit_exceeded = False
+        self._token = None
+
+    def write(self, stream: str, text: str) -> None:
+        capture = self.streams[stream]
+        kept = capture.write(text.encode(errors="replace"))
+        if kept and self.on_chunk is not None:
+            self.on_chunk(stream, kept.decode(errors="ignore"))
+        if (
+            self.limit_bytes is not None
+            and not self.limit_exceeded
+            and self.total > self.limit_bytes
+        ):
+            # only once, the traceback of the exception is printed too
+            self.limit_exceeded = True
+            raise OutputLimitExceeded(
+                f"The code printed more than {self.limit_bytes} bytes."
+            )
+
+    @property
+    def total(self) -> int:
+        return sum(capture.total for capture in self.streams.values())
+
+    def result(self) -> CapturedOutput:
+        return CapturedOutput(
+            output=self.streams["stdout"].getvalue(),
+            error=self.streams["stderr"].getvalue(),
+            dropped=sum(capture.dropped for capture in self.streams.values()),
+        )
+
+    def __enter__(self) -> OutputCapture:
+        install()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        _current.reset(self._token)
+
+
+class _RoutingStream(io.TextIOBase):
+    def __init__(self, name: str, original: Any) -> None:
+        self.name = name
+        self.original = original
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        capture = _current.get(None)
+        if capture is None:
+            return self.original.write(text)
+        capture.write(self.name, text)
+        return len(text)
+
+    def flush(self) -> None:
+        if _current.get(None) is None:
+            self.original.flush()
+
+    def fileno(self) -> int:
+        return self.original.fileno()
+
+    def isatty(self) -> bool:
+        return False
+
+
+def install() -> None:
+    """Route sys.stdout and sys.stderr through the current capture, once."""
+    with _install_lock:
+        for name in STREAMS:
+            stream = getattr(sys, name)
+            if not isinstance(stream, _RoutingStream):
+                setattr(sys, name, _RoutingStream(name, stream))
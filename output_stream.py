@@ -0,0 +1,172 @@
+"""
+
+Helpers to stream the stdout and stderr of running code into a Poe response.
+
+Output arrives as ("stdout", text) and ("stderr", text) events. coalesce_output
+merges them so that the bot sends at most one event per interval, and stops
+forwarding text past a hard byte cap. FencedOutput turns the merged chunks into
+```output and ```error markdown blocks.
+
+"""
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Any, AsyncIterator
+
+STREAMS = ("stdout", "stderr")
+
+
+async def coalesce_output(
+    events: AsyncIterator[tuple[str, Any]],
+    interval: float = 0.5,
+    max_bytes: int | None = None,
+) -> AsyncIterator[tuple[str, Any]]:
+    """Merge consecutive chunks of the same stream.
+
+    Chunks are held for at most `interval` seconds. Once `max_bytes` characters
+    have been forwarded, the rest of the output is dropped and a single
+    ("truncated", dropped) event is yielded at the end. Events that are not
+    stdout or stderr are passed through after the pending text is flushed.
+
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for event in events:
+                await queue.put(event)
+        except BaseException as e:
+            await queue.put(e)
+        finally:
+            await queue.put(done)
+
+    task = asyncio.ensure_future(pump())
+    pending_stream, pending, deadline = None, [], None
+    sent, dropped = 0, 0
+
+    def flush():
+        nonlocal pending_stream, pending
+        chunk = (pending_stream, "".join(pending))
+        pending_stream, pending = None, []
+        return chunk
+
+    try:
+        while True:
+            timeout = None if not pending else max(0.0, deadline - loop.time())
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                yield flush()
+                continue
+            if event is done:
+                break
+            if isinstance(event, BaseException):
+                raise event
+
+            kind, payload = event
+            if kind not in STREAMS:
+                if pending:
+                    yield flush()
+                yield kind, payload
+                continue
+
+            if max_bytes is not None:
+                kept = payload[: max(0, max_bytes - sent)]
+                dropped += len(payload) - len(kept)
+                payload = kept
+            if not payload:
+                continue
+            sent += len(payload)
+            if pending and kind != pending_stream:
+                yield flush()
+            if not pending:
+                pending_stream, deadline = kind, loop.time() + interval
+            pending.append(payload)
+
+        if pending:
+            yield flush()
+        if dropped:
+            yield "truncated", dropped
+    finally:
+        task.cancel()
+
+
+async def stream_sandbox_output(sandbox: Any) -> AsyncIterator[tuple[str, str]]:
+    """Yield the lines of a Modal sandbox's stdout and stderr as they are written."""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def read(name, stream):
+        # sandbox streams are blocking iterators, so each one gets a thread
+        try:
+            for line in stream:
+                loop.call_soon_threadsafe(queue.put_nowait, (name, line))
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    for name in STREAMS:
+        threading.Thread(
+            target=read, args=(name, getattr(sandbox, name)), daemon=True
+        ).start()
+
+    open_streams = len(STREAMS)
+    while open_streams:
+        event = await queue.get()
+        if event is None:
+            open_streams -= 1
+            continue
+        yield event
+    await loop.run_in_executor(None, sandbox.wait)
+
+
+async def iterate_in_thread(iterable: Any) -> AsyncIterator[Any]:
+    """Yield the items of a blocking iterable, e.g. a remote generator."""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    def read():
+        try:
+            for item in iterable:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        item = await queue.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+class FencedOutput:
+    """Render stream chunks as ```output and ```error markdown blocks."""
+
+    FENCES = {"stdout": "output", "stderr": "error"}
+
+    def __init__(self) -> None:
+        self.stream = None
+        self.ends_with_newline = True
+
+    def write(self, stream: str, text: str) -> str:
+        markdown = ""
+        if stream != self.stream:
+            markdown += self.close()
+            markdown += f"\n\n```{self.FENCES[stream]}\n"
+            self.stream = stream
+        self.ends_with_newline = text.endswith("\n")
+        return markdown + text
+
+    def close(self) -> str:
+        if self.stream is None:
+            return ""
+        self.stream = None
+        return ("" if self.ends_with_newline else "\n") + "```\n\n"
@@ -0,0 +1,189 @@
+"""
+
+Prepare the execution environment of an agent request in the background.
+
+The agent loop used to resolve the volume, ingest the attachments, stream the
+model reply and only then start the kernel, so the user waited for each step in
+turn. RequestPrep starts the volume lookup as soon as the request arrives, then
+ingests the attachments and starts (and warms up) the kernel concurrently, all
+while the model reply is streaming. When a code block closes, kernel() returns
+the warm kernel, usually without waiting. The kernel is checked out of the pool
+until the caller releases it; close() releases a kernel that was prepared but
+never handed out.
+
+Each iteration records how long the preparation took, how long the loop still
+had to wait for it, and the difference, which is the wall time saved compared to
+doing the preparation after the code block closed.
+
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from attachment_ingest import IngestResult, ingest_attachments
+from kernel_pool import Kernel, KernelDied, KernelPool
+from tracing import Trace
+from volume_registry import VolumeRegistry
+
+
+@dataclass
+class OverlapRecord:
+    iteration: int
+    # time the background preparation took, and the part the loop waited for
+    prep_seconds: float
+    wait_seconds: float
+
+    @property
+    def saved_seconds(self) -> float:
+        return max(0.0, self.prep_seconds - self.wait_seconds)
+
+
+class RequestPrep:
+    """Volume, attachments and kernel of one request, prepared concurrently.
+
+    Arguments:
+        - volume_name: the volume of the user, mounted at /cache in the kernel.
+        - warmup_code: run on a freshly started kernel, e.g. the common imports.
+
+    """
+
+    def __init__(
+        self,
+        volume_registry: VolumeRegistry,
+        kernel_pool: KernelPool,
+        trace: Trace,
+        volume_name: str,
+        conversation_id: str,
+        attachments: list[Any],
+        warmup_code: str | None = None,
+    ) -> None:
+        self.volume_registry = volume_registry
+        self.kernel_pool = kernel_pool
+        self.trace = trace
+        self.volume_name = volume_name
+        self.conversation_id = conversation_id
+        self.attachments = attachments
+        self.warmup_code = warmup_code
+        self.records: list[OverlapRecord] = []
+        # attachments that could not be ingested, not reported yet
+        self.failed_attachments: list[IngestResult] = []
+        self._volume: asyncio.Future | None = None
+        self._ingest: asyncio.Future | None = None
+        self._kernel: asyncio.Future | None = None
+        self._kernel_started = 0.0
+        self._kernel_ready = 0.0
+        self._ingest_ready = 0.0
+
+    def start(self) -> None:
+        """Start the volume lookup, the ingestion and the kernel warm-up."""
+        self._volume = _background(self._open_volume())
+        self._ingest = _background(self._ingest_attachments())
+        self.warm()
+
+    def warm(self) -> None:
+        """Get the kernel ready for the next code block, called before streaming.
+
+        The pool keeps the kernel between iterations, so this is only a lookup,
+        unless the kernel was evicted after the previous iteration.
+
+        """
+        if self._kernel is None:
+            self._kernel_started = time.monotonic()
+            self._kernel = _background(self._prepare_kernel())
+
+    async def kernel(self, iteration: int) -> Kernel:
+        """The warm kernel, with the attachments in its volume."""
+        self.warm()
+        start = time.monotonic()
+        with self.trace.span("prep_wait", iteration=iteration) as span:
+            await self._ingest
+            kernel = await self._kernel
+            # the next iteration checks again, the kernel may get evicted
+            self._kernel = None
+            ready = max(self._ingest_ready, self._kernel_ready)
+            record = OverlapRecord(
+                iteration=iteration,
+                prep_seconds=ready - self._kernel_started,
+                wait_seconds=time.monotonic() - start,
+            )
+            span.attributes["prep_ms"] = record.prep_seconds * 1000
+            span.attributes["saved_ms"] = record.saved_seconds * 1000
+        self.records.append(record)
+        return kernel
+
+    def close(self) -> None:
+        """Check in the kernel prepared for an iteration that did not come."""
+        task, self._kernel = self._kernel, None
+        if task is not None:
+            _background(self._release(task))
+
+    async def _release(self, task: asyncio.Future) -> None:
+        try:
+            kernel = await task
+        except Exception:
+            return
+        await self.kernel_pool.release(kernel)
+
+    async def _open_volume(self) -> Any:
+        with self.trace.span("volume_lookup"):
+            return await self.volume_registry.get(self.volume_name)
+
+    def take_failed_attachments(self) -> list[IngestResult]:
+        """The attachments that failed since the last call."""
+        failed, self.failed_attachments = self.failed_attachments, []
+        return failed
+
+    async def _ingest_attachments(self) -> None:
+        # never raises, a failed attachment must not stop the request
+        try:
+            volume = await self._volume
+            with self.trace.span(
+                "attachment_upload", attachments=len(self.attachments)
+            ):
+                results = await ingest_attachments(self.attachments, volume)
+        except Exception as e:
+            results = [
+                IngestResult(attachment.name, "", 0, uploaded=False, error=repr(e))
+                for attachment in self.attachments
+            ]
+        for ingested in results:
+            print("attachment", ingested)
+            if ingested.error is not None:
+                self.failed_attachments.append(ingested)
+        self._ingest_ready = time.monotonic()
+
+    async def _prepare_kernel(self) -> Kernel:
+        volume = await self._volume
+        with self.trace.span("sandbox_spawn") as span:
+            kernel = await self.kernel_pool.acquire(
+                self.conversation_id, network_file_systems={"/cache": volume}
+            )
+            span.attributes["warm"] = kernel.executions > 0
+        if self.warmup_code and kernel.executions == 0:
+            with self.trace.span("kernel_warmup"):
+                try:
+                    await kernel.execute(self.warmup_code)
+                except KernelDied as e:
+                    # the warm-up is only a head start, get a new kernel without it
+                    print("kernel warm-up failed", repr(e))
+                    await self.kernel_pool.release(kernel)
+                    kernel = await self.kernel_pool.acquire(
+                        self.conversation_id, network_file_systems={"/cache": volume}
+                    )
+        self._kernel_ready = time.monotonic()
+        return kernel
+
+
+def _background(coroutine: Any) -> asyncio.Future:
+    task = asyncio.ensure_future(coroutine)
+    task.add_done_callback(_log_failure)
+    return task
+
+
+def _log_failure(task: asyncio.Future) -> None:
+    # the request may end before the task is awaited, e.g. when there is no code
+    if not task.cancelled() and task.exception() is not None:
+        print("background preparation failed", repr(task.exception()))
@@ -0,0 +1,681 @@
+"""
+
+Cache of execution results for the stateless code bots.
+
+RunPythonCode and matplotlib run every message in a fresh execution, so the
+same code (the plot of a popular prompt, the same test snippet) gives the same
+result every time, and was executed every time. ResultCache keys results by
+the hash of the code text, the function, its other arguments and
+EXECUTOR_VERSION, and keeps them for `ttl` seconds, evicting the least recently
+used ones beyond `max_entries` or `max_bytes`. Only trailing whitespace is
+ignored: the results are shared by all users, and tracebacks quote the source
+lines and their numbers.
+
+Code is only cached when its result can be expected to be the same next time:
+everything it uses from modules and builtins must be on an allowlist of pure
+functions (PURE_NAMES and PURE_BUILTINS), and it must not mention a URL.
+Anything else bypasses the cache.
+
+    cache = ResultCache(ttl=3600)
+    output = await cache.call(executor, "execute_code", code, timeout=40)
+    cache.stats.hit_ratio, cache.stats.saved_seconds
+
+"""
+from __future__ import annotations
+
+import ast
+import hashlib
+import os
+import pickle
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable
+
+from executor_client import EXECUTOR_VERSION, ExecutorClient
+
+# what cacheable code may take from modules, each name with everything under
+# it; any other module member, e.g. numpy.random, pandas.Timestamp or
+# seaborn.load_dataset, makes the code uncacheable
+PURE_NAMES = {
+    # modules without clocks, randomness or I/O
+    "bisect",
+    "cmath",
+    "collections",
+    "copy",
+    "dataclasses",
+    "decimal",
+    "enum",
+    "fractions",
+    "functools",
+    "heapq",
+    "itertools",
+    "json",
+    "math",
+    "operator",
+    "re",
+    "statistics",
+    "string",
+    "textwrap",
+    "typing",
+    # drawing, the figures of the same calls are the same
+    "matplotlib.cm",
+    "matplotlib.colors",
+    "matplotlib.gridspec",
+    "matplotlib.lines",
+    "matplotlib.patches",
+    "matplotlib.pyplot",
+    "matplotlib.ticker",
+    "matplotlib.use",
+    "mpl_toolkits.basemap.Basemap",
+    "mpl_toolkits.mplot3d",
+    # seaborn without the plots that bootstrap their error bars
+    *(
+        f"seaborn.{name}"
+        for name in (
+            "boxplot",
+            "color_palette",
+            "countplot",
+            "heatmap",
+            "histplot",
+            "jointplot",
+            "kdeplot",
+            "pairplot",
+            "scatterplot",
+            "set",
+            "set_palette",
+            "set_style",
+            "set_theme",
+            "violinplot",
+        )
+    ),
+    "numpy.fft",
+    "numpy.linalg",
+    *(
+        f"numpy.{name}"
+        for name in (
+            "abs",
+            "allclose",
+            "arange",
+            "arccos",
+            "arcsin",
+            "arctan",
+            "arctan2",
+            "argmax",
+            "argmin",
+            "argsort",
+            "array",
+            "asarray",
+            "ceil",
+            "clip",
+            "column_stack",
+            "concatenate",
+            "cos",
+            "cosh",
+            "cross",
+            "cumprod",
+            "cumsum",
+            "diff",
+            "dot",
+            "e",
+            "exp",
+            "eye",
+            "float32",
+            "float64",
+            "floor",
+            "full",
+            "full_like",
+            "gradient",
+            "histogram",
+            "hstack",
+            "identity",
+            "inf",
+            "int32",
+            "int64",
+            "interp",
+            "isclose",
+            "isnan",
+            "linspace",
+            "log",
+            "log10",
+            "log2",
+            "logspace",
+            "matmul",
+            "max",
+            "maximum",
+            "mean",
+            "median",
+            "meshgrid",
+            "min",
+            "minimum",
+            "mod",
+            "nan",
+            "ndarray",
+            "newaxis",
+            "ones",
+            "ones_like",
+            "outer",
+            "percentile",
+            "pi",
+            "polyfit",
+            "polyval",
+            "power",
+            "prod",
+            "quantile",
+            "reshape",
+            "round",
+            "set_printoptions",
+            "sin",
+            "sinh",
+            "sort",
+            "sqrt",
+            "stack",
+            "std",
+            "sum",
+            "tan",
+            "tanh",
+            "transpose",
+            "unique",
+            "var",
+            "vstack",
+            "where",
+            "zeros",
+            "zeros_like",
+        )
+    ),
+    *(
+        f"pandas.{name}"
+        for name in (
+            "Categorical",
+            "DataFrame",
+            "Index",
+            "MultiIndex",
+            "NA",
+            "Series",
+            "concat",
+            "crosstab",
+            "cut",
+            "get_dummies",
+            "isna",
+            "melt",
+            "merge",
+            "notna",
+            "options",
+            "pivot_table",
+            "qcut",
+            "set_option",
+        )
+    ),
+    "scipy.constants",
+    "scipy.integrate",
+    "scipy.interpolate",
+    "scipy.special",
+    *(
+        f"scipy.linalg.{name}"
+        for name in (
+            "cholesky",
+            "det",
+            "eig",
+            "eigh",
+            "expm",
+            "inv",
+            "lu",
+            "norm",
+            "qr",
+            "solve",
+            "svd",
+        )
+    ),
+    *(
+        f"scipy.optimize.{name}"
+        for name in (
+            "brentq",
+            "curve_fit",
+            "fsolve",
+            "least_squares",
+            "linprog",
+            "minimize",
+            "minimize_scalar",
+            "root",
+            "root_scalar",
+        )
+    ),
+    *(
+        f"scipy.stats.{name}"
+        for name in (
+            "chi2_contingency",
+            "describe",
+            "kurtosis",
+            "linregress",
+            "pearsonr",
+            "skew",
+            "spearmanr",
+            "ttest_1samp",
+            "ttest_ind",
+            "ttest_rel",
+            "zscore",
+        )
+    ),
+    # the functions of the distributions, not their samples
+    *(
+        f"scipy.stats.{distribution}.{function}"
+        for distribution in (
+            "beta",
+            "binom",
+            "chi2",
+            "expon",
+            "gamma",
+            "norm",
+            "poisson",
+            "t",
+            "uniform",
+        )
+        for function in (
+            "cdf",
+            "interval",
+            "logpdf",
+            "mean",
+            "pdf",
+            "pmf",
+            "ppf",
+            "sf",
+            "std",
+            "var",
+        )
+    ),
+    *(
+        f"sympy.{name}"
+        for name in (
+            "E",
+            "Eq",
+            "Function",
+            "Matrix",
+            "N",
+            "Rational",
+            "Symbol",
+            "binomial",
+            "cos",
+            "diff",
+            "dsolve",
+            "exp",
+            "expand",
+            "factor",
+            "factorial",
+            "factorint",
+            "gcd",
+            "integrate",
+            "isprime",
+            "latex",
+            "lcm",
+            "limit",
+            "log",
+            "nsimplify",
+            "oo",
+            "pi",
+            "pprint",
+            "prime",
+            "primerange",
+            "series",
+            "simplify",
+            "sin",
+            "solve",
+            "sqrt",
+            "summation",
+            "symbols",
+        )
+    ),
+}
+
+# the packages cacheable code may import
+PURE_PACKAGES = {name.split(".")[0] for name in PURE_NAMES}
+
+# the builtins cacheable code may use; not set or frozenset, whose order of
+# strings changes from one process to the next, nor hash, id, open, eval or
+# getattr and the like
+PURE_BUILTINS = {
+    "ArithmeticError",
+    "AssertionError",
+    "Exception",
+    "IndexError",
+    "KeyError",
+    "NotImplementedError",
+    "RuntimeError",
+    "StopIteration",
+    "TypeError",
+    "ValueError",
+    "ZeroDivisionError",
+    "__name__",
+    "abs",
+    "all",
+    "any",
+    "bin",
+    "bool",
+    "bytes",
+    "chr",
+    "classmethod",
+    "complex",
+    "dict",
+    "divmod",
+    "enumerate",
+    "filter",
+    "float",
+    "format",
+    "hex",
+    "int",
+    "isinstance",
+    "issubclass",
+    "iter",
+    "len",
+    "list",
+    "map",
+    "max",
+    "min",
+    "next",
+    "object",
+    "oct",
+    "ord",
+    "pow",
+    "print",
+    "property",
+    "range",
+    "repr",
+    "reversed",
+    "round",
+    "slice",
+    "sorted",
+    "staticmethod",
+    "str",
+    "sum",
+    "super",
+    "tuple",
+    "type",
+    "zip",
+}
+
+# methods that give a different result on every call, whatever the object
+# (the type of a value is not known here, e.g. DataFrame.sample)
+VOLATILE_METHODS = {
+    "choice",
+    "now",
+    "permutation",
+    "random",
+    "rvs",
+    "sample",
+    "shuffle",
+    "today",
+}
+
+
+def normalize_code(code: str) -> str:
+    """`code` without trailing whitespace, which does not change its output."""
+    return "\n".join(line.rstrip() for line in code.rstrip().splitlines())
+
+
+def _is_pure(name: str) -> bool:
+    parts = name.split(".")
+    return any(".".join(parts[:i]) in PURE_NAMES for i in range(1, len(parts) + 1))
+
+
+def _names(tree: ast.AST) -> tuple[dict[str, str], set[str]]:
+    # (the module member each imported name stands for, the names the code binds)
+    imported: dict[str, str] = {}
+    bound: set[str] = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.asname:
+                    imported[alias.asname] = alias.name
+                else:
+                    top = alias.name.split(".")[0]
+                    imported[top] = top
+        elif isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                imported[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+        elif isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            bound.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+    return imported, bound
+
+
+def uncacheable_reason(code: str) -> str | None:
+    """Why the result of `code` must not be cached, or None.
+
+    Code is cacheable when everything it uses from modules is in PURE_NAMES
+    and every builtin it uses is in PURE_BUILTINS.
+
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # the error is the result, and it does not change
+        return None
+    imported, bound = _names(tree)
+    # the Name at the start of each a.b.c chain, and the inner parts of chains
+    roots, inner = {}, set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute):
+            if node.attr.startswith("__") or node.attr in VOLATILE_METHODS:
+                return f"uses {node.attr}"
+            if isinstance(node.value, ast.Attribute):
+                inner.add(id(node.value))
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and id(node) not in inner:
+            attributes, value = [], node
+            while isinstance(value, ast.Attribute):
+                attributes.append(value.attr)
+                value = value.value
+            if isinstance(value, ast.Name):
+                roots[id(value)] = ".".join(reversed(attributes))
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            if isinstance(node, ast.ImportFrom) and (node.level or not node.module):
+                return "relative import"
+            for alias in node.names:
+                module = getattr(node, "module", None) or alias.name
+                if alias.name == "*":
+                    return f"imports * from {module}"
+                if module.split(".")[0] not in PURE_PACKAGES:
+                    return f"imports {module}"
+        elif isinstance(node, (ast.Set, ast.SetComp)):
+            return "uses a set"
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            if node.id in imported:
+                name = imported[node.id]
+                if id(node) in roots:
+                    name = f"{name}.{roots[id(node)]}"
+                if not _is_pure(name):
+                    return f"uses {name}"
+            elif node.id not in bound and node.id not in PURE_BUILTINS:
+                return f"uses {node.id}"
+        elif (
+            isinstance(node, ast.Constant)
+            and isinstance(node.value, str)
+            and "://" in node.value
+        ):
+            return "mentions a URL"
+    return None
+
+
+def within_limits(value: Any) -> bool:
+    """Whether an execution ran without hitting a limit or being killed.
+
+    `value` is what an execution function returned, ending with its metering,
+    or the items of its stream, ending with ("result", {"metering": ...}).
+    Hitting a limit can be down to load, such results are not cached.
+
+    """
+    if isinstance(value, list):
+        kind, payload = value[-1] if value else (None, None)
+        if kind != "result":
+            return False
+        metering = payload["metering"]
+    else:
+        metering = value[-1]
+    return metering["limit_exceeded"] is None and metering.get("killed_by") is None
+
+
+@dataclass
+class ResultCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # code that is not cacheable
+    bypassed: int = 0
+    evicted: int = 0
+    # execution time that the hits did not spend
+    saved_seconds: float = 0.0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+@dataclass
+class _Entry:
+    value: Any
+    size: int
+    seconds: float
+    expires: float
+
+
+class ResultCache:
+    """Results by code, for `ttl` seconds, at most `max_entries` and `max_bytes`."""
+
+    def __init__(
+        self,
+        ttl: float = 60 * 60,
+        max_entries: int = 512,
+        max_bytes: int = 256 * 1024 * 1024,
+        version: str = EXECUTOR_VERSION,
+    ) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version = version
+        self.stats = ResultCacheStats()
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._size = 0
+
+    def key(self, name: str, code: str, args: tuple) -> str:
+        digest = hashlib.sha256()
+        for part in (self.version, name, repr(args), normalize_code(code)):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _get(self, key: str) -> _Entry | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, value: Any, seconds: float) -> None:
+        size = len(pickle.dumps(value))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = _Entry(value, size, seconds, time.monotonic() + self.ttl)
+        self._size += size
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.stats.evicted += 1
+
+    def _remove(self, key: str) -> None:
+        self._size -= self._entries.pop(key).size
+
+    def _lookup(
+        self, name: str, code: str, args: tuple
+    ) -> tuple[str | None, _Entry | None]:
+        # (key, entry), the key is None when the code bypasses the cache
+        reason = uncacheable_reason(code)
+        if reason is not None:
+            self.stats.bypassed += 1
+            print("result_cache bypass", reason)
+            return None, None
+        key = self.key(name, code, args)
+        entry = self._get(key)
+        if entry is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+            self.stats.saved_seconds += entry.seconds
+        return key, entry
+
+    async def call(
+        self,
+        executor: ExecutorClient,
+        name: str,
+        code: str,
+        *args: Any,
+        timeout: float | None = None,
+        cacheable: Callable[[Any], bool] = lambda value: True,
+    ) -> Any:
+        """executor.call(name, code, *args), from the cache when possible.
+
+        Results for which `cacheable` returns False are not stored.
+
+        """
+        key, entry = self._lookup(name, code, args)
+        if entry is not None:
+            return entry.value
+        start = time.monotonic()
+        value = await executor.call(name, code, *args, timeout=timeout)
+        if key is not None and cacheable(value):
+            self.put(key, value, time.monotonic() - start)
+        return value
+
+    async def stream(
+        self,
+        executor: ExecutorClient,
+        name: str,
+        code: str,
+        *args: Any,
+        timeout: float | None = None,
+        cacheable: Callable[[list], bool] = lambda items: True,
+    ) -> AsyncIterator[Any]:
+        """executor.stream(name, code, *args), replayed from the cache when possible.
+
+        Only complete streams for which `cacheable` returns True are stored.
+
+        """
+        key, entry = self._lookup(name, code, args)
+        if entry is not None:
+            for item in entry.value:
+                yield item
+            return
+        start = time.monotonic()
+        items = []
+        async for item in executor.stream(name, code, *args, timeout=timeout):
+            items.append(item)
+            yield item
+        if key is not None and cacheable(items):
+            self.put(key, items, time.monotonic() - start)
+
+
+def result_cache_environment() -> dict[str, str]:
+    """The EXECUTION_CACHE_* variables set at deploy time, to pass on to the app."""
+    return {
+        name: value
+        for name, value in os.environ.items()
+        if name.startswith("EXECUTION_CACHE_")
+    }
+
+
+def result_cache_from_environment() -> ResultCache | None:
+    """A cache if EXECUTION_CACHE_TTL is set (seconds), else None."""
+    ttl = os.environ.get("EXECUTION_CACHE_TTL")
+    if not ttl:
+        return None
+    return ResultCache(
+        ttl=float(ttl), max_entries=int(os.environ.get("EXECUTION_CACHE_ENTRIES", 512))
+    )
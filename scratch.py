@@ -0,0 +1,98 @@
+"""
+
+Scratch directory of one execution.
+
+Executions that write files used to share the working directory of the
+container: two concurrent plots both wrote image.png, and a module written by
+one execution could be imported by another. Each execution now runs in a
+directory of its own, which is its working directory, the first entry of its
+import path and its TMPDIR. The files it leaves there can be collected, and
+the directory is removed when the execution is done.
+
+    with ScratchDirectory() as scratch:
+        run_forked(scratch.wrap(function), limits)
+        images = scratch.collect(IMAGE_EXTENSIONS)
+
+"""
+from __future__ import annotations
+
+import importlib
+import os
+import shutil
+import stat
+import sys
+import tempfile
+from dataclasses import dataclass
+from typing import Any, Callable, Sequence
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg")
+
+
+@dataclass
+class ScratchFile:
+    # relative to the scratch directory
+    name: str
+    data: bytes
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+class ScratchDirectory:
+    """A new directory in `root`, removed on exit."""
+
+    def __init__(self, root: str | None = None) -> None:
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix="exec-", dir=root)
+
+    def enter(self) -> None:
+        """Make the directory the working directory, call in the child."""
+        os.chdir(self.path)
+        sys.path.insert(0, self.path)
+        os.environ["TMPDIR"] = self.path
+        tempfile.tempdir = self.path
+        importlib.invalidate_caches()
+
+    def wrap(self, function: Callable[[], Any]) -> Callable[[], Any]:
+        def run() -> Any:
+            self.enter()
+            return function()
+
+        return run
+
+    def collect(
+        self,
+        extensions: Sequence[str],
+        max_files: int = 10,
+        max_bytes: int = 20 * 1024 * 1024,
+    ) -> list[ScratchFile]:
+        """The regular files with one of `extensions`, oldest first."""
+        found = []
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(directory, name)
+                info = os.lstat(path)
+                # links could point anywhere in the container
+                if not stat.S_ISREG(info.st_mode):
+                    continue
+                if os.path.splitext(name)[1].lower() in extensions:
+                    found.append((info.st_mtime, path, info.st_size))
+        files, total = [], 0
+        for _, path, size in sorted(found)[:max_files]:
+            if total + size > max_bytes:
+                break
+            with open(path, "rb") as f:
+                files.append(ScratchFile(os.path.relpath(path, self.path), f.read()))
+            total += size
+        return files
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self) -> ScratchDirectory:
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.cleanup()
@@ -0,0 +1,212 @@
+"""
+
+Incremental session snapshots for the Python agents.
+
+Instead of pickling the whole __main__ namespace after every cell, only the globals
+that the cell created, rebound or visibly mutated are serialized, one object per
+entry, into a content-addressed directory. A manifest maps each global to the
+digest of its entry, so unchanged objects are never pickled again and a restore
+only reads the entries that differ from what is already loaded.
+
+The source of this module is injected into the execution kernel by the session
+wrapper, so it must only depend on the standard library and dill.
+
+"""
+from __future__ import annotations
+
+import ast
+import hashlib
+import json
+import os
+import sys
+import types
+
+# method calls that usually mutate their receiver in place
+MUTATING_METHODS = {
+    "add",
+    "append",
+    "clear",
+    "discard",
+    "extend",
+    "fit",
+    "insert",
+    "partial_fit",
+    "pop",
+    "popitem",
+    "remove",
+    "reverse",
+    "setdefault",
+    "sort",
+    "update",
+}
+
+_stores = {}
+
+
+def open_store(root):
+    """Return the store for `root`, reusing it within the same interpreter."""
+    root = os.path.abspath(root)
+    if root not in _stores:
+        _stores[root] = SnapshotStore(root)
+    return _stores[root]
+
+
+def _is_session_name(name):
+    return not (name.startswith("__") and name.endswith("__"))
+
+
+def mutated_names(code):
+    """Names that the cell stores into or calls a mutating method on."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set()
+
+    def base_name(node):
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        return node.id if isinstance(node, ast.Name) else None
+
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Attribute, ast.Subscript)) and isinstance(
+            node.ctx, (ast.Store, ast.Del)
+        ):
+            names.add(base_name(node))
+        elif isinstance(node, ast.AugAssign):
+            names.add(base_name(node.target))
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            inplace = any(
+                keyword.arg == "inplace"
+                and getattr(keyword.value, "value", None) is True
+                for keyword in node.keywords
+            )
+            if inplace or node.func.attr in MUTATING_METHODS:
+                names.add(base_name(node.func.value))
+        elif isinstance(node, ast.Global):
+            names.update(node.names)
+    names.discard(None)
+    return names
+
+
+class SnapshotStore:
+    """Content-addressed snapshot of a session namespace.
+
+    Layout of `root`:
+        - manifest.json: {name: digest or "module:<module name>"}
+        - objects/<digest>: the dill pickle of a single global
+
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.manifest_path = os.path.join(root, "manifest.json")
+        # what the namespace holds right now, as far as this store knows
+        self.loaded = {}
+        self.identities = {}
+        # id of the globals that could not be pickled, retried once rebound
+        self.unpicklable = {}
+        self.stats = {"restored": 0, "saved": 0, "unchanged": 0, "skipped": 0}
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def restore(self, namespace):
+        """Load the entries of the manifest that differ from the namespace."""
+        import dill
+
+        for name, digest in self.read_manifest().items():
+            if self.loaded.get(name) == digest and name in namespace:
+                continue
+            try:
+                if digest.startswith("module:"):
+                    module = digest.split(":", 1)[1]
+                    __import__(module)
+                    value = sys.modules[module]
+                else:
+                    with open(os.path.join(self.objects, digest), "rb") as f:
+                        value = dill.load(f)
+            except Exception as e:
+                print(f"Could not restore {name}: {e}", file=sys.stderr)
+                continue
+            namespace[name] = value
+            self.loaded[name] = digest
+            self.identities[name] = id(value)
+            self.stats["restored"] += 1
+
+    def begin(self, namespace):
+        """Remember the identity of every global before the cell runs."""
+        self.identities = {
+            name: id(value)
+            for name, value in namespace.items()
+            if _is_session_name(name)
+        }
+
+    def dirty_names(self, namespace, code=""):
+        mutated = mutated_names(code)
+        return [
+            name
+            for name, value in namespace.items()
+            if _is_session_name(name)
+            and self.unpicklable.get(name) != id(value)
+            and (
+                self.identities.get(name) != id(value)
+                or name in mutated
+                or name not in self.loaded
+            )
+        ]
+
+    def commit(self, namespace, code=""):
+        """Serialize the globals the cell touched and rewrite the manifest."""
+        import dill
+
+        os.makedirs(self.objects, exist_ok=True)
+        manifest = {
+            name: digest for name, digest in self.loaded.items() if name in namespace
+        }
+        self.unpicklable = {
+            name: identity
+            for name, identity in self.unpicklable.items()
+            if id(namespace.get(name)) == identity
+        }
+        for name in self.dirty_names(namespace, code):
+            value = namespace[name]
+            if isinstance(value, types.ModuleType):
+                manifest[name] = self.loaded[name] = "module:" + value.__name__
+                continue
+            try:
+                data = dill.dumps(value)
+            except Exception:
+                # open files, sockets, generators and the like cannot be kept
+                self.stats["skipped"] += 1
+                self.unpicklable[name] = id(value)
+                manifest.pop(name, None)
+                self.loaded.pop(name, None)
+                continue
+            digest = hashlib.sha256(data).hexdigest()
+            path = os.path.join(self.objects, digest)
+            if os.path.exists(path):
+                self.stats["unchanged"] += 1
+            else:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+                self.stats["saved"] += 1
+            manifest[name] = self.loaded[name] = digest
+
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+        # entries that no global refers to anymore
+        referenced = set(manifest.values())
+        for digest in os.listdir(self.objects):
+            if digest not in referenced and not digest.endswith(".tmp"):
+                os.remove(os.path.join(self.objects, digest))
+
+        self.begin(namespace)
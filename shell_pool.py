@@ -0,0 +1,148 @@
+"""
+
+Pool of pre-initialized IPython shells for the execution functions.
+
+Building the traitlets config and the InteractiveShellEmbed, and importing the
+usual packages in the first cell, costs hundreds of milliseconds on every call.
+The pool creates the shells once per container, imports the preload modules
+once, and hands the shells out per call. When a call is done, the shell is
+reset to a clean namespace before it goes back to the pool. A shell lent to
+a forked child goes back as it is, only the child's copy ran the cell.
+
+    pool = ShellPool(preload=["numpy", "pandas", "matplotlib.pyplot"])
+    with pool.shell() as ipython:
+        ipython.run_cell(code, silent=True, store_history=False)
+
+"""
+from __future__ import annotations
+
+import contextlib
+import importlib
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Sequence
+
+from execution_limits import drop_harness_frames
+
+
+@dataclass
+class ShellPoolStats:
+    # calls served by a shell that was already in the pool
+    hits: int = 0
+    misses: int = 0
+    resets: int = 0
+    preload_seconds: float = 0.0
+    creation_seconds: list = field(default_factory=list)
+
+
+def create_shell() -> Any:
+    import traitlets.config
+    from IPython.terminal.embed import InteractiveShellEmbed
+
+    config = traitlets.config.Config()
+    config.InteractiveShell.colors = "NoColor"
+    # the cells are not stored, and the history database only works in the
+    # thread that created the shell
+    config.HistoryManager.enabled = False
+    # config.PlainTextFormatter.max_width = 40  # not working
+    # config.InteractiveShell.width = 40  # not working
+    shell = InteractiveShellEmbed(config=config)
+
+    # tracebacks go to stderr, so that callers can tell them from the output
+    def show_traceback(etype, evalue, stb):
+        print(shell.InteractiveTB.stb2text(stb), file=sys.stderr)
+
+    shell._showtraceback = show_traceback
+
+    # the limits of the execution raise from their own frames
+    showtraceback = shell.showtraceback
+
+    def show_traceback_in_code(exc_tuple=None, *args, **kwargs):
+        drop_harness_frames((exc_tuple or sys.exc_info())[2])
+        return showtraceback(exc_tuple, *args, **kwargs)
+
+    shell.showtraceback = show_traceback_in_code
+    return shell
+
+
+class ShellPool:
+    """Shells handed out one call at a time.
+
+    Arguments:
+        - size: shells created up front, more are created if they are all busy.
+        - preload: modules imported once, so that importing them in a cell is
+          a lookup in sys.modules.
+
+    """
+
+    def __init__(self, size: int = 1, preload: Sequence[str] = ()) -> None:
+        self.preload = list(preload)
+        self.stats = ShellPoolStats()
+        self._idle: list[Any] = []
+        self._lock = threading.Lock()
+        # pyplot.show as matplotlib defines it, cells tend to patch it
+        self._pyplot_show = None
+
+        start = time.monotonic()
+        for name in self.preload:
+            try:
+                importlib.import_module(name)
+            except ImportError as e:
+                print("cannot preload", name, e)
+        self._remember_pyplot()
+        self.stats.preload_seconds = time.monotonic() - start
+
+        for _ in range(size):
+            self._idle.append(self._create())
+
+    def _create(self) -> Any:
+        start = time.monotonic()
+        shell = create_shell()
+        self.stats.creation_seconds.append(time.monotonic() - start)
+        return shell
+
+    def _remember_pyplot(self) -> None:
+        pyplot = sys.modules.get("matplotlib.pyplot")
+        if pyplot is not None and self._pyplot_show is None:
+            self._pyplot_show = pyplot.show
+
+    def acquire(self) -> Any:
+        self._remember_pyplot()
+        with self._lock:
+            if self._idle:
+                self.stats.hits += 1
+                return self._idle.pop()
+            self.stats.misses += 1
+        return self._create()
+
+    def release(self, shell: Any) -> None:
+        """Reset the shell to a clean namespace and return it to the pool."""
+        shell.reset(new_session=False)
+        pyplot = sys.modules.get("matplotlib.pyplot")
+        if pyplot is not None:
+            pyplot.close("all")
+            if self._pyplot_show is not None:
+                pyplot.show = self._pyplot_show
+        with self._lock:
+            self.stats.resets += 1
+            self._idle.append(shell)
+
+    @contextlib.contextmanager
+    def shell(self) -> Iterator[Any]:
+        shell = self.acquire()
+        try:
+            yield shell
+        finally:
+            self.release(shell)
+
+    @contextlib.contextmanager
+    def lend(self) -> Iterator[Any]:
+        """A shell for a forked child, returned to the pool without a reset."""
+        shell = self.acquire()
+        try:
+            yield shell
+        finally:
+            with self._lock:
+                self._idle.append(shell)
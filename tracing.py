@@ -0,0 +1,229 @@
+"""
+
+Lightweight tracing for the bots.
+
+A Trace groups the spans of one request and tags all of them with the same
+attributes (e.g. conversation_id). Every finished span is added to a per-phase
+histogram on the Tracer, and handed to the exporters, which write JSON lines
+either as plain records or as OpenTelemetry (OTLP/JSON) span records.
+
+    tracer = Tracer(exporters=[JsonLinesExporter("spans.jsonl")])
+    trace = tracer.trace(conversation_id="c1")
+    with trace.span("execution", iteration=0):
+        ...
+    tracer.summary()  # {"execution": {"count": 1, "p50_ms": ..., ...}}
+    tracer.log_summary()
+
+"""
+from __future__ import annotations
+
+import bisect
+import contextlib
+import json
+import os
+import secrets
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import IO, Any, Iterator
+
+# upper bounds of the histogram buckets, in milliseconds
+BUCKET_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    start_ns: int
+    end_ns: int = 0
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def to_record(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": self.duration * 1000,
+            "attributes": self.attributes,
+        }
+
+    def to_otel(self) -> dict:
+        """The span in the OTLP/JSON encoding."""
+
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": k, "value": value(v)} for k, v in self.attributes.items()
+            ],
+        }
+
+
+class PhaseHistogram:
+    """Bucketed durations of one phase, plus the recent samples for percentiles."""
+
+    def __init__(self, max_samples: int = 10000) -> None:
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.samples: deque = deque(maxlen=max_samples)
+
+    def record(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, seconds * 1000)] += 1
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": max(self.samples, default=0.0) * 1000,
+            "buckets": {
+                **{
+                    f"le_{bound}": n for bound, n in zip(BUCKET_BOUNDS_MS, self.buckets)
+                },
+                "le_inf": self.buckets[-1],
+            },
+        }
+
+
+class JsonLinesExporter:
+    """Write each span as one JSON line to a path or an open text stream."""
+
+    def __init__(self, target: str | IO[str], otel: bool = False) -> None:
+        self.stream = open(target, "a") if isinstance(target, str) else target
+        self.otel = otel
+
+    def export(self, span: Span) -> None:
+        record = span.to_otel() if self.otel else span.to_record()
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+
+class Trace:
+    def __init__(self, tracer: Tracer, **attributes: Any) -> None:
+        self.tracer = tracer
+        self.trace_id = secrets.token_hex(16)
+        self.attributes = attributes
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Time the block. Attributes can be added to the span inside it."""
+        span = Span(
+            name=name,
+            trace_id=self.trace_id,
+            span_id=secrets.token_hex(8),
+            start_ns=time.time_ns(),
+            attributes={**self.attributes, **attributes},
+        )
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            self.tracer.record(span)
+
+    def add(self, name: str, seconds: float, **attributes: Any) -> Span:
+        """Record a phase that was timed elsewhere and ended just now."""
+        end_ns = time.time_ns()
+        span = Span(
+            name=name,
+            trace_id=self.trace_id,
+            span_id=secrets.token_hex(8),
+            start_ns=end_ns - int(seconds * 1e9),
+            end_ns=end_ns,
+            attributes={**self.attributes, **attributes},
+        )
+        self.tracer.record(span)
+        return span
+
+
+class Tracer:
+    def __init__(self, exporters: list | None = None, max_spans: int = 10000) -> None:
+        self.exporters = exporters or []
+        self.spans: deque = deque(maxlen=max_spans)
+        self.histograms: dict[str, PhaseHistogram] = {}
+
+    def trace(self, **attributes: Any) -> Trace:
+        return Trace(self, **attributes)
+
+    def record(self, span: Span) -> None:
+        self.spans.append(span)
+        self.histograms.setdefault(span.name, PhaseHistogram()).record(span.duration)
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                print("span export failed", e, file=sys.stderr)
+
+    def summary(self) -> dict:
+        return {name: h.to_dict() for name, h in sorted(self.histograms.items())}
+
+    def log_summary(self) -> None:
+        print("tracing", json.dumps(self.summary()))
+
+    def to_otlp(self, service_name: str = "poe-bot") -> dict:
+        """The recent spans as an OTLP/JSON export request."""
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "tracing"},
+                            "spans": [span.to_otel() for span in self.spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+
+def tracer_from_environment() -> Tracer:
+    """Export to TRACE_EXPORT_PATH (OTLP records if TRACE_EXPORT_OTEL is set)."""
+    path = os.environ.get("TRACE_EXPORT_PATH")
+    if not path:
+        return Tracer()
+    otel = bool(os.environ.get("TRACE_EXPORT_OTEL"))
+    return Tracer(exporters=[JsonLinesExporter(path, otel=otel)])
@@ -0,0 +1,220 @@
+"""
+
+Content-addressed cache of uploaded files.
+
+Popular prompts produce byte-identical images again and again, and each of them
+was uploaded to Cloudinary anew. UploadCache keys uploads by the SHA-256 of
+their bytes: a repeat returns the URL of the first upload. URLs are kept in a
+bounded in-memory LRU, and in a persistent index shared by the containers of
+the upload function (a directory on a network file system).
+
+CloudinaryStorage uploads to Cloudinary. LocalDirectoryStorage writes the files
+to a local directory, so the whole path can be exercised without Cloudinary.
+
+    cache = UploadCache(LocalDirectoryStorage("/tmp/uploads"), DirectoryIndex("/tmp/index"))
+    url = cache.upload(data, "image.png")
+    urls = cache.upload_many([(png, "a.png"), (svg, "b.svg")])
+
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Union
+
+# bytes, or a stream read into memory
+FileData = Union[bytes, bytearray, memoryview, BinaryIO]
+
+
+class UploadStorage:
+    def upload(self, data: bytes, file_name: str, digest: str) -> str:
+        """Store `data` and return its URL."""
+        raise NotImplementedError
+
+
+class CloudinaryStorage(UploadStorage):
+    """Uploads from memory, the client is configured once per process."""
+
+    _configured = False
+    _configure_lock = threading.Lock()
+
+    def _configure(self) -> None:
+        import cloudinary
+
+        with self._configure_lock:
+            if not CloudinaryStorage._configured:
+                cloudinary.config(
+                    cloud_name=os.environ["CLOUDINARY_CLOUD_NAME"],
+                    api_key=os.environ["CLOUDINARY_API_KEY"],
+                    api_secret=os.environ["CLOUDINARY_API_SECRET"],
+                )
+                CloudinaryStorage._configured = True
+
+    def upload(self, data: bytes, file_name: str, digest: str) -> str:
+        import cloudinary.uploader
+
+        self._configure()
+        # reject if file size is too big
+        reply = cloudinary.uploader.upload(
+            io.BytesIO(data), filename=file_name, public_id=digest, overwrite=False
+        )
+        return reply["secure_url"]
+
+
+class LocalDirectoryStorage(UploadStorage):
+    """Files named by their digest in `root`, served from `base_url` if given."""
+
+    def __init__(self, root: str, base_url: str | None = None) -> None:
+        self.root = os.path.abspath(root)
+        self.base_url = base_url
+        os.makedirs(self.root, exist_ok=True)
+
+    def upload(self, data: bytes, file_name: str, digest: str) -> str:
+        name = digest + os.path.splitext(file_name)[1]
+        _write_atomic(os.path.join(self.root, name), data)
+        return self.url(name)
+
+    def url(self, name: str) -> str:
+        if self.base_url is not None:
+            return f"{self.base_url.rstrip('/')}/{name}"
+        return f"file://{os.path.join(self.root, name)}"
+
+
+class UrlIndex:
+    """Persistent tier, URLs by digest."""
+
+    def get(self, digest: str) -> str | None:
+        raise NotImplementedError
+
+    def put(self, digest: str, url: str) -> None:
+        raise NotImplementedError
+
+
+class DirectoryIndex(UrlIndex):
+    """One small file per digest, safe to share between processes."""
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, digest: str) -> str | None:
+        try:
+            with open(self._path(digest)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def put(self, digest: str, url: str) -> None:
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_atomic(path, url.encode())
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    # readers see the whole file or no file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+@dataclass
+class UploadCacheStats:
+    memory_hits: int = 0
+    persistent_hits: int = 0
+    uploads: int = 0
+    # bytes that a hit did not have to upload
+    bytes_saved: int = 0
+
+
+class UploadCache:
+    """Uploads by content, at most `memory_entries` URLs kept in memory."""
+
+    def __init__(
+        self,
+        storage: UploadStorage,
+        index: UrlIndex | None = None,
+        memory_entries: int = 1024,
+    ) -> None:
+        self.storage = storage
+        self.index = index
+        self.memory_entries = memory_entries
+        self.stats = UploadCacheStats()
+        self._urls: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, digest: str, url: str) -> None:
+        with self._lock:
+            self._urls[digest] = url
+            self._urls.move_to_end(digest)
+            while len(self._urls) > self.memory_entries:
+                self._urls.popitem(last=False)
+
+    def lookup(self, digest: str) -> str | None:
+        with self._lock:
+            url = self._urls.get(digest)
+            if url is not None:
+                self._urls.move_to_end(digest)
+                self.stats.memory_hits += 1
+                return url
+        if self.index is not None:
+            url = self.index.get(digest)
+            if url is not None:
+                self.stats.persistent_hits += 1
+                self._remember(digest, url)
+                return url
+        return None
+
+    def upload(self, data: FileData, file_name: str) -> str:
+        """The URL of `data`, uploaded unless the same bytes were before."""
+        data = read_file_data(data)
+        digest = hashlib.sha256(data).hexdigest()
+        url = self.lookup(digest)
+        if url is not None:
+            self.stats.bytes_saved += len(data)
+            return url
+        url = self.storage.upload(data, file_name, digest)
+        self.stats.uploads += 1
+        if self.index is not None:
+            self.index.put(digest, url)
+        self._remember(digest, url)
+        return url
+
+    def upload_many(
+        self, files: list[tuple[FileData, str]], max_workers: int = 8
+    ) -> list[str]:
+        """Upload (data, file_name) pairs concurrently, the URLs are in order.
+
+        Identical files within the batch are uploaded once.
+
+        """
+        contents = [(read_file_data(data), file_name) for data, file_name in files]
+        digests = [hashlib.sha256(data).hexdigest() for data, _ in contents]
+        unique = dict(zip(reversed(digests), reversed(contents)))
+        with ThreadPoolExecutor(max(1, min(max_workers, len(unique)))) as pool:
+            urls = dict(
+                zip(unique, pool.map(lambda item: self.upload(*item), unique.values()))
+            )
+        self.stats.bytes_saved += sum(len(data) for data, _ in contents) - sum(
+            len(data) for data, _ in unique.values()
+        )
+        return [urls[digest] for digest in digests]
+
+
+def read_file_data(data: FileData) -> bytes:
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return bytes(data)
+    return data.read()
@@ -0,0 +1,169 @@
+"""
+
+Concurrent fetching of the URLs of a message.
+
+The bots fetched links one at a time with a blocking requests.get and no
+timeout, inside the async handler: a message with three slow links took the sum
+of their latencies, and froze the event loop for every other request meanwhile.
+UrlFetcher fetches all of them concurrently on the shared client, with
+connect and read timeouts, at most `per_host` requests to the same host at
+once, a cap on the size of each body, and a total deadline. Links that are not
+done by the deadline are cancelled and reported as timed out, the others are
+returned as they are.
+
+    fetcher = UrlFetcher(deadline=15)
+    for result in await fetcher.fetch_all(urls):
+        if result.ok:
+            ...
+
+"""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator
+from urllib.parse import urlparse
+
+import httpx
+
+from http_client import get_async_client
+
+
+@dataclass
+class FetchResult:
+    url: str
+    status: int | None = None
+    content: bytes = b""
+    content_type: str = ""
+    error: str | None = None
+    seconds: float = 0.0
+    timed_out: bool = False
+    # the body was cut at max_bytes
+    truncated: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.status == 200
+
+
+@dataclass
+class _HostSlot:
+    semaphore: asyncio.Semaphore
+    # requests holding or waiting for the semaphore
+    users: int = 0
+
+
+class UrlFetcher:
+    """Fetch URLs concurrently, within `deadline` seconds in total.
+
+    Arguments:
+        - client: an httpx.AsyncClient, by default the shared one.
+        - connect_timeout, read_timeout: per request, in seconds.
+        - per_host: requests to the same host at once.
+        - max_bytes: the body is cut beyond this.
+
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient | None = None,
+        connect_timeout: float = 3.0,
+        read_timeout: float = 10.0,
+        per_host: int = 2,
+        deadline: float = 15.0,
+        max_bytes: int = 10 * 1024 * 1024,
+    ) -> None:
+        self.client = client
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.per_host = per_host
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        # only the hosts with requests in flight, a long-lived fetcher sees
+        # an unbounded number of hosts
+        self._hosts: dict[str, _HostSlot] = {}
+
+    @contextlib.asynccontextmanager
+    async def _host_slot(self, url: str) -> AsyncIterator[None]:
+        host = urlparse(url).netloc.lower()
+        slot = self._hosts.get(host)
+        if slot is None:
+            slot = self._hosts[host] = _HostSlot(asyncio.Semaphore(self.per_host))
+        slot.users += 1
+        try:
+            async with slot.semaphore:
+                yield
+        finally:
+            slot.users -= 1
+            if not slot.users:
+                del self._hosts[host]
+
+    async def _fetch(self, client: httpx.AsyncClient, url: str) -> FetchResult:
+        result = FetchResult(url)
+        start = time.monotonic()
+        try:
+            async with self._host_slot(url):
+                async with client.stream(
+                    "GET", url, timeout=self.timeout, follow_redirects=True
+                ) as response:
+                    result.status = response.status_code
+                    result.content_type = response.headers.get("content-type", "")
+                    chunks, size = [], 0
+                    async for chunk in response.aiter_bytes():
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if size >= self.max_bytes:
+                            result.truncated = True
+                            break
+                    result.content = b"".join(chunks)[: self.max_bytes]
+            if result.status != 200:
+                result.error = f"status {result.status}"
+        except httpx.TimeoutException:
+            result.error, result.timed_out = "timed out", True
+        except httpx.InvalidURL:
+            result.error = "invalid URL"
+        except httpx.HTTPError as e:
+            result.error = f"{type(e).__name__}: {e}"
+        result.seconds = time.monotonic() - start
+        return result
+
+    async def fetch_all(self, urls: list[str]) -> list[FetchResult]:
+        """The results in the order of `urls`, timed out past the deadline."""
+        if not urls:
+            return []
+        client = self.client or get_async_client()
+        tasks = [asyncio.ensure_future(self._fetch(client, url)) for url in urls]
+        try:
+            _, pending = await asyncio.wait(tasks, timeout=self.deadline)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # let the cancelled requests release their connections
+            await asyncio.gather(*tasks, return_exceptions=True)
+        results = []
+        for url, task in zip(urls, tasks):
+            if task in pending or task.cancelled():
+                results.append(
+                    FetchResult(
+                        url,
+                        error="deadline exceeded",
+                        seconds=self.deadline,
+                        timed_out=True,
+                    )
+                )
+            else:
+                results.append(task.result())
+        return results
+
+
+def log_results(results: list[FetchResult]) -> None:
+    for result in results:
+        print(
+            "fetch",
+            result.url,
+            result.status,
+            len(result.content),
+            f"{result.seconds:.2f}s",
+            result.error or "",
+        )
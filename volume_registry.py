@@ -0,0 +1,149 @@
+"""
+
+Registry of per-user volume handles.
+
+Looking up (and, the first time, creating) a NetworkFileSystem costs a round trip
+on every message. The registry caches handles for a TTL and makes sure that
+concurrent first messages from one user share a single lookup or creation.
+
+ModalVolumeBackend talks to Modal. LocalDirectoryBackend keeps each volume in a
+local directory, so the registry and everything that writes to volumes can be
+exercised without Modal.
+
+"""
+from __future__ import annotations
+
+import asyncio
+import fnmatch
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Iterator
+
+
+class VolumeBackend:
+    def lookup(self, name: str) -> Any:
+        """Return the handle of an existing volume, or None."""
+        raise NotImplementedError
+
+    def create(self, name: str) -> Any:
+        raise NotImplementedError
+
+
+class ModalVolumeBackend(VolumeBackend):
+    def lookup(self, name: str) -> Any:
+        import modal
+
+        try:
+            return modal.NetworkFileSystem.lookup(name)
+        except modal.exception.NotFoundError:
+            return None
+
+    def create(self, name: str) -> Any:
+        import modal
+
+        # creates the volume directly, no sandbox needed to hydrate it
+        return modal.NetworkFileSystem.lookup(name, create_if_missing=True)
+
+
+class LocalVolume:
+    """The NetworkFileSystem methods used by the bots, on a local directory."""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def _path(self, remote_path: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, remote_path.lstrip("/")))
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise ValueError(f"{remote_path} is outside of the volume")
+        return path
+
+    def write_file(self, remote_path: str, fp: BinaryIO) -> int:
+        path = self._path(remote_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(fp, f)
+            return f.tell()
+
+    def add_local_file(self, local_path: str, remote_path: str | None = None) -> int:
+        with open(local_path, "rb") as fp:
+            return self.write_file(remote_path or os.path.basename(local_path), fp)
+
+    def read_file(self, path: str) -> Iterator[bytes]:
+        with open(self._path(path), "rb") as f:
+            yield from iter(lambda: f.read(1024 * 1024), b"")
+
+    def listdir(self, pattern: str) -> list[str]:
+        paths = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.relpath(os.path.join(directory, name), self.root)
+                if fnmatch.fnmatch(path, pattern):
+                    paths.append(path)
+        return sorted(paths)
+
+    def remove_file(self, path: str) -> None:
+        os.remove(self._path(path))
+
+
+class LocalDirectoryBackend(VolumeBackend):
+    def __init__(self, root: str) -> None:
+        self.root = os.path.abspath(root)
+
+    def lookup(self, name: str) -> Any:
+        path = os.path.join(self.root, name)
+        return LocalVolume(path) if os.path.isdir(path) else None
+
+    def create(self, name: str) -> Any:
+        os.makedirs(os.path.join(self.root, name), exist_ok=True)
+        return LocalVolume(os.path.join(self.root, name))
+
+
+@dataclass
+class VolumeRegistryStats:
+    hits: int = 0
+    misses: int = 0
+    # callers that joined a lookup already in flight
+    joined: int = 0
+    created: int = 0
+
+
+class VolumeRegistry:
+    """Volume handles by name, cached for `ttl` seconds."""
+
+    def __init__(self, backend: VolumeBackend, ttl: float = 5 * 60) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.stats = VolumeRegistryStats()
+        self._handles: dict[str, tuple[Any, float]] = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    async def get(self, name: str) -> Any:
+        cached = self._handles.get(name)
+        if cached is not None and cached[1] > time.monotonic():
+            self.stats.hits += 1
+            return cached[0]
+
+        task = self._inflight.get(name)
+        if task is None:
+            self.stats.misses += 1
+            task = asyncio.ensure_future(self._open(name))
+            self._inflight[name] = task
+            task.add_done_callback(lambda _: self._inflight.pop(name, None))
+        else:
+            self.stats.joined += 1
+        # a cancelled request must not cancel the lookup the others are waiting on
+        return await asyncio.shield(task)
+
+    async def _open(self, name: str) -> Any:
+        loop = asyncio.get_running_loop()
+        handle = await loop.run_in_executor(None, self.backend.lookup, name)
+        if handle is None:
+            handle = await loop.run_in_executor(None, self.backend.create, name)
+            self.stats.created += 1
+        self._handles[name] = (handle, time.monotonic() + self.ttl)
+        return handle
+
+    def invalidate(self, name: str) -> None:
+        self._handles.pop(name, None)